@@ -0,0 +1 @@
+"""Offline benchmarks for echoscraper, run from the package root e.g. 'python -m benchmarks.bench_download'."""
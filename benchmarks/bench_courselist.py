@@ -0,0 +1,124 @@
+"""Compares ways of extracting the course list from the Echo360 home page.
+
+    Usage:
+        python -m benchmarks.bench_courselist [number of courses, default 2000 | saved home page]
+
+    Given a number, a home page listing that many courses is synthesized, with the markup
+    around each row that makes the real page large. A home page saved from a browser can be
+    given instead. Every parser must return the same courses, or the benchmark stops.
+    Memory is what Python allocates, lxml's trees are held outside it, and the parser
+    target never builds one."""
+
+import gc
+import os
+import re
+import sys
+import time
+import tracemalloc
+
+from lxml import etree, html
+
+from echoscraper import scraper
+from echoscraper.data import Course
+
+REPEATS = 10    # Best time of this many runs is reported
+
+def tree_xpath(text):
+    """parse_courselist as it was before streaming, for comparison."""
+    def scrape_course_data():
+        title = row.xpath(".//div[@class='info-main']")[0]
+        coursename = title.xpath("./h2/text()")[0]
+        teachingperiod = title.xpath("./h3/text()")[0]
+        groups = re.search(r"\d+ - (\d+) Semester (\d)", teachingperiod)
+        courseSyllabusLink = scraper.ECHO360_URL + re.sub('home', 'syllabus', row.xpath("./div/a/@href")[0])
+        return Course(coursename, courseSyllabusLink, int(groups.group(1)), int(groups.group(2)))
+
+    tree = html.fromstring(text)
+    courses = []
+    for row in tree.xpath(".//div[@class='home-content-main']/div"):
+        courses.append(scrape_course_data())
+    return courses
+
+ROWS = etree.XPath(".//div[@class='home-content-main']/div")
+INFO = etree.XPath("(.//div[@class='info-main'])[1]")
+NAME = etree.XPath("string(./h2[1]/text()[1])")
+PERIOD = etree.XPath("string(./h3[1]/text()[1])")
+HREF = etree.XPath("string((./div/a/@href)[1])")
+
+def tree_compiled(text):
+    """Whole tree, with XPath expressions compiled once."""
+    courses = []
+    for row in ROWS(html.fromstring(text)):
+        info = INFO(row)[0]
+        groups = scraper.TEACHING_PERIOD.search(PERIOD(info))
+        courses.append(Course(NAME(info), scraper.ECHO360_URL + HREF(row).replace('home', 'syllabus'),
+                              int(groups.group(1)), int(groups.group(2))))
+    return courses
+
+def synthesize(numCourses):
+    """returns: home page HTML listing 'numCourses' courses"""
+    rows = []
+    for num in range(numCourses):
+        rows.append("""
+        <div class="course-row" data-id="{0:08x}">
+            <div class="course-actions"><a href="/section/{0:08x}/home" class="btn">View</a>
+                <span class="icon"><svg viewBox="0 0 16 16"><path d="M0 0h16v16H0z"/></svg></span></div>
+            <div class="info-main"><h2>Course {0} &amp; Tutorials</h2><h3>3720 - {1} Semester {2}</h3>
+                <p class="description">{3}</p></div>
+            <div class="info-aside"><ul>{4}</ul></div>
+        </div>""".format(num, 2010 + num % 10, 1 + num % 2, "Lorem ipsum dolor sit amet. " * 8,
+                         ''.join('<li><a href="/media/{0}">Recording {0}</a></li>'.format(i) for i in range(5))))
+
+    return """<!DOCTYPE html><html><head><title>Echo360</title>
+    <script>{0}</script><style>{1}</style></head><body>
+    <nav>{2}</nav>
+    <div class="home-content-main">{3}
+    </div>
+    <footer>{2}</footer></body></html>""".format(
+        "var config = {};" * 200, ".course-row { display: block; }" * 200,
+        ''.join('<a href="/nav/{0}">Link {0}</a>'.format(i) for i in range(50)), ''.join(rows))
+
+def measure(parse, text):
+    """returns: (best seconds, peak bytes allocated) of parsing 'text'"""
+    best = float('inf')
+    for _ in range(REPEATS):
+        gc.collect()
+        start = time.perf_counter()
+        parse(text)
+        best = min(best, time.perf_counter() - start)
+
+    # lxml allocates outside Python, so only Python allocations are traced
+    gc.collect()
+    tracemalloc.start()
+    parse(text)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+def main():
+    arg = sys.argv[1] if len(sys.argv) > 1 else '2000'
+    if os.path.isfile(arg):
+        with open(arg, encoding='utf-8') as page:
+            text = page.read()
+    else:
+        text = synthesize(int(arg))
+
+    parsers = [
+        ("tree, xpath per row", tree_xpath),        # Before
+        ("tree, compiled xpath", tree_compiled),
+        ("parser target", scraper.parse_courselist),
+    ]
+
+    expected = [course.toDict() for course in tree_xpath(text)]
+    print("Home page with {0} courses, {1:.1f} MB of HTML:".format(len(expected), len(text) / 2**20))
+
+    for label, parse in parsers:
+        courses = [course.toDict() for course in parse(text)]
+        if courses != expected:
+            sys.exit("'{}' found different courses.".format(label))
+
+        seconds, peak = measure(parse, text)
+        print("    {0:<24} {1:>8.1f} ms  {2:>8.1f} MB peak Python".format(label, seconds * 1000, peak / 2**20))
+
+if __name__ == '__main__':
+    main()
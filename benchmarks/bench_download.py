@@ -0,0 +1,109 @@
+"""Measures download throughput of the copy path against a local HTTP server.
+
+    Usage:
+        python -m benchmarks.bench_download [size in MB, default 256]"""
+
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from echoscraper import download
+from echoscraper.download import LectureDownloader
+from echoscraper.progress import Progress
+
+# (label, chunk size, read straight into buffer)
+CONFIGS = [
+    ("iter_content 1 KiB", 2**10, False),
+    ("iter_content 1 MiB", 2**20, False),
+    ("readinto 1 MiB", 2**20, True),
+    ("readinto 8 MiB", 8 * 2**20, True),
+]
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    """Serves files from the current directory, with support for 'Range: bytes=start-end'."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = os.path.join(self.server.root, self.path.lstrip('/'))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(start, end, size))
+        else:
+            self.send_response(200)
+
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+
+        with open(path, 'rb') as fd:
+            fd.seek(start)
+            remaining = end - start + 1
+            while remaining:
+                chunk = fd.read(min(remaining, 2**20))
+                self.wfile.write(chunk)
+                remaining = remaining - len(chunk)
+
+def serve(root):
+    """Starts a range capable HTTP server for 'root' in a background thread.
+        returns: server, call 'shutdown()' when done"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+    server.root = root
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+
+    with tempfile.TemporaryDirectory() as root:
+        with open(os.path.join(root, 'lecture.mp4'), 'wb') as fd:
+            for _ in range(size):
+                fd.write(os.urandom(2**20))
+
+        server = serve(root)
+        url = 'http://127.0.0.1:{}/lecture.mp4'.format(server.server_address[1])
+        partpath = os.path.join(root, 'download.part')
+
+        print("Downloading {} MB from local server:".format(size))
+        for label, chunkSize, readinto in CONFIGS:
+            download.READINTO = readinto
+            downloader = LectureDownloader(None, chunkSize=chunkSize)
+
+            with open(os.devnull, 'w') as devnull:
+                wall, cpu = time.perf_counter(), time.process_time()
+                downloader.fetch(url, partpath, Progress(1, stream=devnull))
+                wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+
+            assert os.path.getsize(partpath) == size * 2**20
+            os.remove(partpath)
+            print("    {0:<20} {1:>8.1f} MB/s  {2:>6.2f}s wall  {3:>6.2f}s cpu".format(
+                label, size / wall, wall, cpu))
+
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
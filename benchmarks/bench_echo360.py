@@ -0,0 +1,419 @@
+"""Runs scrape and download end to end against a local mock of Echo360, so no real login is needed.
+
+    The mock serves the login form chain, a home page listing courses, JSON syllabuses and
+    range capable lecture videos, with optional latency and bandwidth limits. Each step of a
+    scenario runs echoscraper in a fresh process, and reports wall time, requests and bytes
+    served, CPU time and peak memory. Downloads run with '--metrics', whose counters are checked.
+
+    Usage:
+        python -m benchmarks.bench_echo360 [options] [scenario ...]
+
+    Scenarios are names from SCENARIOS, or 'COURSESxLECTURESxMB' e.g. '10x20x4', default 'small'.
+    Options:
+        --latency MS: Delay before each response, default 0
+        --bandwidth MB: Limit on each connection in megabytes per second, default unlimited
+        --jobs N: Parallel jobs passed to scrape and download with '-j', default 4
+        --async: Runs scrape and download with '-a', requires aiohttp
+        --sync: Runs the sync command instead of scrape then download, with '-j' downloads
+        --save FILE: Saves results as JSON, to compare later runs against
+        --compare FILE: Compares results with a saved run, exits with status 1 on a regression
+        --tolerance RATIO: Slowdown allowed by '--compare' before it's a regression, default 0.25
+        --verbose: Shows echoscraper's output"""
+
+import argparse
+import builtins
+import getpass
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# name: (courses, lectures per course, MB per lecture)
+SCENARIOS = {
+    "small": (4, 10, 1),
+    "many": (40, 50, 0.0625),
+    "large": (2, 2, 128),
+}
+
+# Downloading steps save their metrics here, to check '--metrics' works while downloading
+METRICS_FILE = 'metrics.json'
+
+# Steps of every scenario: (name, echoscraper arguments before the register)
+STEPS = [
+    ("scrape", ["scrape"]),
+    ("rescrape", ["scrape"]),       # Resumes session, pages are unchanged
+    ("download", ["download", "-y", "--metrics=" + METRICS_FILE]),
+]
+
+# Steps with '--sync', where syllabuses are scraped while lectures download
+SYNC_STEPS = [
+    ("sync", ["sync", "--metrics=" + METRICS_FILE]),
+    ("resync", ["sync"]),           # Nothing left to scrape or download
+]
+
+# Answers to echoscraper's login prompts
+EMAIL = "student@example.edu"
+USERNAME = "student"
+PASSWORD = "hunter2"
+SESSION_COOKIE = "mocksession"
+
+BLOCK = hashlib.sha256(b'echo360').digest() * 2**15     # 1 MiB of video, repeated
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FORM = """<html><body><form method="post" action="{0}">{1}</form></body></html>"""
+
+class MockEcho360(BaseHTTPRequestHandler):
+    """Serves just enough of Echo360, and an institution's login, for echoscraper to run."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, status, body=b'', headers=None, length=None):
+        """Sends a response after the server's latency, counting the request and bytes sent."""
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body) if length is None else length))
+        self.end_headers()
+        self.write(body)
+        self.server.count(len(body))
+
+    def write(self, body):
+        """Writes 'body', no faster than the server's bandwidth."""
+        if not self.server.bandwidth:
+            self.wfile.write(body)
+            return
+
+        start = time.monotonic()
+        for offset in range(0, len(body), 2**16):
+            self.wfile.write(body[offset:offset + 2**16])
+            delay = start + (offset + 2**16) / self.server.bandwidth - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def redirect(self, path, headers=None):
+        headers = dict(headers or {})
+        headers['Location'] = self.server.url + path
+        self.respond(302, headers=headers)
+
+    def loggedIn(self):
+        return 'session=' + SESSION_COOKIE in self.headers.get('Cookie', '')
+
+    def page(self, body, contentType):
+        """Sends a page, or 304 if the client's copy is still current."""
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.respond(304, headers={'ETag': etag})
+        else:
+            self.respond(200, body, {'ETag': etag, 'Content-Type': contentType})
+
+    def do_GET(self):
+        path = self.path.partition('?')[0]
+        match = re.match(r'/section/(\d+)/syllabus$', path)
+
+        if path.startswith('/video/'):
+            self.video(path)
+        elif path == '/home' and self.loggedIn():
+            self.page(self.server.home, 'text/html')
+        elif match and self.loggedIn() and int(match.group(1)) < len(self.server.syllabuses):
+            self.page(self.server.syllabuses[int(match.group(1))], 'application/json')
+        elif path in ('/', '/home') or match:
+            self.redirect('/login')
+        elif path in ('/login', '/adfs/ls'):
+            self.respond(200, b'<html><body>Enter your email address.</body></html>')
+        else:
+            self.respond(404)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form = dict(re.findall(r'([^&=]+)=([^&]*)', self.rfile.read(length).decode()))
+        url = self.server.url
+
+        if self.path == '/login/institutions':
+            # Known institution, so on to its login form
+            if 'example.edu' in form.get('email', ''):
+                self.respond(303, headers={'Location': url + '/adfs/ls'})
+            else:
+                self.respond(404)
+        elif self.path == '/adfs/ls':
+            if form.get('UserName') == USERNAME and form.get('Password') == PASSWORD:
+                inputs = '<input name="SAMLResponse" value="response"/><input name="RelayState" value="state"/>'
+                self.respond(200, FORM.format(url + '/sso/saml', inputs).encode())
+            else:
+                self.respond(200, b'<html><body>Incorrect user ID or password. Enter your password.</body></html>')
+        elif self.path == '/sso/saml':
+            inputs = '<input name="agentid" value="agent"/><input name="tokenid" value="token"/>'
+            self.respond(200, FORM.format(url + '/sso/agent', inputs).encode())
+        elif self.path == '/sso/agent':
+            self.redirect('/home', {'Set-Cookie': 'session={}; Path=/'.format(SESSION_COOKIE)})
+        else:
+            self.respond(404)
+
+    def video(self, path):
+        """Streams generated video of the scenario's size, or a quarter of it for the low quality
+            variant, with support for 'Range: bytes=start-end'."""
+        size = self.server.videoSize // 4 if path.endswith('sd1.mp4') else self.server.videoSize
+        start, end = 0, size - 1
+        headers = {'Accept-Ranges': 'bytes', 'Content-Type': 'video/mp4'}
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if start >= size:
+                headers['Content-Range'] = 'bytes */{}'.format(size)
+                self.respond(416, headers=headers)
+                return
+            headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, end, size)
+
+        # Body is streamed rather than built, so it's sent by hand instead of by 'respond'
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.send_response(206 if match else 200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+
+        view = memoryview(BLOCK)
+        sent = 0
+        try:
+            while start + sent <= end:
+                offset = (start + sent) % len(BLOCK)
+                chunk = view[offset:offset + min(end + 1 - start - sent, len(BLOCK) - offset)]
+                self.write(chunk)
+                sent = sent + len(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            # Client stopped reading, e.g. after probing the first byte
+            self.close_connection = True
+        finally:
+            self.server.count(sent)
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, courses, lectures, videoSize, latency=0, bandwidth=0):
+        super().__init__(('localhost', 0), MockEcho360)
+        # Cookies are only kept for named hosts, so the server isn't addressed by IP
+        self.url = 'http://localhost:{}'.format(self.server_address[1])
+        self.videoSize = videoSize
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes = 0
+        self.build(courses, lectures)
+
+    def build(self, courses, lectures):
+        """Builds the home page and syllabuses of 'courses' courses, each with 'lectures' lectures."""
+        rows = []
+        self.syllabuses = []
+        for course in range(courses):
+            rows.append(
+                '<div><div><a href="/section/{0}/home">Open</a></div>'
+                '<div class="info-main"><h2>Course {0}</h2><h3>3720 - {1} Semester {2}</h3></div></div>'
+                .format(course, 2014 + course % 5, 1 + course % 2))
+
+            data = []
+            for lecture in range(lectures):
+                video = '{0}/video/{1}/{2}/'.format(self.url, course, lecture)
+                data.append({"lesson": {
+                    "lesson": {
+                        "displayName": "Lecture {}".format(lecture),
+                        "timing": {
+                            "start": "2017-{0:02d}-{1:02d}T{2:02d}:00:00.000".format(
+                                1 + lecture % 12, 1 + lecture % 28, 8 + lecture % 10),
+                            "end": "2017-{0:02d}-{1:02d}T{2:02d}:50:00.000".format(
+                                1 + lecture % 12, 1 + lecture % 28, 8 + lecture % 10),
+                        },
+                    },
+                    "video": {"media": {"media": {"current": {"primaryFiles": [
+                        {"size": self.videoSize // 4, "s3Url": video + "sd1.mp4", "width": 640, "height": 360},
+                        {"size": self.videoSize, "s3Url": video + "hd1.mp4", "width": 1280, "height": 720},
+                    ]}}}},
+                }})
+            self.syllabuses.append(json.dumps({"status": "ok", "data": data}).encode())
+
+        self.home = '<html><body><div class="home-content-main">{}</div></body></html>'.format(
+            ''.join(rows)).encode()
+
+    def handle_error(self, request, client_address):
+        # Clients exiting with idle keep-alive connections open reset them, which is expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def count(self, nbytes):
+        with self.lock:
+            self.requests = self.requests + 1
+            self.bytes = self.bytes + nbytes
+
+    def counters(self):
+        with self.lock:
+            return self.requests, self.bytes
+
+def child(argv):
+    """Runs echoscraper with its login prompts answered, in the process started by 'step'."""
+    answers = {'Email': EMAIL, 'Username': USERNAME}
+    builtins.input = lambda prompt='': next((value for key, value in answers.items() if key in prompt), '')
+    getpass.getpass = lambda prompt='': PASSWORD
+
+    from echoscraper.echoscraper import main
+    sys.argv = ['echoscraper'] + argv
+    main()
+
+def step(server, workdir, argv, verbose):
+    """Runs echoscraper in a new process against 'server'.
+        returns: dict of the step's measurements"""
+    env = dict(os.environ)
+    env.update({
+        'ECHO360_URL': server.url,
+        'ECHO360_LOGIN_URL': server.url + '/login/institutions',
+        'HOME': workdir,        # Keeps the session file away from the user's own
+        'PYTHONPATH': os.pathsep.join(filter(None, [REPO, env.get('PYTHONPATH')])),
+    })
+    output = None if verbose else subprocess.DEVNULL
+
+    requests, nbytes = server.counters()
+    wall = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'benchmarks.bench_echo360', '--child'] + argv,
+        cwd=workdir, env=env, stdin=subprocess.DEVNULL, stdout=output, stderr=output)
+    _, status, usage = os.wait4(proc.pid, 0)
+    wall = time.perf_counter() - wall
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    after = server.counters()
+
+    if proc.returncode:
+        raise RuntimeError("'echoscraper {0}' exited with status {1}".format(' '.join(argv), proc.returncode))
+
+    return {
+        'wall': wall,
+        'requests': after[0] - requests,
+        'bytes': after[1] - nbytes,
+        'cpu': usage.ru_utime + usage.ru_stime,
+        'rss': usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024),
+    }
+
+def downloaded(workdir):
+    """returns: (number, total size) of files downloaded into 'workdir', ignoring hidden files e.g. the store's index"""
+    sizes = [
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(os.path.join(workdir, 'lectures')) for name in names if not name.startswith('.')
+    ]
+    return len(sizes), sum(sizes)
+
+def scenario(spec):
+    """returns: (courses, lectures, MB) of a scenario name or 'COURSESxLECTURESxMB'"""
+    if spec in SCENARIOS:
+        return SCENARIOS[spec]
+    match = re.match(r'(\d+)x(\d+)x(\d*\.?\d+)$', spec)
+    if not match:
+        raise argparse.ArgumentTypeError("unknown scenario '{}'".format(spec))
+    return int(match.group(1)), int(match.group(2)), float(match.group(3))
+
+def run(spec, args):
+    """Runs every step of a scenario.
+        returns: dict of step name: measurements"""
+    courses, lectures, megabytes = scenario(spec)
+    videoSize = int(megabytes * 2**20)
+    flags = ['-j', str(args.jobs)] + (['-a'] if args.asynchronous else [])
+
+    server = MockServer(courses, lectures, videoSize, args.latency / 1000, args.bandwidth * 2**20)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    print("Scenario '{0}': {1} courses x {2} lectures x {3:g} MB".format(spec, courses, lectures, megabytes))
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            for name, command in (SYNC_STEPS if args.sync else STEPS):
+                results[name] = result = step(server, workdir, command + flags + ['register.json'], args.verbose)
+                print("    {0:<10} {1:>8.2f}s wall {2:>7.2f}s cpu {3:>7} requests {4:>10.1f} MB {5:>8.1f} MB rss".format(
+                    name, result['wall'], result['cpu'], result['requests'],
+                    result['bytes'] / 2**20, result['rss'] / 2**20))
+
+            # Wrong results would make the timings meaningless
+            expected = (courses * lectures, courses * lectures * videoSize)
+            if downloaded(workdir) != expected:
+                raise RuntimeError("Downloaded {0[0]} files, {0[1]} bytes, expected {1[0]} files, {1[1]} bytes".format(
+                    downloaded(workdir), expected))
+
+            with open(os.path.join(workdir, METRICS_FILE)) as metricsfile:
+                completed = json.load(metricsfile)["counters"].get("download.completed", 0)
+            if completed != expected[0]:
+                raise RuntimeError("Metrics counted {0} completed downloads, expected {1}".format(completed, expected[0]))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    return results
+
+def compare(results, baseline, tolerance):
+    """Prints measurements which are worse than the baseline.
+        returns: True if there was a regression"""
+    regressed = False
+    for spec, steps in results.items():
+        for name, result in steps.items():
+            before = baseline.get(spec, {}).get(name)
+            if not before:
+                continue
+            for measure in ('wall', 'cpu', 'requests', 'bytes', 'rss'):
+                # Counts are exact, timings and memory vary from run to run
+                allowed = before[measure] if measure in ('requests', 'bytes') else before[measure] * (1 + tolerance)
+                if result[measure] > allowed:
+                    regressed = True
+                    print("Regression in '{0}' {1}: {2} {3:.4g}, was {4:.4g}".format(
+                        spec, name, measure, result[measure], before[measure]))
+    return regressed
+
+def main():
+    if sys.argv[1:2] == ['--child']:
+        child(sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('scenarios', nargs='*', default=['small'])
+    parser.add_argument('--latency', type=float, default=0, help="milliseconds before each response")
+    parser.add_argument('--bandwidth', type=float, default=0, help="MB/s limit on each connection")
+    parser.add_argument('--jobs', type=int, default=4)
+    parser.add_argument('--async', dest='asynchronous', action='store_true')
+    parser.add_argument('--sync', action='store_true')
+    parser.add_argument('--save', metavar='FILE')
+    parser.add_argument('--compare', metavar='FILE')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    if args.sync and args.asynchronous:
+        parser.error("--sync can't be run with --async")
+
+    for spec in args.scenarios:
+        try:
+            scenario(spec)
+        except argparse.ArgumentTypeError as err:
+            parser.error(str(err))
+
+    results = {spec: run(spec, args) for spec in args.scenarios}
+
+    if args.save:
+        with open(args.save, 'w') as savefile:
+            json.dump(results, savefile, indent=2)
+
+    if args.compare:
+        with open(args.compare) as basefile:
+            if compare(results, json.load(basefile), args.tolerance):
+                sys.exit(1)
+        print("No regressions against '{}'.".format(args.compare))
+
+if __name__ == '__main__':
+    main()
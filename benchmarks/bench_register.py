@@ -0,0 +1,135 @@
+"""Compares memory use and load/save time of register codecs on a synthetic register.
+
+    Usage:
+        python -m benchmarks.bench_register [number of lectures, default 50000]"""
+
+import gc
+import json
+import sys
+import time
+import tracemalloc
+
+from echoscraper import data
+from echoscraper.data import Course, Lecture
+
+LECTURES_PER_COURSE = 250
+REPEATS = 10    # Best time of this many runs is reported
+
+class DictLecture(object):
+    """Lecture as it was before '__slots__', for comparison."""
+    def __init__(self, name, date, time, dllink, filename=''):
+        self.name = name
+        self.date = date
+        self.time = time
+        self.dllink = dllink
+        self.filename = filename
+
+    @property
+    def key(self):
+        return (self.name, self.date, self.time)
+
+class DictCourse(object):
+    """Course as it was before '__slots__', for comparison."""
+    def __init__(self, name="", courselink="", year="", semester=0, lectures=None):
+        self.name = name
+        self.courselink = courselink
+        self.year = year
+        self.semester = semester
+        self.lectures = []
+        self._index = {}
+
+        for lect in lectures or []:
+            if lect.key not in self._index:
+                self._index[lect.key] = len(self.lectures)
+                self.lectures.append(lect)
+
+def dict_decode(dct):
+    if 'date' in dct:
+        return DictLecture(dct['name'], dct['date'], dct['time'], dct['dllink'], dct['filename'])
+    return DictCourse(dct['name'], dct['courselink'], dct['year'], dct['semester'], dct['lectures'])
+
+def synthesize(numLectures):
+    """Returns list of Course objects holding 'numLectures' lectures in total."""
+    courses = []
+    for lectIndx in range(numLectures):
+        if lectIndx % LECTURES_PER_COURSE == 0:
+            num = len(courses)
+            courses.append(Course(
+                "Course {}".format(num),
+                "https://echo360.org.au/section/{:08x}/syllabus".format(num),
+                2014 + num % 5,
+                1 + num % 2
+            ))
+        courses[-1].addLecture(Lecture(
+            "Lecture {}".format(lectIndx),
+            "2017/{0:02d}/{1:02d}".format(1 + lectIndx % 12, 1 + lectIndx % 28),
+            "{0:02d}:00".format(8 + lectIndx % 10),
+            "https://s3.amazonaws.com/echo360/{:016x}/hd1.mp4?X-Amz-Signature=abcdef".format(lectIndx),
+            "lectures/2017/semester1/Course/Lecture {}".format(lectIndx) if lectIndx % 3 else ''
+        ))
+    return courses
+
+def measure(load, text):
+    """Returns (seconds, bytes) taken to load and hold the decoded register."""
+    best = float('inf')
+    for _ in range(REPEATS):
+        gc.collect()
+        start = time.perf_counter()
+        load(text)
+        best = min(best, time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    result = load(text)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return best, size
+
+def timeit(func):
+    best = float('inf')
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    numLectures = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    courses = synthesize(numLectures)
+    text = data.dumps(courses)
+    backend = data.orjson
+
+    print("Register with {0} courses, {1} lectures, {2:.1f} MB of JSON:".format(
+        len(courses), numLectures, len(text) / 2**20))
+
+    loaders = [
+        ("object_hook, __dict__ classes", lambda t: json.loads(t, object_hook=dict_decode)),   # Before
+        ("object_hook, __slots__ classes", lambda t: json.loads(t, object_hook=data.decode)),
+        ("bulk, stdlib json", lambda t: data.loads(t)),
+    ]
+    if backend:
+        loaders.append(("bulk, orjson", lambda t: data.loads(t)))
+
+    print("    Load:")
+    for label, load in loaders:
+        data.orjson = backend if 'orjson' in label else None
+        seconds, size = measure(load, text)
+        print("        {0:<32} {1:>8.1f} ms  {2:>8.1f} MB".format(label, seconds * 1000, size / 2**20))
+
+    savers = [
+        ("Encoder.default", lambda: json.dumps(courses, cls=data.Encoder)),
+        ("bulk, stdlib json", lambda: data.dumps(courses)),
+    ]
+    if backend:
+        savers.append(("bulk, orjson", lambda: data.dumps(courses)))
+
+    print("    Save:")
+    for label, save in savers:
+        data.orjson = backend if 'orjson' in label else None
+        print("        {0:<32} {1:>8.1f} ms".format(label, timeit(save) * 1000))
+
+    data.orjson = backend
+
+if __name__ == '__main__':
+    main()
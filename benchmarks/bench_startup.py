@@ -0,0 +1,96 @@
+"""Measures how long quick commands take to start, and checks they don't import heavy dependencies.
+
+    Usage:
+        python -m benchmarks.bench_startup [import time target in ms, default 50]
+
+    Each command is run REPEATS times in a fresh interpreter, and the best wall time is reported
+    beside an empty interpreter's. Imports are measured with 'python -X importtime', and the run
+    fails if a command imports more than the target, or any module in HEAVY."""
+
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+from echoscraper import data
+from echoscraper.data import Course, Lecture
+
+REPEATS = 10
+
+# (label, echoscraper arguments), '{}' is replaced by the register's filename
+COMMANDS = [
+    ("usage", []),
+    ("register", ["register", "{}"]),
+    ("register -d", ["register", "-d", "{}"]),
+]
+
+# Only needed to talk to Echo360, or for SQLite registers
+HEAVY = ('requests', 'lxml', 'aiohttp', 'asyncio', 'sqlite3')
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def run(argv, workdir, importtime=False):
+    """Runs 'python [-X importtime] argv' in 'workdir'.
+        returns: (wall seconds, stderr)"""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO, os.environ.get('PYTHONPATH')])))
+    flags = ['-X', 'importtime'] if importtime else []
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable] + flags + argv, cwd=workdir, env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    return time.perf_counter() - start, proc.stderr
+
+def best(argv, workdir):
+    return min(run(argv, workdir)[0] for _ in range(REPEATS))
+
+def imports(stderr):
+    """Parses the output of '-X importtime', counting what's imported once echoscraper starts.
+        returns: (total microseconds, set of module names)"""
+    total = 0
+    modules = set()
+    started = False
+    for line in stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)', line)
+        if not match:
+            continue
+        cumulative, indent, name = int(match.group(1)), len(match.group(2)), match.group(3)
+        started = started or name.startswith('echoscraper')
+        if started:
+            modules.add(name)
+            if indent == 1:
+                # Top level imports, their cumulative time includes everything below them
+                total = total + cumulative
+    return total, modules
+
+def main():
+    target = float(sys.argv[1]) if len(sys.argv) > 1 else 50
+    failed = False
+
+    with tempfile.TemporaryDirectory() as workdir:
+        regname = os.path.join(workdir, 'register.json')
+        course = Course("Course", "https://echo360.org.au/section/0/syllabus", 2017, 1)
+        course.addLecture(Lecture("Lecture", "2017/03/01", "10:00", "https://example.com/0.mp4"))
+        with open(regname, 'w') as regfile:
+            regfile.write(data.dumps([course]))
+
+        print("Startup, best of {}:".format(REPEATS))
+        print("    {0:<14} {1:>8.1f} ms wall".format("python", best(['-c', 'pass'], workdir) * 1000))
+
+        for label, args in COMMANDS:
+            argv = ['-m', 'echoscraper'] + [arg.format(regname) for arg in args]
+            wall = best(argv, workdir)
+            total, modules = imports(run(argv, workdir, importtime=True)[1])
+            heavy = sorted(name for name in HEAVY if name in modules)
+
+            print("    {0:<14} {1:>8.1f} ms wall {2:>8.1f} ms importing{3}".format(
+                label, wall * 1000, total / 1000, ", imports " + ', '.join(heavy) if heavy else ''))
+            if heavy or total / 1000 > target:
+                failed = True
+
+    if failed:
+        print("Startup target of {:g} ms importing, without heavy dependencies, was missed.".format(target))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
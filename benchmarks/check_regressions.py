@@ -0,0 +1,143 @@
+"""Checks fixed bugs stay fixed, against the local mock of Echo360 from bench_echo360 where they need one.
+
+    Each check runs in a fresh temporary folder, with each storage engine in ENGINES:
+        variants: 'sync -q' and 'download -q' save the chosen variant's file, but the
+                  register keeps the link to the largest, as does choosing for 'watch'
+        missing:  'register -m' counts every lecture of a course, only listing missing ones
+        commit:   a course added with its lectures is saved with them, not just the course
+
+    Usage:
+        python -m benchmarks.check_regressions [--verbose]
+    Exits with status 1 if any check fails."""
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import threading
+
+from benchmarks.bench_echo360 import MockServer, step, downloaded
+from echoscraper import register
+from echoscraper.data import Course, Lecture
+from echoscraper.download import lecturesToDownload, chooseVariants
+from echoscraper.register import Register
+
+ENGINES = ('register.json', 'register.jsonl', 'register.db')
+
+# Mock register: (courses, lectures per course, bytes of the largest variant)
+COURSES, LECTURES, VIDEO_SIZE = 2, 3, 2**20
+
+def checkVariants(server, regname, commands, verbose):
+    """returns: list of failures after running each of 'commands', the last with '-q smallest'"""
+    with tempfile.TemporaryDirectory() as workdir:
+        for command in commands:
+            step(server, workdir, command + [regname], verbose)
+
+        failures = []
+        expected = (COURSES * LECTURES, COURSES * LECTURES * (VIDEO_SIZE // 4))
+        if downloaded(workdir) != expected:
+            failures.append("downloaded {0[0]} files, {0[1]} bytes, expected {1[0]} smallest variants, {1[1]} bytes".format(
+                downloaded(workdir), expected))
+
+        for course in Register(os.path.join(workdir, regname)):
+            for lect in course.lectures:
+                if not lect.dllink.endswith('hd1.mp4'):
+                    failures.append("register saved link '{0}' of {1}".format(lect.dllink, lect))
+                if not lect.filename:
+                    failures.append("register didn't save filename of {}".format(lect))
+        return failures
+
+def checkWatchVariants():
+    """returns: list of failures after choosing variants for the lectures 'watch' would download"""
+    reg = Register()
+    reg.append(Course("Course 0", "/course/0", 2017, 1, [
+        Lecture("Lecture {}".format(indx), "2017/01/0{}".format(indx + 1), "09:00", "/hd1.mp4", variants=[
+            {"url": "/sd1.mp4", "size": 1, "height": 360},
+            {"url": "/hd1.mp4", "size": 4, "height": 720},
+        ]) for indx in range(LECTURES)
+    ]))
+
+    tasks = chooseVariants(list(lecturesToDownload(reg, None)), 'smallest')
+    failures = ["queued link '{0}' of {1}".format(lect.dllink, lect) for _, lect in tasks if lect.dllink != '/sd1.mp4']
+    failures.extend("register changed to link '{0}' of {1}".format(lect.dllink, lect)
+        for lect in reg[0].lectures if lect.dllink != '/hd1.mp4')
+    return failures
+
+def sampleCourse():
+    """returns: Course with LECTURES lectures, all but the last downloaded"""
+    return Course("Course 0", "/course/0", 2017, 1, [
+        Lecture("Lecture {}".format(indx), "2017/01/0{}".format(indx + 1), "09:00", "/{}.mp4".format(indx),
+            "lectures/{}".format(indx) if indx < LECTURES - 1 else '')
+        for indx in range(LECTURES)
+    ])
+
+def checkMissing(regname):
+    """returns: list of failures in the output of 'register -m'"""
+    with tempfile.TemporaryDirectory() as workdir:
+        regname = os.path.join(workdir, regname)
+        with contextlib.redirect_stdout(io.StringIO()):
+            with Register(regname) as reg:
+                reg.append(sampleCourse())
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            register.start([regname], {'m': True})
+        output = output.getvalue()
+
+        failures = []
+        if "with {} lectures".format(LECTURES) not in output:
+            failures.append("course doesn't count all {0} lectures:\n{1}".format(LECTURES, output))
+        if output.count("\tMissing") != 1 or "\tFound" in output:
+            failures.append("expected only the 1 missing lecture to be listed:\n{}".format(output))
+        return failures
+
+def checkCommit(regname):
+    """returns: list of failures after adding a course with lectures to an existing register"""
+    with tempfile.TemporaryDirectory() as workdir:
+        regname = os.path.join(workdir, regname)
+        with contextlib.redirect_stdout(io.StringIO()):
+            # Created empty first, so the course is saved by committing the change rather than writing the whole register
+            with Register(regname):
+                pass
+            with Register(regname) as reg:
+                reg.append(sampleCourse())
+
+        saved = [(lect.key, lect.filename) for course in Register(regname, load=False).iterCourses() for lect in course.lectures]
+        expected = [(lect.key, lect.filename) for lect in sampleCourse().lectures]
+        return [] if saved == expected else ["saved lectures {0}, expected {1}".format(saved, expected)]
+
+def main():
+    verbose = '--verbose' in sys.argv[1:]
+
+    server = MockServer(COURSES, LECTURES, VIDEO_SIZE)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    checks = [("watch variants", checkWatchVariants)]
+    for regname in ENGINES:
+        checks.extend([
+            ("sync variants, " + regname, lambda regname=regname: checkVariants(server, regname, [['sync', '-q', 'smallest']], verbose)),
+            ("download variants, " + regname, lambda regname=regname: checkVariants(server, regname, [['scrape'], ['download', '-y', '-q', 'smallest']], verbose)),
+            ("missing, " + regname, lambda regname=regname: checkMissing(regname)),
+            ("commit, " + regname, lambda regname=regname: checkCommit(regname)),
+        ])
+
+    failed = 0
+    try:
+        for name, check in checks:
+            failures = check()
+            print("    {0:<40} {1}".format(name, "failed" if failures else "ok"))
+            for failure in failures:
+                print("        " + failure)
+            failed = failed + bool(failures)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    if failed:
+        print("{0} of {1} checks failed.".format(failed, len(checks)))
+        sys.exit(1)
+    print("All {} checks passed.".format(len(checks)))
+
+if __name__ == '__main__':
+    main()
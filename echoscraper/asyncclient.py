@@ -0,0 +1,486 @@
+"""Asyncio client for Echo360, runs a whole scrape or download on a single event loop.
+    Used by 'scrape -a' and 'download -a', instead of one blocking connection per thread.
+    Requires aiohttp, installed with 'pip install echoscraper[async]'."""
+
+import asyncio          # Event loop
+import http.cookies     # Builds cookies with their original domain
+import os               # Creates directory to store downloaded lectures
+import signal           # Captures SIGINT
+import time             # Times first byte of downloads
+from datetime import datetime   # Logs time of download errors
+
+try:
+    import aiohttp
+    import yarl         # URLs, installed with aiohttp
+except ImportError:
+    aiohttp = None
+
+from .echo360login import SESSION_FILE, ECHO360_URL, INSTITUTIONS_URL
+from .echo360login import askEmail, institutionFound, askCredentials, loginAccepted, loginRejected
+from .echo360login import parseForm, loadCookies, saveCookies
+from . import metrics
+from .cache import ResponseCache
+from .register import Register, FLUSH_EVERY, FLUSH_INTERVAL
+from .scraper import parse_courselist, parse_syllabus, CACHE_SUFFIX
+from .download import LectureDownloader, loadQueue, planQueue, confirm, preflight, partPath
+from .download import RETRIES, BACKOFF, TIMEOUT, CHUNK_SIZE
+from .progress import Progress, humanize
+from .scheduler import order
+from .store import ContentStore, linkFile, mediaKey
+
+def available():
+    """Checks aiohttp is installed, telling the user how to install it if not."""
+    if aiohttp is None:
+        print("Option '-a' requires aiohttp, install it with 'pip install echoscraper[async]'.")
+        return False
+    return True
+
+class AsyncEcho360login(object):
+    """Asynchronous version of Echo360login, sharing its prompts and session file.
+
+        usage:
+            async with AsyncEcho360login(connections) as client:
+                if await client.login():
+                    ...     # Make requests with client.sesh"""
+
+    def __init__(self, connections, sessionfile=SESSION_FILE, hostConnections=0):
+        self.connections = connections  # Open connections allowed at once
+        self.hostConnections = hostConnections  # ...and to each host, 0 for any
+        self.sessionfile = sessionfile
+        self.sesh = None
+
+    async def __aenter__(self):
+        self.sesh = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.connections, limit_per_host=self.hostConnections),
+            # Stalled connections time out, but downloads can take as long as they need
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=TIMEOUT, sock_read=TIMEOUT),
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.sesh.close()
+
+    @metrics.timed('login')
+    async def login(self, fresh=False):
+        """Logs into Echo360 and authenticates for all future requests.
+            Reuses the session saved by a previous login if it's still valid.
+            fresh: ignore any saved session and log in again"""
+        if not fresh and await self.resumeSession():
+            print("Resumed previous Echo360 session.")
+            return True
+
+        print("Logging in to Echo360...")
+
+        # Load Institution login page
+        async with self.sesh.get(ECHO360_URL) as response:
+            await response.read()
+
+        while True:
+            postData = askEmail()
+            email = postData['email']
+            async with self.sesh.post(INSTITUTIONS_URL, data=postData) as response:
+                await response.read()
+                url = response.url
+
+            if institutionFound(response.status, email):
+                break
+
+        # Now on actual login page, get username & password, then POST to login
+        attempts = 3
+        while attempts > 0:
+            async with self.sesh.post(url, data=askCredentials(email)) as response:
+                text = await response.text()
+                url = response.url
+
+            if loginAccepted(text):
+                break
+
+            attempts = attempts - 1
+            if loginRejected(attempts):
+                return False
+
+        # Ping identity SAMLRequest and RelayState, then its agentid and tokenid back to echo360
+        text = await self.autoPOST(text)
+        text = await self.autoPOST(text)
+
+        print("Login Successful.")
+        self.saveSession()
+        return True
+
+    async def resumeSession(self):
+        """Loads cookies saved by a previous login, and checks they're still accepted.
+            returns: True if session is still logged in"""
+        cookies = loadCookies(self.sessionfile)
+        if not cookies:
+            return False
+
+        try:
+            for cookie in cookies:
+                morsel = http.cookies.SimpleCookie()
+                morsel[cookie['name']] = cookie['value']
+                morsel[cookie['name']]['domain'] = cookie['domain']
+                morsel[cookie['name']]['path'] = cookie['path']
+                self.sesh.cookie_jar.update_cookies(
+                    morsel, yarl.URL('https://' + cookie['domain'].lstrip('.')))
+        except (KeyError, TypeError, AttributeError, http.cookies.CookieError):
+            self.sesh.cookie_jar.clear()
+            return False
+
+        # Logged in users get the home page, everyone else is redirected to log in
+        try:
+            async with self.sesh.get(ECHO360_URL + '/home', allow_redirects=False) as response:
+                status = response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            status = None
+
+        if status != 200:
+            self.sesh.cookie_jar.clear()
+            return False
+
+        return True
+
+    def saveSession(self):
+        """Saves session cookies, in the same format as Echo360login."""
+        saveCookies(self.sessionfile, [{
+            'name': morsel.key,
+            'value': morsel.value,
+            'domain': morsel['domain'],
+            'path': morsel['path'] or '/',
+            'expires': None,
+            'secure': bool(morsel['secure']),
+        } for morsel in self.sesh.cookie_jar])
+
+    @metrics.timed('login.autopost')
+    async def autoPOST(self, text):
+        """Used when post form needs to submit default values.
+            returns: text of the page the form leads to"""
+        url, data = parseForm(text)
+        async with self.sesh.post(url, data=data) as response:
+            return await response.text()
+
+    async def cachedGet(self, cache, url):
+        """Same as ResponseCache.get, for the asynchronous session."""
+        with metrics.span('scrape.fetch'):
+            async with self.sesh.get(url, headers=cache.conditional(url)) as response:
+                content = await response.read()
+                text = content.decode(response.get_encoding(), 'replace')
+                return cache.update(url, response.status, response.headers, content, text)
+
+class AsyncLectureSpider(AsyncEcho360login):
+    """Asynchronous version of LectureSpider, all syllabuses are requested at once
+        over at most 'jobs' connections."""
+
+    def __init__(self, regname, jobs):
+        super().__init__(jobs)
+        self.regname = regname
+        self.register = None
+        self.cache = ResponseCache(regname + CACHE_SUFFIX)
+
+    async def run(self, refresh=False, fresh=False):
+        async with self:
+            if not await self.login(fresh):
+                return
+
+            # Register is read once and kept for the whole run, changes are flushed in batches
+            self.register = Register(self.regname, FLUSH_EVERY, FLUSH_INTERVAL)
+
+            if refresh or not self.register.exists:
+                # Cached pages are only skipped if they've already been scraped into the register
+                self.cache.clear()
+
+            with self.register:
+                await self.scrape_courselist()
+
+                results = await asyncio.gather(
+                    *[self.scrape_course_lectures(course) for course in self.register])
+
+                # Merge all lectures into register in one pass
+                for indx, lectures in enumerate(results):
+                    for lect in lectures:
+                        self.register.appendLecture(indx, lect)
+
+        # Only save cache once its pages are safely in the register
+        self.cache.save()
+        print("Page cache: {}".format(self.cache.summary()))
+
+        print("\nBuilt ", end='')
+        self.register.docket()
+        print("\nRun 'echoscraper download {}' to begin downloading.".format(self.regname))
+
+    @metrics.timed('scrape.courselist')
+    async def scrape_courselist(self):
+        """Scrapes links to all courses with available lectures."""
+        print("Scraping course metadata...")
+
+        text, changed = await self.cachedGet(self.cache, ECHO360_URL + "/home")
+        if not changed:
+            print("Course list unchanged since last scrape.")
+            return
+
+        for course in parse_courselist(text):
+            self.register.appendIfMissing(course)
+
+    @metrics.timed('scrape.syllabus')
+    async def scrape_course_lectures(self, course):
+        """Downloads and parses a course's syllabus.
+            returns: list of Lecture objects in course syllabus"""
+        try:
+            text, changed = await self.cachedGet(self.cache, course.courselink)
+            if not changed:
+                print("Lectures for '{}' unchanged since last scrape.".format(course.name))
+                return []
+
+            print("Scraping lectures for '{}'...".format(course.name))
+            return parse_syllabus(text)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as err:
+            print("Couldn't scrape lectures for '{0}': {1}".format(course.name, err))
+            self.cache.forget(course.courselink)
+            return []
+
+class AsyncLectureDownloader(AsyncEcho360login):
+    """Asynchronous version of LectureDownloader, 'jobs' lectures are downloaded at once.
+        Downloads are scheduled, resume from '.part' files and retry like LectureDownloader's,
+        but aren't segmented."""
+
+    def __init__(self, regname, jobs, chunkSize=CHUNK_SIZE, bucket=None, hostConnections=0):
+        super().__init__(jobs, hostConnections=hostConnections)
+        self.jobs = jobs
+        self.chunkSize = chunkSize
+        self.bucket = bucket    # TokenBucket limiting combined rate of all downloads
+        # Register is streamed rather than loaded, each completed download is flushed
+        self.register = Register(regname, flushEvery=1, load=False)
+        self.store = ContentStore()     # Videos already downloaded, by any register or course
+        self.pending = {}               # Media key: Event set once its download is done
+        self.numDownloaded = 0
+        self.halt = False       # Stop starting new downloads
+        self.quit = False       # Abandon downloads in progress
+
+    async def run(self, options):
+        if not self.register.exists:
+            return
+
+        async with self:
+            if not await self.login('l' in options):
+                return
+
+            queue, tasks = loadQueue(self.register, options)
+            if 'plan' in options:
+                # Only checks what would be downloaded, nothing is queued
+                if tasks is None:
+                    tasks, _ = planQueue(self.register, options)
+                return preflight(tasks, await self.probeSizes(tasks), options)
+
+            planned = tasks is None
+            if planned:
+                tasks, chosen = planQueue(self.register, options)
+                sizes = await self.probeSizes(tasks) if options.get('p') == 'smallest' else None
+                tasks = order(tasks, options.get('p', 'register'), sizes, chosen)
+
+            # Ask before continuing
+            if not confirm(options):
+                return
+
+            if planned:
+                # Only saved once confirmed, so a declined plan isn't resumed by the next run
+                queue.create(tasks)
+
+            loop = asyncio.get_running_loop()
+            loop.add_signal_handler(signal.SIGINT, self.interrupt_handler)
+            # Lectures downloaded before the store existed can be linked too
+            self.store.addDownloaded(self.register)
+            try:
+                # Leaving the 'with' block flushes the register, even after a forced quit
+                with self.register:
+                    await self.downloadConcurrently(queue, tasks)
+            finally:
+                loop.remove_signal_handler(signal.SIGINT)
+                self.store.save()
+
+            if not self.halt:
+                # Every lecture has been tried, failures are planned again next time
+                queue.remove()
+
+        print("{0} lecture{1} downloaded.".format(
+            self.numDownloaded, 's' if self.numDownloaded != 1 else '')
+        )
+
+    async def probeSizes(self, tasks):
+        """returns: file size, or None if unknown, of each (course, lecture)"""
+        async def probe(url):
+            # First byte only, see LectureDownloader.probe
+            try:
+                async with self.sesh.get(url, headers={'Range': 'bytes=0-0'}) as resp:
+                    total = resp.headers.get('content-range', '').rpartition('/')[2]
+                    if resp.status == 206 and total.isdigit():
+                        return int(total)
+                    if resp.status == 200 and resp.content_length is not None:
+                        return resp.content_length
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+            return None
+
+        return await asyncio.gather(*[probe(lecture.dllink) for _, lecture in tasks])
+
+    async def downloadConcurrently(self, queue, tasks):
+        """Downloads queued lectures, 'jobs' at a time.
+            Every download runs on this thread, so the register is only ever modified here."""
+        bar = Progress(len(tasks))
+        tasks = iter(tasks)
+
+        async def worker():
+            for course, lecture in tasks:
+                if self.halt:
+                    break
+
+                filepath, etag = await self.downloadLecture(course, lecture, bar)
+                metrics.count('download.completed' if filepath else 'download.failed')
+                if filepath:
+                    self.register.setFilename(course, lecture, filepath, os.path.getsize(filepath), etag)
+                    queue.done(course, lecture)
+                    self.numDownloaded = self.numDownloaded + 1
+
+        # Workers share one iterator, so each lecture is only downloaded once
+        await asyncio.gather(*[worker() for _ in range(self.jobs)])
+        bar.close()
+
+    @metrics.timed('download.lecture')
+    async def downloadLecture(self, course, lecture, bar):
+        """Downloads a specific lecture from a given course, or links it to a stored copy of its video.
+            returns: (path of downloaded file or '' if download failed, server's ETag for file)"""
+        path, filename = LectureDownloader.directory(course, lecture)
+        filepath = path + '/' + filename
+        os.makedirs(path, exist_ok=True)
+
+        # Wait while another worker downloads the same video, see ContentStore.claim
+        key = mediaKey(lecture.dllink)
+        while key in self.pending:
+            await self.pending[key].wait()
+        self.pending[key] = asyncio.Event()
+        try:
+            stored = self.store.find(lecture)
+            if stored and stored['path'] != filepath and linkFile(stored['path'], filepath):
+                bar.message("Linked to '{}'.".format(stored['path']))
+                metrics.count('download.linked')
+                return (filepath, stored['etag'])
+
+            filepath, etag = await self.fetchLecture(lecture, filepath, bar)
+            if filepath:
+                self.store.add(lecture, filepath, os.path.getsize(filepath), etag)
+            return (filepath, etag)
+        finally:
+            self.pending.pop(key).set()
+
+    async def fetchLecture(self, lecture, filepath, bar):
+        """Downloads a lecture to 'filepath', see downloadLecture.
+            returns: ('filepath' or '' if download failed, server's ETag for file)"""
+        bar.message("Downloading... {}".format(lecture))
+        bar.begin()
+
+        # Data is downloaded to a '.part' file, which is only renamed once complete
+        partpath = partPath(filepath, lecture)
+        completed = False
+        meta = {}   # Response headers worth keeping, filled in by fetches
+        try:
+            completed = await self.fetch(lecture.dllink, partpath, bar, meta)
+        finally:
+            bar.end(completed)
+
+        if not completed:
+            return ('', None)
+
+        os.replace(partpath, filepath)
+        return (filepath, meta.get('etag'))
+
+    async def fetch(self, url, partpath, bar, meta):
+        """Downloads 'url' into 'partpath', resuming from wherever a previous attempt stopped.
+            Transient errors are retried with exponential backoff.
+            returns: True if download completed"""
+        output = bar.message
+
+        for attempt in range(RETRIES + 1):
+            if attempt:
+                delay = BACKOFF * 2 ** (attempt - 1)
+                metrics.count('download.retries')
+                output("Retrying in {} seconds...".format(delay))
+                await asyncio.sleep(delay)
+
+            if self.quit:
+                return False
+
+            try:
+                return await self.fetchRange(url, partpath, bar, meta)
+            except aiohttp.ClientResponseError as err:
+                output('Download Error at {0}: {1}'.format(datetime.now().time(), err))
+                if err.status < 500:
+                    # Client errors e.g. expired link, won't go away by retrying
+                    return False
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                # Disconnected during download
+                output('Download Error at {0}: {1!r}'.format(datetime.now().time(), err))
+
+        output("Download failed after {} attempts, skipping.".format(RETRIES + 1))
+        return False
+
+    async def fetchRange(self, url, partpath, bar, meta):
+        """Makes a single attempt at downloading the rest of 'url' into 'partpath'.
+            returns: True if download completed, False if it was abandoned"""
+        offset = os.path.getsize(partpath) if os.path.exists(partpath) else 0
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+
+        requested = time.perf_counter()
+        async with self.sesh.get(url, headers=headers) as resp:
+            metrics.observe('download.ttfb', time.perf_counter() - requested)
+            if resp.status == 416:
+                # Range starts past the end of the file, check if '.part' is already complete
+                total = resp.headers.get('content-range', '').rpartition('/')[2]
+                if total.isdigit() and int(total) == offset:
+                    return True
+
+                # '.part' doesn't match file on server, start again from scratch
+                os.remove(partpath)
+                raise aiohttp.ClientPayloadError("Partial download doesn't match server, restarting.")
+
+            resp.raise_for_status()
+            meta['etag'] = resp.headers.get('ETag')
+
+            if resp.status != 206:
+                # Server ignored range, full file is being sent
+                offset = 0
+
+            remaining = int(resp.headers.get('content-length', 0))
+
+            if offset:
+                bar.message("Resuming from {}.".format(humanize(offset)))
+            bar.expect(remaining)
+
+            # Writes go to the page cache and are quick, so aren't worth a thread each
+            copied = 0
+            with open(partpath, 'ab' if offset else 'wb') as fd:
+                write = metrics.wrap('download.write', fd.write)
+                try:
+                    async for chunk in resp.content.iter_chunked(self.chunkSize):
+                        if self.quit:
+                            # Force quitting, abandon download
+                            return False
+                        write(chunk)
+                        copied = copied + len(chunk)
+                        bar.advance(len(chunk))
+                        if self.bucket:
+                            await asyncio.sleep(self.bucket.reserve(len(chunk)))
+                finally:
+                    metrics.count('download.bytes', copied)
+
+        if remaining and os.path.getsize(partpath) != offset + remaining:
+            raise aiohttp.ClientPayloadError("Connection closed before download finished.")
+
+        return True
+
+    def interrupt_handler(self):
+        """Stops starting downloads on the first ^C, abandons those in progress on the second."""
+        if not self.halt:
+            self.halt = True
+            print("\nHalting. Program will terminate after current downloads finish.")
+            print("Press ^C again to abandon them, they'll resume next time.")
+        else:
+            self.quit = True
+            print("\nQuitting...")
@@ -0,0 +1,233 @@
+"""Scrapes and downloads many registers at once, each in its own process, from a JSON manifest.
+    Options:
+        -j N: Runs N registers in parallel [j]obs, default 2
+        -s N: Caps concurrent network [s]treams across all registers at N, default no cap
+        -l: Forces a fresh [l]ogin for every register instead of resuming their sessions
+    Manifest:
+        [{"register": "alice.json", "email": "...", "username": "...", "password_env": "ALICE_PASSWORD",
+          "scrape": {"j": 4}, "download": {"j": 2, "p": "newest"}}, ...]
+        Only "register" is required. Options are those of scrape and download, or false to skip
+        one. Each register keeps its own session in '<register>.session' unless "session" is given,
+        and its output goes to '<register>.log'. Lectures are downloaded beside the register
+        unless "directory" is given, registers sharing a directory shouldn't share courses."""
+
+import json             # Manifest format
+import os               # Resolves paths and redirects output
+import signal           # Lets running registers finish on ^C
+import sys              # Flushes output before redirecting it
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .storage import openStorage
+
+# Number of registers run at once
+JOBS = 2
+
+# Each register's session and output are kept beside it
+SESSION_SUFFIX = '.session'
+LOG_SUFFIX = '.log'
+
+# Options which prompt, or which would bypass the stream cap, can't be used in a batch
+UNSUPPORTED = {"a", "c"}
+
+# Semaphore capping network streams, shared by every worker process, see initWorker
+STREAMS = None
+
+def start(arguments, options):
+    """Runs every register in a manifest."""
+    jobs = options.get('j', JOBS)
+    streams = options.get('s', 0)
+    if jobs < 1 or streams < 0:
+        print("Options '-j' and '-s' must be positive numbers.")
+        return
+
+    try:
+        entries = loadManifest(arguments[0])
+    except (OSError, ValueError) as err:
+        print("Couldn't read manifest '{0}': {1}".format(arguments[0], err))
+        return
+
+    BatchRunner(entries, jobs, streams).run('l' in options)
+
+def loadManifest(filename):
+    """Reads and checks a manifest, resolving paths relative to the manifest.
+        returns: list of entries, with options converted like the command line's
+        raises: ValueError if an entry is invalid"""
+    from .echoscraper import COMMANDS     # Imported here, as echoscraper imports this module
+
+    with open(filename) as manifest:
+        entries = json.load(manifest)
+    if not isinstance(entries, list):
+        raise ValueError("manifest must be a list of registers")
+
+    base = os.path.dirname(os.path.abspath(filename))
+    for indx, entry in enumerate(entries):
+        if not isinstance(entry, dict) or not isinstance(entry.get('register'), str):
+            raise ValueError("entry {} has no \"register\"".format(indx))
+
+        entry['register'] = os.path.join(base, os.path.expanduser(entry['register']))
+        entry['session'] = os.path.join(base, os.path.expanduser(
+            entry.get('session') or entry['register'] + SESSION_SUFFIX))
+        entry['directory'] = os.path.join(base, os.path.expanduser(
+            entry.get('directory') or os.path.dirname(entry['register'])))
+
+        if entry.get('password_env'):
+            entry['password'] = os.environ.get(entry['password_env'])
+            if not entry['password']:
+                raise ValueError("entry {0} needs ${1} to be set".format(indx, entry['password_env']))
+
+        for command in ('scrape', 'download'):
+            options = entry.get(command, {})
+            if options is False or options is None:
+                entry[command] = None
+                continue
+            if not isinstance(options, dict):
+                raise ValueError("entry {0} \"{1}\" must be options or false".format(indx, command))
+
+            valops = COMMANDS[command].get("valops", {})
+            for letter, value in options.items():
+                if letter not in COMMANDS[command]["ops"] or letter in UNSUPPORTED:
+                    raise ValueError("entry {0} {1} option '-{2}' can't be used".format(indx, command, letter))
+                options[letter] = valops[letter](value) if letter in valops else bool(value)
+
+            if options.get('p') == 'chosen':
+                raise ValueError("entry {} download policy 'chosen' needs a prompt".format(indx))
+            entry[command] = {letter: value for letter, value in options.items() if value is not False}
+
+    return entries
+
+def initWorker(streams):
+    """Runs in each worker process as it starts."""
+    global STREAMS
+    STREAMS = streams
+    # ^C is left to downloads, which finish the lecture in progress and stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def runEntry(entry, fresh):
+    """Scrapes then downloads one register, in a worker process.
+        Output is written to the register's log, as many registers run at once.
+        returns: dict of 'register', 'before' and 'after' tallies, and 'error' or None"""
+    # Imported in the worker, so the batch itself doesn't load requests and lxml
+    from . import scraper
+    from . import download
+
+    regname = entry['register']
+    result = {'register': regname, 'before': None, 'after': None, 'error': None}
+    client = {
+        'sessionfile': entry['session'],
+        'credentials': {key: entry.get(key) for key in ('email', 'username', 'password')},
+        'streams': STREAMS,
+        # Workers can't prompt, getpass would wait on the terminal and hang the batch
+        'interactive': False,
+    }
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = (os.dup(1), os.dup(2))
+    with open(regname + LOG_SUFFIX, 'a') as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            result['before'] = tally(regname)
+            try:
+                # Lectures are downloaded relative to the working directory
+                os.makedirs(entry['directory'], exist_ok=True)
+                os.chdir(entry['directory'])
+
+                if entry['scrape'] is not None:
+                    options = dict(entry['scrape'], **({'l': True} if fresh else {}))
+                    if not scraper.start([regname], options, **client):
+                        result['error'] = "scrape failed"
+
+                if entry['download'] is not None and not result['error']:
+                    # Session saved by scrape is resumed, without logging in again
+                    options = dict(entry['download'], y=True)
+                    if fresh and entry['scrape'] is None:
+                        options['l'] = True
+                    if not download.start([regname], options, **client):
+                        result['error'] = "download didn't finish"
+            except EOFError:
+                # Prompted for something the manifest didn't give
+                result['error'] = "login needs credentials"
+            except Exception as err:
+                result['error'] = "{0}: {1}".format(type(err).__name__, err)
+            result['after'] = tally(regname)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
+
+    return result
+
+def tally(regname):
+    """returns: (total, missing) lectures of a register, or None if it doesn't exist"""
+    # Storage is used directly, as a streaming Register reports missing files
+    storage = openStorage(regname)
+    return storage.tally() if storage.exists() else None
+
+class BatchRunner(object):
+    def __init__(self, entries, jobs=JOBS, streams=0):
+        self.entries = entries
+        self.jobs = jobs
+        self.streams = streams  # Network streams allowed at once across all registers, 0 for any
+
+    def run(self, fresh=False):
+        semaphore = multiprocessing.BoundedSemaphore(self.streams) if self.streams else None
+        results = []
+
+        print("Running {0} registers, {1} at a time{2}.".format(
+            len(self.entries), self.jobs,
+            ", with at most {} network streams".format(self.streams) if self.streams else ''))
+
+        pool = ProcessPoolExecutor(max_workers=self.jobs, initializer=initWorker, initargs=(semaphore,))
+        futures = {pool.submit(runEntry, entry, fresh): entry for entry in self.entries}
+        try:
+            for future in as_completed(futures):
+                results.append(self.finished(futures[future], future))
+        except KeyboardInterrupt:
+            print("\nStopping once running registers finish...")
+            pool.shutdown(wait=True, cancel_futures=True)
+            results = [self.finished(futures[future], future) for future in futures
+                       if future.done() and not future.cancelled()]
+        finally:
+            pool.shutdown(wait=True)
+
+        self.summary(results)
+
+    def finished(self, entry, future):
+        """returns: result of a completed register, printing how it went"""
+        try:
+            result = future.result()
+        except Exception as err:
+            # Worker process died
+            result = {'register': entry['register'], 'before': None, 'after': None,
+                      'error': "{0}: {1}".format(type(err).__name__, err)}
+
+        if result['error']:
+            print("'{0}' failed: {1}, see '{2}'.".format(
+                result['register'], result['error'], result['register'] + LOG_SUFFIX))
+        else:
+            print("'{0}' finished.".format(result['register']))
+        return result
+
+    def summary(self, results):
+        """Prints a table of every register's lectures, combining their tallies."""
+        if not results:
+            return
+
+        print("\n    {0:<40} {1:>8} {2:>8} {3:>10}  {4}".format("Register", "Lectures", "Missing", "Downloaded", "Status"))
+        totals = [0, 0, 0]
+        for result in sorted(results, key=lambda result: result['register']):
+            total, missing = result['after'] or (0, 0)
+            # Lectures found by this run's scrape count as missing beforehand
+            before = result['before'][1] + (total - result['before'][0]) if result['before'] else total
+            downloaded = max(0, before - missing)
+
+            totals = [totals[0] + total, totals[1] + missing, totals[2] + downloaded]
+            print("    {0:<40} {1:>8} {2:>8} {3:>10}  {4}".format(
+                os.path.relpath(result['register']), total, missing, downloaded, result['error'] or "ok"))
+
+        print("    {0:<40} {1:>8} {2:>8} {3:>10}".format("Total", *totals))
@@ -0,0 +1,114 @@
+"""Caches responses on disk, so unchanged pages are skipped when re-scraping."""
+
+import hashlib      # Detects unchanged responses when server ignores conditional requests
+import json         # Cache file format
+import threading    # Cache is shared by parallel syllabus fetches
+
+from . import metrics
+from .progress import humanize
+from .storage import writeAtomic
+
+class ResponseCache(object):
+    """Stores validators ('ETag', 'Last-Modified'), content hash and body of the last
+        response for each URL. Requests are made conditional on these validators, so the
+        server can reply '304 Not Modified' instead of sending the page again.
+
+        usage:
+            cache = ResponseCache("register.json.cache")
+            text, changed = cache.get(sesh, url)
+            if changed:
+                try:
+                    parse(text)
+                except ValueError:
+                    cache.forget(url)   # Don't skip this page next time
+            cache.save()"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+
+        # Counters for this run
+        self.hits = 0           # Server replied '304 Not Modified'
+        self.unchanged = 0      # Server sent page again, but it hadn't changed
+        self.misses = 0         # Page is new or has changed
+        self.saved = 0          # Bytes not sent thanks to '304 Not Modified'
+
+        try:
+            with open(filename, encoding='utf-8') as cachefile:
+                self.entries = json.load(cachefile)
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+
+    def get(self, sesh, url):
+        """Requests 'url' using session 'sesh', unless it hasn't changed since last time.
+            returns: (text, changed) where text is the page, from cache if unchanged"""
+        with metrics.span('scrape.fetch'):
+            response = sesh.get(url, headers=self.conditional(url))
+        return self.update(url, response.status_code, response.headers, response.content, response.text)
+
+    # NOTE: 'get' is split into 'conditional' and 'update' so clients other than
+    #       requests, e.g. asyncclient, can share the cache.
+
+    def conditional(self, url):
+        """returns: headers making a request for 'url' conditional on it having changed"""
+        with self.lock:
+            entry = self.entries.get(url)
+
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('modified'):
+            headers['If-Modified-Since'] = entry['modified']
+        return headers
+
+    def update(self, url, status, headers, content, text):
+        """Records response to a request made with 'conditional' headers.
+            returns: (text, changed) where text is the page, from cache if unchanged"""
+        with self.lock:
+            entry = self.entries.get(url)
+
+        if status == 304 and entry:
+            with self.lock:
+                self.hits = self.hits + 1
+                self.saved = self.saved + len(entry['body'])
+            return entry['body'], False
+
+        digest = hashlib.sha1(content).hexdigest()
+        changed = not entry or entry['hash'] != digest
+
+        with self.lock:
+            if changed:
+                self.misses = self.misses + 1
+            else:
+                self.unchanged = self.unchanged + 1
+
+            # Only cache successful responses
+            if status == 200:
+                self.entries[url] = {
+                    'etag': headers.get('ETag'),
+                    'modified': headers.get('Last-Modified'),
+                    'hash': digest,
+                    'body': text,
+                }
+
+        return text, changed
+
+    def forget(self, url):
+        """Removes a URL from the cache, e.g. after its page failed to parse."""
+        with self.lock:
+            self.entries.pop(url, None)
+
+    def clear(self):
+        """Removes all URLs from the cache."""
+        with self.lock:
+            self.entries = {}
+
+    def save(self):
+        """Writes cache to file, which only the current user can read, as pages are from a logged in session."""
+        with self.lock:
+            writeAtomic(self.filename, lambda cachefile: json.dump(self.entries, cachefile), 0o600)
+
+    def summary(self):
+        """Returns counters as a string."""
+        return "{0} not modified, {1} unchanged, {2} changed, {3} saved".format(
+            self.hits, self.unchanged, self.misses, humanize(self.saved))
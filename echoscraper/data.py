@@ -1,14 +1,89 @@
 """Defines lecture data structures."""
 
+import gc
 import json
 
+try:
+    # Faster JSON backend, used when installed
+    import orjson
+except ImportError:
+    orjson = None
 
+def fromJSON(text):
+    """Decodes JSON string into plain Python data, using the fastest available backend."""
+    return orjson.loads(text) if orjson else json.loads(text)
+
+def toJSON(data):
+    """Encodes plain Python data into a JSON string, using the fastest available backend."""
+    return orjson.dumps(data).decode() if orjson else json.dumps(data)
+
+def loads(text):
+    """Decodes a JSON register into a list of Course objects.
+        Objects are built in one pass over the decoded data, rather than
+        through a per-dictionary 'object_hook'."""
+    data = fromJSON(text)
+    if not isinstance(data, list):
+        data = [data]
+
+    # Building lots of objects triggers many pointless garbage collections,
+    # the decoded data can't contain reference cycles.
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return [Course.fromDict(dct) for dct in data]
+    finally:
+        if enabled:
+            gc.enable()
+
+def iterloads(regfile, chunkSize=2**16):
+    """Decodes a JSON register one course at a time, reading 'regfile' in chunks.
+        Only one course is held in memory at a time, however large the register is.
+        returns: iterator of Course objects"""
+    decoder = json.JSONDecoder()
+    buf = regfile.read(chunkSize)
+    pos = len(buf) - len(buf.lstrip())
+
+    if not buf[pos:pos + 1] == '[':
+        # Not a list, e.g. register with a single course
+        if buf.strip():
+            yield from loads(buf + regfile.read())
+        return
+
+    pos = pos + 1
+    while True:
+        # Skip whitespace and separators up to the next course
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos = pos + 1
+
+        if pos < len(buf) and buf[pos] == ']':
+            return
+
+        try:
+            dct, pos = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            # Course is split across chunks, read more, growing reads for very large courses
+            more = regfile.read(max(chunkSize, len(buf) - pos))
+            if not more:
+                raise
+            buf = buf[pos:] + more
+            pos = 0
+            continue
+
+        yield Course.fromDict(dct)
+
+def dumps(courses):
+    """Encodes a list of Course objects into a JSON string."""
+    return toJSON([course.toDict() for course in courses])
+
+# NOTE: 'decode' and 'Encoder' are the original per-object codec, kept for
+#       code that uses them with the json module directly.
 
 def decode(dct):
     """Decodes an arbitrary JSON dictionary into a class."""
     def dec_lecture(dct):
         """Returns Lecture object from deserialized dictionary data."""
-        return Lecture(dct['name'], dct['date'], dct['time'], dct['dllink'], dct['filename'])
+        return Lecture(dct['name'], dct['date'], dct['time'], dct['dllink'], dct['filename'],
+                       dct.get('size'), dct.get('etag'), dct.get('variants'))
     
     def dec_course(dct):
         """Returns Course oect from deserialized dictionary data."""
@@ -29,6 +104,9 @@ class Encoder(json.JSONEncoder):
                 "time": o.time,
                 "dllink": o.dllink,
                 "filename": o.filename,
+                "size": o.size,
+                "etag": o.etag,
+                "variants": o.variants,
             }
         elif isinstance(o, Course):
             return {
@@ -45,13 +123,39 @@ class Encoder(json.JSONEncoder):
 class Lecture(object):
     """Defines 'Lecture' data class."""
 
-    def __init__(self, name, date, time, dllink, filename=''):
+    __slots__ = ('name', 'date', 'time', 'dllink', 'filename', 'size', 'etag', 'variants')
+
+    def __init__(self, name, date, time, dllink, filename='', size=None, etag=None, variants=None):
         self.name = name
         self.date = date
         self.time = time
         self.dllink = dllink
         self.filename = filename
+        self.size = size    # Bytes in downloaded file, as sent by server
+        self.etag = etag    # Server's ETag for downloaded file
+        # Every quality of the recording, as dicts of 'url', 'size', 'width', 'height' and
+        # 'bitrate' in bits per second, or None if only 'dllink' is known, see scheduler.chooseVariant
+        self.variants = variants
+
+
+    @classmethod
+    def fromDict(cls, dct):
+        """Returns Lecture object from deserialized dictionary data."""
+        return cls(dct['name'], dct['date'], dct['time'], dct['dllink'], dct['filename'],
+                   dct.get('size'), dct.get('etag'), dct.get('variants'))
 
+    def toDict(self):
+        """Returns dictionary data for serializing."""
+        return {
+            "name": self.name,
+            "date": self.date,
+            "time": self.time,
+            "dllink": self.dllink,
+            "filename": self.filename,
+            "size": self.size,
+            "etag": self.etag,
+            "variants": self.variants,
+        }
 
     def __repr__(self):
         return "<{0} object at {1}>".format(
@@ -67,6 +171,11 @@ class Lecture(object):
             "Found" if self.filename else "Missing"
         )
     
+    @property
+    def key(self):
+        """Identity of lecture, two lectures with the same key are the same lecture."""
+        return (self.name, self.date, self.time)
+
     def __eq__(self, other):
         if isinstance(other, type(self)):
             return self.name == other.name and \
@@ -74,19 +183,52 @@ class Lecture(object):
             self.time == other.time
         return False
 
+    def __hash__(self):
+        # Same as hash(self.key), without the property lookup, as it's called a lot
+        return hash((self.name, self.date, self.time))
+
 class Course(object):
     """Defines 'Course' data class."""
 
+    __slots__ = ('name', 'courselink', 'year', 'semester', 'lectures', '_index')
+
     def __init__(self, name="", courselink="", year="", semester=0, lectures=None):
         self.name = name
         self.courselink = courselink
         self.year = year
         self.semester = semester
         self.lectures = []
+        self._index = {}    # Lecture: position in lectures, lectures hash by key
 
         if lectures:
             for lect in lectures:
-                self.lectures.append(lect)
+                self.addLecture(lect)
+
+    @classmethod
+    def fromDict(cls, dct):
+        """Returns Course object, and its Lecture objects, from deserialized dictionary data."""
+        course = cls(dct['name'], dct['courselink'], dct['year'], dct['semester'])
+
+        # Same as calling 'addLecture' for each lecture, inlined as it's called a lot
+        lectures = course.lectures
+        index = course._index
+        for lect in dct['lectures']:
+            lect = Lecture(lect['name'], lect['date'], lect['time'], lect['dllink'], lect['filename'],
+                           lect.get('size'), lect.get('etag'), lect.get('variants'))
+            if index.setdefault(lect, len(lectures)) == len(lectures):
+                lectures.append(lect)
+
+        return course
+
+    def toDict(self):
+        """Returns dictionary data, including lectures, for serializing."""
+        return {
+            "name": self.name,
+            "courselink": self.courselink,
+            "year": self.year,
+            "semester": self.semester,
+            "lectures": [lect.toDict() for lect in self.lectures],
+        }
 
     def __repr__(self):
         return "<{0} object at {1}>".format(
@@ -102,10 +244,35 @@ class Course(object):
             len(self.lectures)
         )
 
+    @property
+    def key(self):
+        """Identity of course, two courses with the same key are the same course."""
+        return (self.name, self.year, self.semester, self.courselink)
+
     def __eq__(self, other):
         if isinstance(other, type(self)):
-            return self.name == other.name and \
-            self.year == other.year and \
-            self.semester == other.semester and \
-            self.courselink == other.courselink
+            return self.key == other.key
         return False
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __contains__(self, lecture):
+        return lecture in self._index
+
+    # NOTE: Lectures must be added using 'addLecture', rather than appending to
+    #       'lectures' directly, so they can be found by key.
+
+    def addLecture(self, lecture):
+        """Adds lecture if it doesn't already exist, else does nothing.
+            returns: True if lecture was added"""
+        # Index is keyed by the lecture itself, so no extra key tuples are kept in memory
+        if self._index.setdefault(lecture, len(self.lectures)) != len(self.lectures):
+            return False
+
+        self.lectures.append(lecture)
+        return True
+
+    def findLecture(self, key):
+        """Returns position of the lecture with a given key, or -1 if it doesn't exist."""
+        return self._index.get(Lecture(*key, None), -1)
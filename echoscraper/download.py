@@ -1,147 +1,775 @@
 """Uses register file to download missing recordings.
     Options:
         -y: Automatically selects [y]es to begin downloading without prompt after login
-        -c: Allows user to [c]hoose what courses to download"""
-
+        -c: Allows user to [c]hoose what courses to download
+        -j N: Runs N downloads in parallel [j]obs, default 1
+        -s N: Downloads large lectures in N [s]egments over parallel connections
+        -t MB: Size [t]hreshold above which lectures are segmented, default 64
+        -b MB: Size of read/write [b]uffer, default 1
+        -l: Forces a fresh [l]ogin instead of resuming the previous session
+        -r MB: Limits combined download [r]ate to MB per second
+        -o N: Opens at most N connections to each h[o]st
+        -p POLICY: [p]rioritises lectures by one of
+            register: in register order, the default
+            newest: most recent lectures first
+            smallest: smallest files first
+            chosen: asks for courses like -c, which are downloaded first
+        -n: Plans a [n]ew queue, instead of resuming an interrupted run's
+        -q QUALITY: Chooses the [q]uality of lectures encoded in several, one of
+            largest: the biggest file, the default
+            smallest: the smallest file
+            720p, 800k: closest to a height in pixels, or a bitrate in kbit/s
+        --plan[=MB]: Checks the size of every lecture to download, then prints the total, how
+            long it should take at '-r' or MB per second, and if it fits on disk, without downloading
+        -a: Runs on a single [a]synchronous event loop, with up to N connections from -j,
+            lectures aren't segmented"""
+
+import json     # Records progress of segmented downloads
 import re       # Parses lots of strings
+import shutil   # Checks free disk space
 import signal   # Captures SIGINT
 import sys      # Exits program after capturing SIGINT twice
 import os       # Creates directory to store downloaded lectures
+import time     # Waits between download retries
 
+import requests.adapters            # Sizes connection pool for parallel downloads
 import requests.exceptions as rEx   # Import request exceptions to catch disconnects
-from clint.textui import progress   # Used for dynamic progress bars
+import urllib3.exceptions as uEx    # Raw stream raises urllib3's exceptions instead
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from contextlib import nullcontext  # Stands in for a stream limit when there isn't one
 from datetime import datetime       # Logs time of downloader crash
 
+from . import metrics                   # Times downloads for '--metrics'
 from.echo360login import Echo360login   # Logs into echo360
+from .echo360login import SESSION_FILE
+from .data import Lecture               # Copies lectures before choosing their variant
 from .register import Register          # R/Ws to Register file
+from .progress import Progress          # Time throttled progress bar
+from .progress import humanize
+from .scheduler import POLICIES, QUEUE_SUFFIX
+from .scheduler import DownloadQueue, TokenBucket, order, isVariantPolicy, chooseVariant
+from .store import ContentStore, linkFile   # Links cross-listed lectures instead of downloading them
+from .store import LECTURES_DIR
+
+# Downloads
+PART_SUFFIX = '.part'   # Appended to files while they're being downloaded
+RETRIES = 5             # Number of retries after a download error...
+BACKOFF = 2             # ...waiting this many seconds before the first, doubling each time
+TIMEOUT = 60            # Seconds to wait on a stalled connection before retrying
+SEGMENTS_SUFFIX = '.segments'       # Records completed segments of a '.part' file
+SEGMENT_THRESHOLD = 64 * 2**20      # Only lectures larger than this are segmented
+CHUNK_SIZE = 2**20      # Bytes read and written at a time
+READINTO = True         # Read unencoded downloads straight into a reusable buffer
+PLAN_JOBS = 16          # Lectures probed at once by '--plan'
+
+def start(arguments, options, **client):
+    """Begins downloader.
+        client: 'sessionfile', 'credentials', 'streams' and 'interactive' for LectureDownloader, see batch
+        returns: True if every queued lecture was tried"""
+    jobs = options.get('j', 1)
+    segments = options.get('s', 1)
+    threshold = options.get('t', SEGMENT_THRESHOLD / 2**20) * 2**20
+    chunkSize = int(options.get('b', CHUNK_SIZE / 2**20) * 2**20)
+    rate = options.get('r', 0) * 2**20
+    hostConnections = options.get('o', 0)
+
+    if jobs < 1 or segments < 1 or chunkSize < 1 or rate < 0 or hostConnections < 0:
+        print("Options '-j', '-s', '-b', '-r' and '-o' must be positive numbers.")
+        return
+
+    if options.get('p', 'register') not in POLICIES:
+        print("Option '-p' must be one of: {}.".format(', '.join(POLICIES)))
+        return
+
+    if not isVariantPolicy(options.get('q', 'largest')):
+        print("Option '-q' must be 'largest', 'smallest', a height e.g. '720p' or a bitrate e.g. '800k'.")
+        return
+
+    if options.get('plan', 1) <= 0:
+        print("Option '--plan' must be a positive speed.")
+        return
+
+    bucket = TokenBucket(rate) if rate else None
+
+    if 'a' in options:
+        # Only imported when wanted, as it needs aiohttp
+        import asyncio
+        from . import asyncclient
+        if asyncclient.available():
+            downloader = asyncclient.AsyncLectureDownloader(
+                arguments[0], jobs, chunkSize, bucket, hostConnections)
+            asyncio.run(downloader.run(options))
+        return
+
+    downloader = LectureDownloader(arguments[0], segments, threshold, chunkSize, bucket, hostConnections, **client)
+    return downloader.run(options, jobs)
+
+# NOTE: Planning downloads doesn't touch the network, so these are shared with asyncclient.
+
+def listCoursesToDownload(register, options):
+    """Asks user to choose courses if '-c' or '-p chosen' were given.
+        returns: (positions of courses to download or None for all of them,
+                  keys of chosen courses for '-p chosen')"""
+    if 'c' not in options and options.get('p') != 'chosen':
+        return (None, [])
+
+    # Ask user to choose what courses to download
+    courseNums = chooseCoursesToDownload(register)
+    keys = {indx: course.key for indx, course in enumerate(register.iterCourses(onlyMissing=True))}
+    chosen = [keys[num] for num in courseNums]
+
+    return (courseNums if 'c' in options else None, chosen)
+
+def chooseCoursesToDownload(register):
+    """Lets user choose what courses to download."""
+    register.docket()
+    names = [course.name for course in register.iterCourses(onlyMissing=True)]
+    print("\nWhat numbered courses would you like to download?")
+    courseNums = []
+
+    while(True):
+        num = input()
+        try:
+            num = int(num)
+        except ValueError:
+            break
+
+        if num >= 0 and num < len(names):
+            if num not in courseNums:
+                courseNums.append(num)
+            else:
+                print("'{}' will already be downloaded.".format(names[num]))
+        else:
+            break
+
+    return courseNums
+
+def lecturesToDownload(register, coursesToDownload):
+    """Streams through register for lectures which haven't been downloaded.
+        coursesToDownload: positions of courses to include, or None for all of them
+        returns: iterator of (course, lecture)"""
+    for indx, course in enumerate(register.iterCourses(onlyMissing=True)):
+        if coursesToDownload is None or indx in coursesToDownload:
+            for lecture in course.lectures:
+                if lecture.dllink:
+                    yield (course, lecture)
+
+def loadQueue(register, options):
+    """Loads the queue left by an interrupted run, unless '-n' was given.
+        returns: (DownloadQueue, list of (course, lecture) left to download, or None if
+                  a new queue needs to be planned, see planQueue)"""
+    queue = DownloadQueue(register.filename + QUEUE_SUFFIX)
+    if 'n' in options:
+        queue.remove()
+
+    if not queue.exists():
+        return (queue, None)
+
+    tasks = queue.load()
+    print("Resuming {0} queued lectures from previous run ('-n' plans a new queue).".format(len(tasks)))
+    return (queue, tasks)
+
+def planQueue(register, options):
+    """Lists lectures to download, before they're ordered by the '-p' policy.
+        returns: (list of (course, lecture) in register order, keys of chosen courses)"""
+    coursesToDownload, chosen = listCoursesToDownload(register, options)
+    tasks = chooseVariants(list(lecturesToDownload(register, coursesToDownload)), options.get('q'))
+
+    if options.get('p') == 'smallest' or 'plan' in options:
+        print("Checking size of {} lectures...".format(len(tasks)))
+    return (tasks, chosen)
+
+def chooseVariants(tasks, policy):
+    """Points each lecture's download link at the variant chosen by '-q', if it has variants.
+        The chosen link is saved in the queue, but not in the register: lectures are copied
+        before they're changed, as they may be the register's own, see Register.setFilename.
+        returns: list of (course, lecture)"""
+    if not policy:
+        return tasks
+
+    chosen = []
+    for course, lecture in tasks:
+        variant = chooseVariant(lecture.variants, policy)
+        if variant and variant['url'] != lecture.dllink:
+            lecture = Lecture.fromDict(lecture.toDict())
+            lecture.dllink = variant['url']
+        chosen.append((course, lecture))
+    return chosen
+
+def partPath(filepath, lecture):
+    """returns: path of the '.part' file a lecture is downloaded to, before it's renamed to 'filepath'.
+        Variants chosen with '-q' have their own, so a download is never resumed from another variant."""
+    largest = chooseVariant(lecture.variants, 'largest')
+    if largest is None or largest['url'] == lecture.dllink:
+        return filepath + PART_SUFFIX
+
+    indx = next((indx for indx, variant in enumerate(lecture.variants) if variant.get('url') == lecture.dllink), None)
+    return "{0}.variant{1}{2}".format(filepath, indx, PART_SUFFIX)
+
+def partial(partpath):
+    """returns: (bytes already downloaded, bytes already on disk) of an interrupted download"""
+    try:
+        ondisk = os.path.getsize(partpath)
+    except OSError:
+        return (0, 0)
+
+    # Segmented downloads are preallocated, only their completed segments are downloaded
+    try:
+        with open(partpath + SEGMENTS_SUFFIX) as statefile:
+            state = json.load(statefile)
+    except FileNotFoundError:
+        return (ondisk, ondisk)
+    except ValueError:
+        return (0, ondisk)
+    done = sum(end - start + 1 for indx, (start, end) in enumerate(state['ranges']) if indx in state['done'])
+    return (done, ondisk)
+
+def preflight(tasks, sizes, options):
+    """Prints how much downloading 'tasks' will fetch, how long it should take, and if it fits on disk.
+        sizes: file size of each task from probing it, or None if unknown
+        returns: True if there's enough free disk space"""
+    store = ContentStore()
+    fetch = disk = resumed = 0
+    linked = unknown = 0
+
+    for (course, lecture), size in zip(tasks, sizes):
+        path, filename = LectureDownloader.directory(course, lecture)
+        filepath = path + '/' + filename
 
-def start(arguments, options):
-    """Begins downloader"""
-    LectureDownloader(arguments[0]).run(options)
+        stored = store.find(lecture)
+        if stored and stored['path'] != filepath:
+            linked = linked + 1
+            continue
+
+        if size is None:
+            # Server didn't say, fall back to the size listed in the syllabus
+            variant = next((variant for variant in lecture.variants or () if variant.get('url') == lecture.dllink), {})
+            size = variant.get('size')
+            if size is None:
+                unknown = unknown + 1
+                continue
+
+        done, ondisk = partial(partPath(filepath, lecture))
+        fetch = fetch + max(0, size - done)
+        disk = disk + max(0, size - ondisk)
+        resumed = resumed + min(done, size)
+
+    free = shutil.disk_usage(LECTURES_DIR if os.path.isdir(LECTURES_DIR) else '.').free
+    speed = options['plan'] * 2**20 if options.get('plan') is not True else options.get('r', 0) * 2**20
+
+    print("Plan for {} lectures:".format(len(tasks)))
+    print("    Download  {0}{1}".format(humanize(fetch), ", and {} of unknown size".format(unknown) if unknown else ''))
+    if resumed:
+        print("    Resumed   {} already downloaded by interrupted runs".format(humanize(resumed)))
+    if linked:
+        print("    Linked    {} lectures already stored, which aren't downloaded again".format(linked))
+    if speed:
+        minutes = int(fetch / speed) // 60
+        print("    Time      {0} at {1}/s".format(
+            "about {0}h {1:02d}m".format(minutes // 60, minutes % 60) if minutes else "under a minute", humanize(speed)))
+    else:
+        print("    Time      unknown, give a speed with '--plan=MB' or '-r MB'")
+    print("    Disk      {0} needed, {1} free".format(humanize(disk), humanize(free)))
+
+    if disk > free:
+        print("Not enough free disk space, {} more is needed.".format(humanize(disk - free)))
+        return False
+    return True
+
+def confirm(options):
+    """Asks before downloading, unless '-y' was given.
+        returns: True if downloads should begin"""
+    if 'y' in options:
+        return True
+
+    begin = input('Begin downloading? (y/n): ')
+    return begin.lower() == 'y'
 
 class LectureDownloader(Echo360login):
-    def __init__(self, regname):
-        super().__init__()
+    def __init__(self, regname, segments=1, threshold=SEGMENT_THRESHOLD, chunkSize=CHUNK_SIZE,
+                 bucket=None, hostConnections=0, sessionfile=SESSION_FILE, credentials=None, streams=None,
+                 interactive=True):
+        super().__init__(sessionfile, credentials, interactive)
         self.regname = regname
+        self.segments = segments    # Connections used for each large lecture
+        self.threshold = threshold  # Size in bytes above which lectures are segmented
+        self.chunkSize = chunkSize  # Bytes read and written at a time
+        self.bucket = bucket        # TokenBucket limiting combined rate of all downloads
+        self.hostConnections = hostConnections  # Connections allowed to each host, 0 for any
+        # Semaphore shared with other processes, held by each open download stream
+        self.streams = streams if streams is not None else nullcontext()
+        # Register is streamed rather than loaded.
+        # Every storage engine saves a change without rewriting the register,
+        # so each completed download is flushed straight away.
+        self.register = Register(regname, flushEvery=1, load=False)
+        self.store = ContentStore()     # Videos already downloaded, by any register or course
         self.numDownloaded = 0
-        self.__HALT = False
+        self.__HALT = False     # Stop starting new downloads
+        self.__QUIT = False     # Abandon downloads in progress
         signal.signal(signal.SIGINT, self.interrupt_handler)
 
-    def run(self, options):
-        coursesToDownload = self.listCoursesToDownload(options)
-        
+    def run(self, options, jobs=1):
+        """returns: True if every queued lecture was tried, or with '--plan' if they fit on disk"""
+        if not self.register.exists:
+            return False
+
         # Login to echo360
-        if not self.login():
-            return
+        if not self.login('l' in options):
+            return False
+
+        # Share one connection pool between all workers and segments
+        connections = jobs * self.segments
+        if self.hostConnections:
+            # Pools are per host, blocking makes threads wait for a free connection
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=connections, pool_maxsize=self.hostConnections, pool_block=True)
+        else:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=connections, pool_maxsize=connections)
+        self.sesh.mount('https://', adapter)
+        self.sesh.mount('http://', adapter)
+
+        queue, tasks = loadQueue(self.register, options)
+        if 'plan' in options:
+            # Only checks what would be downloaded, nothing is queued
+            if tasks is None:
+                tasks, _ = planQueue(self.register, options)
+            return preflight(tasks, self.probeSizes(tasks, PLAN_JOBS), options)
+
+        planned = tasks is None
+        if planned:
+            tasks, chosen = planQueue(self.register, options)
+            sizes = self.probeSizes(tasks, jobs) if options.get('p') == 'smallest' else None
+            tasks = order(tasks, options.get('p', 'register'), sizes, chosen)
+
+        # Ask before continuing
+        if not confirm(options):
+            return False
+
+        if planned:
+            # Only saved once confirmed, so a declined plan isn't resumed by the next run
+            queue.create(tasks)
+
+        # Lectures downloaded before the store existed can be linked too
+        self.store.addDownloaded(self.register)
 
-        if 'y' not in options:
-            # Ask before continuing
-            begin = input('Begin downloading? (y/n): ')
-            begin = begin.lower()
+        # Else begin downloading
+        return self.downloadQueued(queue, tasks, jobs)
 
-            if begin != 'y':
-                return
+    def downloadQueued(self, queue, tasks, jobs=1):
+        """Downloads queued lectures, 'jobs' at a time, recording them in the register.
+            returns: True if every queued lecture was tried"""
+        self.numDownloaded = 0
 
-        # Else begin downloading
-        for indx, course in enumerate(Register(self.regname)):
-            if self.__HALT:
-                break
-            elif indx not in coursesToDownload:
-                continue
+        # Leaving the 'with' block flushes the register, even after a forced quit
+        try:
+            with self.register:
+                if jobs > 1:
+                    self.downloadConcurrently(queue, tasks, jobs)
+                else:
+                    self.downloadSequentially(queue, tasks)
+        finally:
+            self.store.save()
 
-            print("Downloading '{}'".format(course.name))
-            self.downloadCourseLectures(indx)
+        if not self.__HALT:
+            # Every lecture has been tried, failures are planned again next time
+            queue.remove()
     
         print("{0} lecture{1} downloaded.".format(
             self.numDownloaded, 's' if self.numDownloaded != 1 else '')
         )
+        return not self.__HALT
 
-    def listCoursesToDownload(self, options):
-        if 'c' in options:
-            # Ask user to choose what courses to download
-            return self.chooseCoursesToDownload()
-
-        return list(range(len(Register(self.regname))))
-
-    def chooseCoursesToDownload(self):
-        """Lets user choose what courses to download."""
-        Register(self.regname).docket()
-        print("\nWhat numbered courses would you like to download?")
-        courseNums = []
-
-        while(True):
-            num = input()
-            try:
-                num = int(num)
-            except ValueError:
-                break
-
-            if num >= 0 and num < len(Register(self.regname)):
-                if num not in courseNums:
-                    courseNums.append(num)
-                else:
-                    print("'{}' will already be downloaded.".format(Register(self.regname)[num].name))
-            else:
-                break
-
-        return courseNums
-
-    def downloadCourseLectures(self, courseindx):
-        """Downloads all remaining lectures for a given course."""
-        for lectureIndx, lecture in enumerate(Register(self.regname)[courseindx].lectures):
+    def downloadSequentially(self, queue, tasks):
+        """Downloads queued lectures one at a time."""
+        current = None
+        for course, lecture in tasks:
             # If downloads haven't been halted
             if self.__HALT:
                 break
-            # If lecture hasn't been downloaded yet and has a download link.                
-            elif lecture.dllink and not lecture.filename:
-                print("Downloading... {}".format(lecture))
-                filepath = self.downloadLecture(courseindx, lectureIndx)
-
-                if filepath:
-                    # Download completed succesfully, write filepath to register                    
-                    with Register(self.regname) as reg:
-                        reg[courseindx].lectures[lectureIndx].filename = filepath
-                    
-                    # Add number of lectures downloaded to total for this session
-                    self.numDownloaded = self.numDownloaded + 1
-
-    def downloadLecture(self, cIndx, lIndx):
-        """Downloads a specific lecture from a given course."""
-        # Read course and lecture metadata from register
-        course = Register(self.regname)[cIndx]
-        lecture = course.lectures[lIndx]
 
+            if course is not current:
+                print("Downloading '{}'".format(course.name))
+                current = course
+
+            print("Downloading... {}".format(lecture))
+            self.record(queue, course, lecture, *self.downloadLecture(course, lecture))
+
+    def downloadConcurrently(self, queue, tasks, jobs):
+        """Downloads queued lectures, 'jobs' at a time.
+            Downloads run in worker threads, but the register is only ever modified
+            from this thread once a download completes."""
+        bar = Progress(len(tasks))
+        tasks = iter(tasks)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            while True:
+                # Keep all workers busy, unless downloads have been halted
+                while not self.__HALT and len(running) < jobs:
+                    task = next(tasks, None)
+                    if task is None:
+                        break
+                    running[pool.submit(self.downloadLecture, *task, bar)] = task
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    course, lecture = running.pop(future)
+                    self.record(queue, course, lecture, *future.result())
+
+        bar.close()
+
+    def record(self, queue, course, lecture, filepath, etag):
+        """Records a finished download in the register and queue, if it succeeded.
+            queue: DownloadQueue, or None if the download wasn't queued on disk"""
+        metrics.count('download.completed' if filepath else 'download.failed')
+        if filepath:
+            # Download completed succesfully, record filepath in register
+            self.register.setFilename(course, lecture, filepath, os.path.getsize(filepath), etag)
+            if queue is not None:
+                queue.done(course, lecture)
+
+            # Add number of lectures downloaded to total for this session
+            self.numDownloaded = self.numDownloaded + 1
+
+    @metrics.timed('download.lecture')
+    def downloadLecture(self, course, lecture, bar=None):
+        """Downloads a specific lecture from a given course, or links it to a stored copy of its video.
+            bar: shared Progress when downloading in parallel, otherwise a progress
+                 bar is drawn for this download alone
+            returns: (path of downloaded file or '' if download failed, server's ETag for file)"""
         # Create lecture path and filename
         path, filename = self.directory(course, lecture)
         filepath = path + '/' + filename
 
         # Create directory from path if it doesn't already exist
-        if not os.path.exists(path):
-            os.makedirs(path)
+        os.makedirs(path, exist_ok=True)
+
+        # Cross-listed lectures share one video, which is linked instead of downloaded again
+        stored = self.store.claim(lecture)
+        try:
+            if stored and stored['path'] != filepath and linkFile(stored['path'], filepath):
+                (bar.message if bar else print)("Linked to '{}'.".format(stored['path']))
+                metrics.count('download.linked')
+                return (filepath, stored['etag'])
+
+            filepath, etag = self.fetchLecture(lecture, filepath, bar)
+            if filepath:
+                self.store.add(lecture, filepath, os.path.getsize(filepath), etag)
+            return (filepath, etag)
+        finally:
+            self.store.release(lecture)
+
+    def fetchLecture(self, lecture, filepath, bar=None):
+        """Downloads a lecture to 'filepath', see downloadLecture.
+            returns: ('filepath' or '' if download failed, server's ETag for file)"""
+        local = bar is None
+        if local:
+            bar = Progress(1)
+        else:
+            bar.message("Downloading... {}".format(lecture))
+        bar.begin()
+
+        # Data is downloaded to a '.part' file, which is only renamed once complete
+        partpath = partPath(filepath, lecture)
+        completed = False
+        meta = {}   # Response headers worth keeping, filled in by fetches
+        try:
+            size = self.segmentable(lecture.dllink, partpath)
+            if size:
+                completed = self.fetchSegmented(lecture.dllink, partpath, size, bar, meta)
+            else:
+                completed = self.fetch(lecture.dllink, partpath, bar, meta)
+        finally:
+            bar.end(completed)
+            if local:
+                bar.close()
+
+        if not completed:
+            return ('', None)
+
+        os.replace(partpath, filepath)
+        return (filepath, meta.get('etag'))
+
+    def fetch(self, url, partpath, bar, meta):
+        """Downloads 'url' into 'partpath', resuming from wherever a previous attempt stopped.
+            Transient errors are retried with exponential backoff.
+            returns: True if download completed"""
+        output = bar.message
+
+        for attempt in range(RETRIES + 1):
+            if attempt:
+                delay = BACKOFF * 2 ** (attempt - 1)
+                metrics.count('download.retries')
+                output("Retrying in {} seconds...".format(delay))
+                time.sleep(delay)
+
+            if self.__QUIT:
+                return False
+
+            try:
+                with self.streams:
+                    return self.fetchRange(url, partpath, bar, meta)
+            except (rEx.ChunkedEncodingError, rEx.ConnectionError, rEx.Timeout) as err:
+                # Disconnected during download, probably 104
+                output('Download Error at {0}: {1}'.format(datetime.now().time(), err))
+            except rEx.HTTPError as err:
+                output('Download Error at {0}: {1}'.format(datetime.now().time(), err))
+                if err.response.status_code < 500:
+                    # Client errors e.g. expired link, won't go away by retrying
+                    return False
+
+        output("Download failed after {} attempts, skipping.".format(RETRIES + 1))
+        return False
+
+    def fetchRange(self, url, partpath, bar, meta):
+        """Makes a single attempt at downloading the rest of 'url' into 'partpath'.
+            returns: True if download completed, False if it was abandoned"""
+        offset = os.path.getsize(partpath) if os.path.exists(partpath) else 0
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
 
         # Start streaming data
         # stream=True parameter ensures page is streamed to reduce memory usage
-        resp = self.sesh.get(lecture.dllink, stream=True)
-
-        # Get total file size for loading bar
-        total_size = int(resp.headers.get('content-length', 0))
+        requested = time.perf_counter()
+        resp = self.sesh.get(url, headers=headers, stream=True, timeout=TIMEOUT)
+        metrics.observe('download.ttfb', time.perf_counter() - requested)
+
+        with resp:
+            if resp.status_code == 416:
+                # Range starts past the end of the file, check if '.part' is already complete
+                total = resp.headers.get('content-range', '').rpartition('/')[2]
+                if total.isdigit() and int(total) == offset:
+                    return True
+
+                # '.part' doesn't match file on server, start again from scratch
+                os.remove(partpath)
+                raise rEx.ConnectionError("Partial download doesn't match server, restarting.")
+
+            resp.raise_for_status()
+            meta['etag'] = resp.headers.get('ETag')
+
+            if resp.status_code != 206:
+                # Server ignored range, full file is being sent
+                offset = 0
+
+            # Get remaining file size for loading bar
+            remaining = int(resp.headers.get('content-length', 0))
+
+            if offset:
+                bar.message("Resuming from {}.".format(humanize(offset)))
+            bar.expect(remaining)
+
+            # Create and write to file
+            with open(partpath, 'ab' if offset else 'wb') as fd:
+                if self.copy(resp, fd.write, bar) is None:
+                    # Force quitting, abandon download
+                    return False
+
+        if remaining and os.path.getsize(partpath) != offset + remaining:
+            raise rEx.ConnectionError("Connection closed before download finished.")
+
+        return True
+
+    def segmentable(self, url, partpath):
+        """Checks if a lecture should be downloaded in segments.
+            returns: file size if it should, else 0"""
+        if self.segments < 2:
+            return 0
+
+        if os.path.exists(partpath) and not os.path.exists(partpath + SEGMENTS_SUFFIX):
+            # Resume previous unsegmented download instead
+            return 0
+
+        size, ranges = self.probe(url)
+        if not ranges:
+            return 0
+
+        return size if size >= self.threshold else 0
+
+    def probe(self, url):
+        """Requests first byte of 'url', which tells us the full size and if ranges are supported.
+            (HEAD isn't used, as pre-signed links are often only valid for GET)
+            returns: (size or None if unknown, True if byte ranges are supported)"""
+        try:
+            with self.streams:
+                resp = self.sesh.get(url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=TIMEOUT)
+                resp.close()
+        except rEx.RequestException:
+            return (None, False)
+
+        total = resp.headers.get('content-range', '').rpartition('/')[2]
+        if resp.status_code == 206 and total.isdigit():
+            return (int(total), resp.headers.get('accept-ranges', 'bytes') == 'bytes')
+
+        length = resp.headers.get('content-length', '')
+        if resp.status_code == 200 and length.isdigit():
+            return (int(length), False)
+
+        return (None, False)
+
+    def probeSizes(self, tasks, jobs):
+        """returns: file size, or None if unknown, of each (course, lecture), probing 'jobs' at a time"""
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            return [size for size, _ in pool.map(lambda task: self.probe(task[1].dllink), tasks)]
+
+    def fetchSegmented(self, url, partpath, size, bar, meta):
+        """Downloads 'url' into 'partpath' as byte range segments over parallel connections.
+            Segments are written in place into a preallocated file, and completed segments
+            are recorded in a '.segments' file so an interrupted download can resume.
+            returns: True if download completed"""
+        segsize = -(-size // self.segments)
+        ranges = [(start, min(start + segsize, size) - 1) for start in range(0, size, segsize)]
+
+        # Load record of previously completed segments
+        statepath = partpath + SEGMENTS_SUFFIX
+        state = {'size': size, 'ranges': ranges, 'done': []}
+        try:
+            with open(statepath) as statefile:
+                saved = json.load(statefile)
+            if saved['size'] == size and os.path.getsize(partpath) == size:
+                state = saved
+                ranges = [tuple(r) for r in saved['ranges']]
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+        todo = [r for i, r in enumerate(ranges) if i not in state['done']]
+
+        bar.message("Downloading in {0} segments ({1})...".format(len(todo), humanize(size)))
+        bar.expect(sum(end - start + 1 for start, end in todo))
+
+        completed = False
+        fd = os.open(partpath, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # Preallocate file, so segments can be written in place
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+
+            with open(statepath, 'w') as statefile:
+                json.dump(state, statefile)
+
+            with ThreadPoolExecutor(max_workers=self.segments) as pool:
+                futures = {
+                    pool.submit(self.fetchSegment, url, fd, start, end, bar, meta): ranges.index((start, end))
+                    for start, end in todo
+                }
+                for future in as_completed(futures):
+                    if future.result():
+                        state['done'].append(futures[future])
+                        with open(statepath, 'w') as statefile:
+                            json.dump(state, statefile)
+
+            # Complete once the finished segments cover every byte, the file's own size
+            # says nothing as it was preallocated
+            done = set(state['done'])
+            completed = sum(end - start + 1 for indx, (start, end) in enumerate(ranges) if indx in done) == size
+        finally:
+            os.close(fd)
+
+        if completed:
+            os.remove(statepath)
+        return completed
+
+    def fetchSegment(self, url, fd, start, end, bar, meta):
+        """Downloads bytes 'start' to 'end' of 'url', writing them in place to file 'fd'.
+            returns: True if segment completed"""
+        pos = start
+
+        for attempt in range(RETRIES + 1):
+            if attempt:
+                delay = BACKOFF * 2 ** (attempt - 1)
+                metrics.count('download.retries')
+                bar.message("Retrying segment in {} seconds...".format(delay))
+                time.sleep(delay)
+
+            if self.__QUIT:
+                return False
 
-        # Create and write to file
-        with open(filepath, 'wb') as fd:
             try:
-                for chunk in progress.bar(
-                        resp.iter_content(chunk_size=1024), expected_size=(total_size/1024) + 1):
+                headers = {'Range': 'bytes={0}-{1}'.format(pos, end)}
+                with self.streams:
+                    requested = time.perf_counter()
+                    with self.sesh.get(url, headers=headers, stream=True, timeout=TIMEOUT) as resp:
+                        metrics.observe('download.ttfb', time.perf_counter() - requested)
+                        resp.raise_for_status()
+                        meta['etag'] = resp.headers.get('ETag')
+                        if resp.status_code != 206:
+                            bar.message("Server ignored byte range, segment failed.")
+                            return False
+
+                        def write(chunk):
+                            nonlocal pos
+                            os.pwrite(fd, chunk, pos)
+                            pos = pos + len(chunk)
+
+                        # Don't overwrite the next segment if server sends too much
+                        if self.copy(resp, write, bar, end + 1 - pos) is None:
+                            return False
+
+                if pos == end + 1:
+                    return True
+                bar.message("Segment ended early at byte {}.".format(pos))
+            except (rEx.ChunkedEncodingError, rEx.ConnectionError, rEx.Timeout) as err:
+                bar.message('Download Error at {0}: {1}'.format(datetime.now().time(), err))
+            except rEx.HTTPError as err:
+                bar.message('Download Error at {0}: {1}'.format(datetime.now().time(), err))
+                if err.response.status_code < 500:
+                    return False
+
+        bar.message("Segment failed after {} attempts.".format(RETRIES + 1))
+        return False
+
+    def copy(self, resp, write, bar, limit=None):
+        """Copies body of a streamed response to 'write' in large chunks.
+            Unencoded bodies are read straight from the raw urllib3 stream into one
+            reusable buffer, instead of creating a new bytes object for every chunk.
+            limit: maximum number of bytes to copy
+            returns: number of bytes copied, or None if download was abandoned"""
+        copied = 0
+        # Disk writes are only timed when metrics are on, as this is the hottest loop
+        write = metrics.wrap('download.write', write)
+
+        try:
+            if READINTO and not resp.headers.get('content-encoding'):
+                view = memoryview(bytearray(self.chunkSize))
+                try:
+                    while limit is None or copied < limit:
+                        if self.__QUIT:
+                            return None
+
+                        size = self.chunkSize if limit is None else min(self.chunkSize, limit - copied)
+                        nbytes = resp.raw.readinto(view[:size])
+                        if not nbytes:
+                            break
+
+                        write(view[:nbytes])
+                        copied = copied + nbytes
+                        bar.advance(nbytes)
+                        if self.bucket:
+                            self.bucket.consume(nbytes)
+                except uEx.ProtocolError as err:
+                    raise rEx.ChunkedEncodingError(err)
+                except uEx.ReadTimeoutError as err:
+                    raise rEx.ConnectionError(err)
+            else:
+                for chunk in resp.iter_content(chunk_size=self.chunkSize):
+                    if self.__QUIT:
+                        return None
+                    if limit is not None:
+                        chunk = chunk[:limit - copied]
                     if chunk: # filter out keep-alive new chunks
-                        fd.write(chunk)
-            except  rEx.ChunkedEncodingError:
-                # Raised an error during download, probably 104
-                # Download was not complete
-                print('Download Error at %s' %datetime.now().time())
-                print('Halting.')
-                self.__HALT = True
-                return ''
-
-        return filepath
+                        write(chunk)
+                        copied = copied + len(chunk)
+                        bar.advance(len(chunk))
+                        if self.bucket:
+                            self.bucket.consume(len(chunk))
+                    if limit is not None and copied >= limit:
+                        break
+        finally:
+            metrics.count('download.bytes', copied)
+
+        return copied
 
     @staticmethod
     def directory(course, lecture):
@@ -174,9 +802,11 @@ class LectureDownloader(Echo360login):
         if not self.__HALT:
             # ^C pressed once
             self.__HALT = True
-            print("\nHalting. Program will terminate after current download finishes.")
+            print("\nHalting. Program will terminate after current downloads finish.")
             print("Press ^C again to force quit - This may corrupt any currently open files!")
         else:
             # ^C pressed twice, force quitting
+            # Parallel downloads see this flag and stop, so the program doesn't wait on them
+            self.__QUIT = True
             print("\nQuitting...")
             sys.exit(1)
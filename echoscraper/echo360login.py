@@ -1,77 +1,181 @@
 """Provides login functionality to echo360 for scraper and download modules."""
 
 import getpass                  # gets password from user silently
+import json                     # session file format
+import os                       # finds home directory
 from lxml import html           # parses html
 
 import requests                 # Maintains session and makes requests
 
+from . import metrics
+from .storage import writeAtomic
+
+# Cookies of last authenticated session, reused to skip logging in again
+SESSION_FILE = os.path.expanduser('~/.echoscraper_session')
+
+# Echo360 endpoints, which can be overridden to point at a test server e.g. benchmarks.bench_echo360
+ECHO360_URL = os.environ.get('ECHO360_URL', 'https://echo360.org.au')
+INSTITUTIONS_URL = os.environ.get('ECHO360_LOGIN_URL', 'https://login.echo360.org.au/login/institutions')
+APP_ID = 'c08c41ee-50e3-45e8-a6e6-e9579b28f620'
+
+# Everything prompted for when logging in
+CREDENTIALS = ('email', 'username', 'password')
+
+# NOTE: The functions below hold the parts of logging in which don't make requests,
+#       so they're shared by the synchronous and asynchronous (see asyncclient) clients.
+
+def askEmail(credentials=None):
+    """Prompts for email address, unless it's given in 'credentials'.
+        returns: POST data for Echo360's institution lookup"""
+    if credentials and credentials.get('email'):
+        email = credentials['email']
+    else:
+        email = input('    Email: ')
+    return {
+        'email': email,
+        'appId': APP_ID,
+    }
+
+def institutionFound(status, email):
+    """Checks Echo360's reply to an institution lookup, explaining any failure.
+        returns: True if institution was found"""
+    if status == 400:
+        print("\tInput must be student email address.")
+    elif status == 404:
+        print("\tEmail '{}' not recognized by Echo360.".format(email))
+        print("\tEither domain is wrong, or ID doesn't match valid domain.")
+    elif status == 200 or status == 303:
+        # Echo360 institution found
+        return True
+    else:
+        print("\tUnkown error occured for email '{}'".format(email))
+    return False
+
+def askCredentials(email, credentials=None):
+    """Prompts for username and password, unless they're given in 'credentials'.
+        returns: POST data for institution's login form"""
+    credentials = credentials or {}
+    usr = credentials.get('username') or input('    Username: ')
+
+    if "@adelaide.edu.au" in email:
+        # Adelaide uni requires domain name be added as prefix to username
+        usr = "uofa\\" + usr
+    # If other institutions require a specific domain name, they have to be typed in with the username
+    # Alternatively, extra elif clauses can be added here for specific domains if necessary
+
+    return {
+        'UserName': usr,
+        'Password': credentials.get('password') or getpass.getpass('    Password: '),
+        'AuthMethod': 'FormsAuthentication',
+    }
+
+def loginAccepted(text):
+    """Checks if institution's login form accepted the credentials."""
+    return "Incorrect user ID or password." and "Enter your password." not in text
+
+def loginRejected(attempts):
+    """Tells user how many login attempts are left.
+        returns: True if there are none left"""
+    print("    Incorrect username or password.")
+    if attempts == 0:
+        print("All attempts used. Exiting.")
+        return True
+
+    print("    {} attempts remaining.".format(attempts))
+    return False
+
+def parseForm(text):
+    """Scrapes the action and default values of a form which would normally auto-submit.
+        returns: (url, data) to POST"""
+    # Build html tree from response
+    tree = html.fromstring(text)
+    form = tree.xpath(".//form")[0]
+
+    url = form.xpath("./@action")[0]
+    data = {}
+
+    for inpt in form.xpath("./input"):
+        # Scrape input name and value
+        name = inpt.xpath("./@name")[0]
+        value = inpt.xpath("./@value")[0]
+
+        data[name] = value
+
+    return (url, data)
+
+def loadCookies(sessionfile):
+    """returns: list of cookies saved by 'saveCookies', or None if there aren't any"""
+    if not sessionfile:
+        return None
+
+    try:
+        with open(sessionfile, encoding='utf-8') as cookiefile:
+            cookies = json.load(cookiefile)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    return cookies if isinstance(cookies, list) else None
+
+def saveCookies(sessionfile, cookies):
+    """Saves list of cookies, as dicts of 'name', 'value', 'domain', 'path', 'expires'
+        and 'secure', to a file only the current user can read."""
+    if sessionfile:
+        writeAtomic(sessionfile, lambda cookiefile: json.dump(cookies, cookiefile), 0o600)
+
 class Echo360login(object):
-    def __init__(self):
+    def __init__(self, sessionfile=SESSION_FILE, credentials=None, interactive=True):
         self.sesh = requests.Session()
+        self.sessionfile = sessionfile
+        # 'email', 'username' and 'password' to log in with instead of prompting, see batch
+        self.credentials = credentials
+        self.interactive = interactive  # False if nothing can be prompted for
+
+    @metrics.timed('login')
+    def login(self, fresh=False):
+        """Logs into Echo360 and authenticates for all future downloads.
+            Reuses the session saved by a previous login if it's still valid.
+            fresh: ignore any saved session and log in again"""
 
-    def login(self):
-        """Logs into Echo360 and authenticates for all future downloads."""
+        if not fresh and self.resumeSession():
+            print("Resumed previous Echo360 session.")
+            return True
+
+        if not self.interactive and not all((self.credentials or {}).get(key) for key in CREDENTIALS):
+            raise EOFError("logging in needs {} which weren't given".format(', '.join(CREDENTIALS)))
 
         print("Logging in to Echo360...")
 
         # Should get redirected to login page
-        loginpage_url = 'https://echo360.org.au'
-
         # Load Institution login page
-        
-        response = self.sesh.get(loginpage_url)
+        response = self.sesh.get(ECHO360_URL)
         while True:
-            email = input('    Email: ')
-            postData = {
-                'email': email,
-                'appId': 'c08c41ee-50e3-45e8-a6e6-e9579b28f620',
-            }
-            response = self.sesh.post('https://login.echo360.org.au/login/institutions', data=postData)
+            postData = askEmail(self.credentials)
+            email = postData['email']
+            response = self.sesh.post(INSTITUTIONS_URL, data=postData)
 
             # Check POST status_code to determine success
-            if response.status_code == 400:
-                print("\tInput must be student email address.")
-            elif response.status_code == 404:
-                print("\tEmail '{}' not recognized by Echo360.".format(email))
-                print("\tEither domain is wrong, or ID doesn't match valid domain.")
-            elif response.status_code == 200 or response.status_code == 303:
-                # Echo360 institution found
+            if institutionFound(response.status_code, email):
                 break
-            else:
-                print("\tUnkown error occured for email '{}'".format(email))
+
+            if self.credentials:
+                # Given credentials won't change by asking again
+                return False
 
         # Now on actual login page, get username & password, then POST to login
         attempts = 3
         while attempts > 0:
             # Get login credentials
-            if "@adelaide.edu.au" in email:
-                # Adelaide uni requires domain name be added as prefix to username
-                usr = "uofa\\" + input('    Username: ')
-            else:
-                # If other institution, take direct input
-                # If other institutions require a specific domain name, they have to be typed in with the username
-                # Alternatively, extra elif clauses can be added here for specific domains if necessary
-                usr = input('    Username: ')
-
-            postData = {
-                'UserName': usr,
-                'Password': getpass.getpass('    Password: '),
-                'AuthMethod': 'FormsAuthentication',
-            }
+            postData = askCredentials(email, self.credentials)
             response = self.sesh.post(response.url, data=postData)
 
-            if "Incorrect user ID or password." and "Enter your password." not in response.text:
+            if loginAccepted(response.text):
                 # Login Successful
                 break
 
-            print("    Incorrect username or password.")
-            attempts = attempts - 1
-
-            if attempts == 0:
-                print("All attempts used. Exiting.")
+            # Given credentials won't change, so they aren't retried
+            attempts = 0 if self.credentials else attempts - 1
+            if loginRejected(attempts):
                 return False
-            else:
-                print("    {} attempts remaining.".format(attempts))
         
         # We get redirected to ping identity and must post SAMLRequest and RelayState response info
         response = self.autoPOST(response)
@@ -81,24 +185,54 @@ class Echo360login(object):
         response = self.autoPOST(response)
 
         print("Login Successful.")
+        self.saveSession()
         return True
 
-    def autoPOST(self, response):
-        """Used when post form needs to submit default values."""
+    def resumeSession(self):
+        """Loads cookies saved by a previous login, and checks they're still accepted.
+            returns: True if session is still logged in"""
+        cookies = loadCookies(self.sessionfile)
+        if not cookies:
+            return False
 
-        # Build html tree from response
-        tree = html.fromstring(response.text)
-        form = tree.xpath(".//form")[0]
+        try:
+            for cookie in cookies:
+                self.sesh.cookies.set(**cookie)
+        except TypeError:
+            return False
 
-        url = form.xpath("./@action")[0]
-        data = {}
+        if not self.loggedIn():
+            self.sesh.cookies.clear()
+            return False
 
-        for inpt in form.xpath("./input"):
-            # Scrape input name and value
-            name = inpt.xpath("./@name")[0]
-            value = inpt.xpath("./@value")[0]
+        return True
+
+    def loggedIn(self):
+        """returns: True if the session is still logged in to Echo360"""
+        # Logged in users get the home page, everyone else is redirected to log in
+        try:
+            response = self.sesh.get(ECHO360_URL + '/home', allow_redirects=False, stream=True)
+            response.close()
+        except requests.exceptions.RequestException:
+            return False
+
+        return response.status_code == 200
+
+    def saveSession(self):
+        """Saves session cookies to a file only the current user can read."""
+        saveCookies(self.sessionfile, [{
+            'name': cookie.name,
+            'value': cookie.value,
+            'domain': cookie.domain,
+            'path': cookie.path,
+            'expires': cookie.expires,
+            'secure': cookie.secure,
+        } for cookie in self.sesh.cookies])
+
+    @metrics.timed('login.autopost')
+    def autoPOST(self, response):
+        """Used when post form needs to submit default values."""
+        url, data = parseForm(response.text)
 
-            data[name] = value
-        
         # POST data
         return self.sesh.post(url, data)
@@ -1,11 +1,10 @@
 """echoscraper scrapes and downloads lectures from Echo360 into organised folder structure."""
 
+import importlib.util   # Imports a command's module when it's run, and finds its source
 import re
 import sys
 
-from . import scraper
-from . import download
-from . import register
+from . import metrics
 
 # Prints current Python interpreter version
 # print("___ Python " + str(sys.version[:5]) + " ___\n")
@@ -15,28 +14,107 @@ from . import register
 
 # GLOBALS
 # Command List
+# Each command's module is only imported when the command runs, so quick commands such as
+# 'register' don't wait for requests and lxml to load. "func" is the function in "module" which
+# runs the command, and "doc" names the function documenting it, by default the module itself.
 COMMANDS = {
     "scrape": {
-        "doc": scraper.__doc__,
-        "func": scraper.start,
-        "numargs": 1
+        "module": "scraper",
+        "func": "start",
+        "numargs": 1,
+        "ops": ["a", "j", "l", "r"],
+        "valops": {"j": int}
     },
     "download": {
-        "doc": download.__doc__,
-        "func": download.start,
+        "module": "download",
+        "func": "start",
         "numargs": 1,
-        "ops": ["c", "y"]
+        "ops": ["a", "b", "c", "j", "l", "n", "o", "p", "q", "r", "s", "t", "y"],
+        "valops": {"b": float, "j": int, "o": int, "p": str, "q": str, "r": float, "s": int, "t": float},
+        "longops": {"plan": float}
     },
     "register": {
-        "doc": register.__doc__,
-        "func": register.start,
+        "module": "register",
+        "func": "start",
         "numargs": 1,
         "ops": ["d", "f", "m"]
+    },
+    "verify": {
+        "module": "verify",
+        "func": "start",
+        "numargs": 1,
+        "ops": ["c", "j", "n"],
+        "valops": {"j": int}
+    },
+    "batch": {
+        "module": "batch",
+        "func": "start",
+        "numargs": 1,
+        "ops": ["j", "l", "s"],
+        "valops": {"j": int, "s": int}
+    },
+    "watch": {
+        "module": "watch",
+        "func": "start",
+        "numargs": 1,
+        "ops": ["i", "j", "l", "q", "r"],
+        "valops": {"i": float, "j": int, "q": str, "r": float}
+    },
+    "sync": {
+        "module": "sync",
+        "func": "start",
+        "numargs": 1,
+        "ops": ["f", "j", "l", "q", "r"],
+        "valops": {"f": int, "j": int, "q": str, "r": float}
+    },
+    "dedupe": {
+        "module": "store",
+        "func": "dedupe",
+        "doc": "dedupe",
+        "numargs": 1,
+        "ops": ["j", "n"],
+        "valops": {"j": int}
+    },
+    "migrate": {
+        "module": "register",
+        "func": "migrate",
+        "doc": "migrate",
+        "numargs": 2
     }
 }
 
+# Long options accepted by every command, handled before the command runs
+# e.g. '--metrics' or '--metrics=run.json', converted to the listed type when given a value
+GLOBAL_LONGOPS = {
+    "metrics": str
+}
+
 # Function Definitions
 
+def handler(command):
+    """Imports the module of a command.
+        returns: function which runs the command"""
+    entry = COMMANDS[command]
+    module = importlib.import_module('.' + entry["module"], __package__)
+    return getattr(module, entry["func"])
+
+def doc(command):
+    """Reads the docstring of a command from its module's source, without importing it.
+        returns: docstring, or '' if it can't be found"""
+    import ast      # Only needed for usage
+    entry = COMMANDS[command]
+    spec = importlib.util.find_spec('.' + entry["module"], __package__)
+    try:
+        with open(spec.origin, encoding='utf-8') as source:
+            tree = ast.parse(source.read())
+    except (AttributeError, OSError, SyntaxError):
+        return ''
+
+    if "doc" in entry:
+        tree = next((node for node in tree.body
+                     if isinstance(node, ast.FunctionDef) and node.name == entry["doc"]), None)
+    return (tree and ast.get_docstring(tree, clean=False)) or ''
+
 def usage():
     """Prints usage information to user."""
     def indent(multiline, prefix, skip=[0]):
@@ -50,35 +128,71 @@ def usage():
     print("\tOR\n    python echoscraper-runner.py <command> [options] <filename>\n")
     
     print("Commands:")
-    for key, value in COMMANDS.items():
-        value["doc"].split('\n')
-        print("    {:<10}  {:<}\n".format(key, indent(value["doc"], 16*' ')))
+    for key in COMMANDS:
+        print("    {:<10}  {:<}\n".format(key, indent(doc(key), 16*' ')))
     
     print("Arguments:\n    All commands require the register filename\n")
+    print("Global options:")
+    print("    --metrics   Prints where the time went once the command finishes")
+    print("    --metrics=FILE\n                Also saves metrics to FILE, as JSON if it ends in '.json', else Prometheus text\n")
+    print("Registers:\n    Registers ending in '.db' are stored in SQLite, '.jsonl' in JSON Lines, otherwise JSON\n")
     print("Example:\n    $ echoscraper scrape register.json")
     print("        - Scrapes info and builds 'register.json'")
     print("    $ echoscraper download register.json")
     print("        - Starts downloading all lectures in 'register.json'")
 
-def options(start):
-    """Get options for a given argument."""
-    ops = []
-    for arg in sys.argv[start+2:]:
-        if re.match(r'-[a-z]', arg):
-            ops.append(re.sub('-', '', arg))
+def parse(argv):
+    """Get the command, arguments and options that were passed with the function call.
+        Options can be grouped e.g. '-cy', and options listed in a command's "valops"
+        take a value e.g. '-j 4' or '-j4', which is converted to the listed type.
+        Long options from GLOBAL_LONGOPS, or a command's "longops", are flags e.g. '--metrics'
+        or take a value after '=' e.g. '--metrics=run.json'.
+        returns: (command, [arguments], {option: value})
+        raises: ValueError if an option's value can't be converted"""
+    command = None
+    arguments = []
+    ops = {}
+
+    argv = iter(argv)
+    for arg in argv:
+        longop = re.match(r'--([a-z][a-z-]*)(?:=(.*))?$', arg)
+        if longop:
+            name, value = longop.groups()
+            longops = dict(GLOBAL_LONGOPS, **COMMANDS.get(command, {}).get("longops", {}))
+            if name not in longops:
+                raise ValueError("Unknown option '--{}'.".format(name))
+            try:
+                ops[name] = True if value is None else longops[name](value)
+            except ValueError:
+                raise ValueError("Option '--{0}' expects a {1}, not '{2}'.".format(
+                    name, longops[name].__name__, value))
+        elif re.match(r'-[a-z]', arg):
+            valops = COMMANDS.get(command, {}).get("valops", {})
+            letters = arg[1:]
+            for i, letter in enumerate(letters):
+                if letter in valops:
+                    # Rest of the argument, or the next argument, is the value
+                    value = letters[i+1:] or next(argv, '')
+                    try:
+                        ops[letter] = valops[letter](value)
+                    except ValueError:
+                        raise ValueError("Option '-{0}' expects a {1}, not '{2}'.".format(
+                            letter, valops[letter].__name__, value))
+                    break
+                ops[letter] = True
+        elif command is None:
+            command = arg
         else:
-            break
+            arguments.append(arg)
 
-    return ops
+    return command, arguments, ops
 
-def parse():
-    """Get any arguments and options that were passed with the function call."""
-    arguments = []
-    for i, arg in enumerate(sys.argv[1:]):
-        if not re.match(r'-[a-z]', arg):
-            arguments.append([arg, *options(i)])
-
-    return arguments
+def report(metricsfile):
+    """Prints metrics recorded during the run, and saves them if given a filename."""
+    metrics.summary()
+    if metricsfile is not True:
+        metrics.save(metricsfile)
+        print("Metrics saved to '{}'.".format(metricsfile))
 
 # Main code
 def main():
@@ -87,14 +201,25 @@ def main():
         usage()
 
     else:
-        arguments = parse()
+        try:
+            command, arguments, ops = parse(sys.argv[1:])
+        except ValueError as err:
+            print(err)
+            return
 
-        arg1 = arguments[0]
-        if arg1[0] in COMMANDS:
-            start = COMMANDS[arg1[0]]["func"]
-            if len(arguments)-1 != COMMANDS[arg1[0]]["numargs"]:
-                print("Wrong number of arguments to method '{}'.".format(arg1[0]))
+        if command in COMMANDS:
+            if len(arguments) != COMMANDS[command]["numargs"]:
+                print("Wrong number of arguments to method '{}'.".format(command))
             else:
-                start(*arguments[1:], arg1[1:])
+                metricsfile = ops.pop("metrics", None)
+                if metricsfile:
+                    metrics.enable()
+
+                try:
+                    with metrics.span("run"):
+                        handler(command)(arguments, ops)
+                finally:
+                    if metricsfile:
+                        report(metricsfile)
         else:
-            print("Unknown command '{}'.".format(arguments[0][0]))
+            print("Unknown command '{}'.".format(command))
@@ -0,0 +1,168 @@
+"""Times spans of work and counts events during a run, for the report printed by '--metrics'.
+    Until 'enable' is called, spans and counters only cost a check of 'enabled'.
+
+    usage:
+        @metrics.timed('scrape.syllabus')       # Times every call
+        def scrape_course_lectures(...): ...
+
+        with metrics.span('register.flush'):    # Times a block
+            ...
+
+        metrics.count('download.retries')       # Counts an event"""
+
+import functools    # Wraps timed functions
+import re           # Builds Prometheus metric names
+import sys          # Prints summary
+import threading    # Spans are recorded from many threads
+import time         # Times spans
+
+from .progress import humanize
+
+# Flag set on 'async def' functions, checked directly as 'inspect' is slow to import
+CO_COROUTINE = 0x80
+
+enabled = False
+
+_lock = threading.Lock()
+_spans = {}     # Name: [calls, total seconds, longest seconds]
+_counters = {}  # Name: total
+
+def enable():
+    """Starts recording spans and counters, forgetting any recorded before."""
+    global enabled
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+    enabled = True
+
+def observe(name, seconds):
+    """Records a span of 'seconds' which was timed elsewhere."""
+    if not enabled:
+        return
+    with _lock:
+        stats = _spans.get(name)
+        if stats is None:
+            _spans[name] = [1, seconds, seconds]
+        else:
+            stats[0] = stats[0] + 1
+            stats[1] = stats[1] + seconds
+            stats[2] = max(stats[2], seconds)
+
+def count(name, value=1):
+    """Adds 'value' to counter 'name'."""
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+class span(object):
+    """Times a 'with' block as span 'name'."""
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        observe(self.name, time.perf_counter() - self.start)
+
+def timed(name):
+    """Decorates a function, or coroutine function, to time each call as span 'name'."""
+    def decorator(func):
+        # Builtins e.g. a file's 'write', given to 'wrap', have no code and are never coroutines
+        code = getattr(func, '__code__', None)
+        if code is not None and code.co_flags & CO_COROUTINE:
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                if not enabled:
+                    return await func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    observe(name, time.perf_counter() - start)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not enabled:
+                    return func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    observe(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+def wrap(name, func):
+    """returns: 'func', timing each call as span 'name' if metrics are enabled.
+        Used on hot paths e.g. disk writes, so they aren't slowed when metrics are off."""
+    return timed(name)(func) if enabled else func
+
+def snapshot():
+    """returns: dict of everything recorded so far"""
+    with _lock:
+        return {
+            "spans": {name: {"calls": calls, "seconds": total, "max": longest}
+                      for name, (calls, total, longest) in sorted(_spans.items())},
+            "counters": dict(sorted(_counters.items())),
+        }
+
+def summary(stream=sys.stdout):
+    """Prints a table of spans and counters."""
+    recorded = snapshot()
+    spans, counters = recorded["spans"], recorded["counters"]
+
+    print("\nMetrics:", file=stream)
+    print("    {0:<22} {1:>7} {2:>10} {3:>10} {4:>10}".format("span", "calls", "total s", "mean ms", "max ms"),
+          file=stream)
+    for name, stats in spans.items():
+        print("    {0:<22} {1:>7} {2:>10.3f} {3:>10.1f} {4:>10.1f}".format(
+            name, stats["calls"], stats["seconds"], stats["seconds"] / stats["calls"] * 1000, stats["max"] * 1000),
+            file=stream)
+
+    for name, value in counters.items():
+        print("    {0:<22} {1:>7}".format(name, humanize(value) if name.endswith('bytes') else value), file=stream)
+
+    # Throughput of the whole run, as downloads overlap
+    if counters.get("download.bytes") and spans.get("run"):
+        print("    {0:<22} {1:>7}/s".format("download.throughput",
+            humanize(counters["download.bytes"] / spans["run"]["seconds"])), file=stream)
+
+def prometheus():
+    """returns: everything recorded so far, in Prometheus' text format"""
+    def metric(name):
+        return 'echoscraper_' + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+    recorded = snapshot()
+    lines = []
+    if recorded["spans"]:
+        lines.append("# TYPE echoscraper_span_seconds summary")
+        for name, stats in recorded["spans"].items():
+            lines.append('echoscraper_span_seconds_sum{{span="{0}"}} {1}'.format(name, stats["seconds"]))
+            lines.append('echoscraper_span_seconds_count{{span="{0}"}} {1}'.format(name, stats["calls"]))
+        lines.append("# TYPE echoscraper_span_seconds_max gauge")
+        for name, stats in recorded["spans"].items():
+            lines.append('echoscraper_span_seconds_max{{span="{0}"}} {1}'.format(name, stats["max"]))
+
+    for name, value in recorded["counters"].items():
+        lines.append("# TYPE {}_total counter".format(metric(name)))
+        lines.append("{0}_total {1}".format(metric(name), value))
+
+    return '\n'.join(lines) + '\n'
+
+def save(filename):
+    """Saves everything recorded so far, as JSON if 'filename' ends in '.json',
+        otherwise in Prometheus' text format e.g. for node_exporter's textfile collector."""
+    # Not needed until the end of a run, so they don't slow startup
+    import json
+    from .storage import writeAtomic
+
+    if filename.endswith('.json'):
+        text = json.dumps(snapshot(), indent=2)
+    else:
+        text = prometheus()
+    writeAtomic(filename, lambda metricsfile: metricsfile.write(text))
@@ -0,0 +1,110 @@
+"""Time throttled progress display, shared by single and concurrent downloads."""
+
+import sys          # Default output stream
+import threading    # Progress is updated from many download threads
+import time         # Throttles redraws and measures throughput
+
+def humanize(nbytes):
+    """Returns byte count as a human readable string e.g. '1.5 GB'."""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if nbytes < 1024:
+            break
+        nbytes = nbytes / 1024
+    else:
+        unit = 'TB'
+    return "{0:.1f} {1}".format(nbytes, unit)
+
+class Progress(object):
+    """Single status line tracking files and bytes across all downloads.
+        Safe to update from multiple threads, and redraws at most every 'interval' seconds.
+
+        usage:
+            progress = Progress(numFiles)
+            progress.queued()               # Another file is found, see sync
+            progress.begin()                # Download starts
+            progress.expect(expectedBytes)  # Size of download is known
+            progress.advance(len(chunk))    # Chunk received
+            progress.end(True)              # Download finished, successfully or not
+            progress.close()"""
+
+    WIDTH = 30
+
+    def __init__(self, files, interval=0.5, stream=sys.stdout):
+        self.files = files
+        self.interval = interval
+        self.stream = stream
+
+        self.finished = 0
+        self.active = 0
+        self.received = 0
+        self.expected = 0
+
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.lastDraw = 0
+
+    def queued(self, files=1):
+        """'files' more files are to be downloaded, when they aren't all known up front."""
+        with self.lock:
+            self.files = self.files + files
+            self._draw()
+
+    def begin(self):
+        """A download has started."""
+        with self.lock:
+            self.active = self.active + 1
+            self._draw(True)
+
+    def expect(self, nbytes):
+        """'nbytes' more bytes are expected to be received."""
+        with self.lock:
+            self.expected = self.expected + nbytes
+            self._draw()
+
+    def advance(self, nbytes):
+        """'nbytes' more bytes have been received."""
+        with self.lock:
+            self.received = self.received + nbytes
+            self._draw()
+
+    def end(self, completed):
+        """A download has finished, 'completed' is False if it failed."""
+        with self.lock:
+            self.active = self.active - 1
+            if completed:
+                self.finished = self.finished + 1
+            self._draw(True)
+
+    def message(self, text):
+        """Prints a line of text above the status line."""
+        with self.lock:
+            self.stream.write("\r\033[K" + text + "\n")
+            self._draw(True)
+
+    def close(self):
+        """Draws final status and moves to a new line."""
+        with self.lock:
+            self._draw(True)
+            self.stream.write("\n")
+            self.stream.flush()
+
+    def _draw(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.lastDraw < self.interval:
+            return
+        self.lastDraw = now
+
+        filled = int(self.WIDTH * self.received / self.expected) if self.expected else 0
+        rate = self.received / max(now - self.started, 1e-6)
+
+        self.stream.write("\r\033[K[{0}{1}] {2}/{3} files  {4}/{5}  {6}/s  {7} active".format(
+            '#' * min(filled, self.WIDTH),
+            ' ' * (self.WIDTH - min(filled, self.WIDTH)),
+            self.finished,
+            self.files,
+            humanize(self.received),
+            humanize(self.expected),
+            humanize(rate),
+            self.active
+        ))
+        self.stream.flush()
@@ -3,38 +3,79 @@
           : default counts the number of courses left to download
         -d: prints [d]ocket, a list of the courses on file
         -m: prints docket with [m]issing lectures for each course
-        -f: prints [f]ull list of courses and lectures"""
+        -f: prints [f]ull list of courses and lectures
+    Registers are converted between storage engines by its own command, 'echoscraper migrate',
+    rather than an option here, as it takes a destination as well, see migrate."""
 
-import json
+import time
 
-from .data import decode
-from .data import Encoder
+from . import metrics
+from .storage import openStorage, Storage
+
+# Batched flushing for long-lived registers, see Register.changed()
+FLUSH_EVERY = 25        # Flush after this many changes...
+FLUSH_INTERVAL = 10     # ...or if this many seconds have passed since the last flush
 
 def start(arguments, options):
     """Interrogates a given register."""
     regname = arguments[0]
-    r = Register(regname)
-    
+    storage = openStorage(regname)
+
+    if not storage.exists():
+        print("'{}' not found.".format(regname))
+        return
+
+    # Queries run directly against storage, so indexed engines don't load the whole register
     if "d" in options:
         # Print [d]ocket
-        if r.exists:
-            r.docket()
+        docket(regname, storage.courses())
     elif "m" in options:
-        # Print docket with only [m]issing lectures
-        if r.exists:
-            r.docket(True, True)
+        # Print docket with only [m]issing lectures, courses still count all of theirs
+        docket(regname, storage.courses(), True, True)
     elif "f" in options:
         # Print [f]ull docket
-        if r.exists:
-            r.docket(True)
+        docket(regname, storage.courses(), True)
     else:
         # Count number of lectures to download
-        if r.exists:
-            total, missing = r.tally()
-            if missing != 0:
-                print("{0} lectures left to download from a total of {1}".format(missing, total))
-            else:
-                print("All {0} lectures downloaded.".format(total))
+        total, missing = storage.tally()
+        if missing != 0:
+            print("{0} lectures left to download from a total of {1}".format(missing, total))
+        else:
+            print("All {0} lectures downloaded.".format(total))
+
+def migrate(arguments, options):
+    """Copies a register into a new file, converting between storage engines.
+    Usage:
+        echoscraper migrate <source> <destination>
+        e.g. 'echoscraper migrate register.json register.db' converts to SQLite"""
+    source = openStorage(arguments[0])
+    destination = openStorage(arguments[1])
+
+    if not source.exists():
+        print("'{}' not found.".format(arguments[0]))
+        return
+
+    courses = source.read()
+    destination.write(courses)
+
+    print("Migrated {0} courses with {1} lectures from '{2}' to '{3}'.".format(
+        len(courses),
+        sum(len(course.lectures) for course in courses),
+        arguments[0],
+        arguments[1]
+    ))
+
+def docket(regname, courses, listLectures=False, onlyMissing=False):
+    """Prints list of courses, and optionally their lectures."""
+    print("Register '{}':".format(regname))
+    for indx, course in enumerate(courses):
+        # Print course info
+        print("  {0} - {1}.".format(indx, course))
+        if len(course.lectures) > 0 and listLectures:
+            # also print lectures
+            for lect in course.lectures:
+                if not lect.filename or not onlyMissing:
+                    print('\t'+str(lect))
 
 class Register(list):
     """List of Course objects, with functionality for r/w to file.
@@ -58,14 +99,42 @@ class Register(list):
                 2017, 2, []
             )
             # Make temporary changes to 'reg'
-            reg.append(c)"""
+            reg.append(c)
+
+            # Long-lived session - file is read once, changes are flushed in batches.
+            with Register("name.json", FLUSH_EVERY, FLUSH_INTERVAL) as reg:
+                for c in courses:
+                    reg.appendIfMissing(c)  # Flushed every FLUSH_EVERY changes
+                reg.flush()                 # Or flush explicitly
+
+            # Streaming - nothing is loaded, courses are read from file one at a time.
+            with Register("name.json", load=False) as reg:
+                for c in reg.iterCourses(onlyMissing=True):
+                    ...
+                    reg.setFilename(c, lecture, filepath)
+
+        Storage engine is chosen by file extension, e.g. 'name.db' is stored in SQLite."""
 
-    def __init__(self, name=None):
+    def __init__(self, name=None, flushEvery=None, flushInterval=None, load=True):
         # print("\tiniting...")
 
         self.filename = name
+        self.storage = openStorage(name) if name else None
+        self.loaded = load or not name
 
-        if name:
+        # Unflushed changes, see Storage.commit()
+        self.flushEvery = flushEvery
+        self.flushInterval = flushInterval
+        self.changes = []
+        self.lastFlush = time.monotonic()
+
+        if name and not load:
+            # Streaming, courses are only read from file when iterated over
+            self.exists = self.storage.exists()
+            if not self.exists:
+                print("'{}' not found.".format(self.filename))
+            data = []
+        elif name:
             # If passed a filename
             try:
                 # If file exists, read it.
@@ -83,33 +152,77 @@ class Register(list):
 
         super().__init__(data)
 
+        # Course key: position in register
+        self._index = {course.key: indx for indx, course in enumerate(self)}
+
     # ---- Quality-of-Life functions ----
 
     def appendIfMissing(self, course):
-        """Adds course to list if it doesn't already exist, else does nothing."""
-
-        # Count number of courses in register that match the current course
-        # Should only be 0 or 1
-        exists = self.count(course) > 0
+        """Adds course to list if it doesn't already exist, else does nothing.
+            returns: position of course in register"""
 
         # If course isn't already in register
-        if not exists:
+        if course.key not in self._index:
             self.append(course)
 
+        return self._index[course.key]
+
+    def append(self, course):
+        """Adds course to list, recording the change."""
+        self._index[course.key] = len(self)
+        super().append(course)
+        self.changed(('course', course))
+
+    def find(self, key):
+        """Returns position of the course with a given key, or -1 if it doesn't exist."""
+        return self._index.get(key, -1)
+
+    def __contains__(self, course):
+        return course.key in self._index
+
+    def appendLecture(self, courseindx, lecture):
+        """Adds lecture to a course if it doesn't already exist, else does nothing.
+            returns: True if lecture was added"""
+        course = self[courseindx]
+        if not course.addLecture(lecture):
+            return False
+
+        self.changed(('lecture', course, lecture))
+        return True
+
+    def setFilename(self, course, lecture, filepath, size=None, etag=None):
+        """Records where a lecture of a course has been downloaded to, or '' if it hasn't.
+            size, etag: of downloaded file, to verify it later"""
+        if self.loaded and course.key in self._index:
+            # Lecture may be a copy e.g. with the variant chosen by 'download -q', the register's own is updated
+            course = self[self._index[course.key]]
+            indx = course.findLecture(lecture.key)
+            if indx != -1:
+                lecture = course.lectures[indx]
+
+        lecture.filename = filepath
+        lecture.size = size
+        lecture.etag = etag
+        self.changed(('filename', course, lecture))
+
+    def iterCourses(self, onlyMissing=False):
+        """Iterates over courses, reading them from file one at a time if not loaded.
+            onlyMissing: only include lectures which haven't been downloaded"""
+        if not self.loaded:
+            return self.storage.courses(onlyMissing)
+        if onlyMissing:
+            return (Storage.missing(course) for course in self)
+        return iter(self)
+
     def docket(self, listLectures=False, onlyMissing=False):
-        print("Register '{}':".format(self.filename))
-        for indx, course in enumerate(self):
-            # Print course info
-            print("  {0} - {1}.".format(indx, course))
-            if len(course.lectures) > 0 and listLectures:
-                # also print lectures
-                for lect in course.lectures:
-                    if not lect.filename or not onlyMissing:
-                        print('\t'+str(lect))
+        docket(self.filename, self.iterCourses(), listLectures, onlyMissing)
 
     def tally(self):
         """Tallys number of lectures and how many are left to download.
             returns: (total, missing)"""
+        if not self.loaded:
+            return self.storage.tally()
+
         missing = 0
         total = 0
         for course in self:
@@ -125,6 +238,26 @@ class Register(list):
         return (total, missing)
 
 
+    # ---- Batched flushing ----
+
+    def changed(self, change):
+        """Records a change, flushing to file if a batch limit has been reached."""
+        self.changes.append(change)
+
+        if self.flushEvery and len(self.changes) >= self.flushEvery:
+            self.flush()
+        elif self.flushInterval and time.monotonic() - self.lastFlush >= self.flushInterval:
+            self.flush()
+
+    @metrics.timed('register.flush')
+    def flush(self):
+        """Writes any unflushed changes to file."""
+        if self.changes and self.storage:
+            self.storage.commit(self if self.loaded else None, self.changes)
+
+        self.changes = []
+        self.lastFlush = time.monotonic()
+
     # NOTE: When called using 'with' keyword, register state is written to file.
     #       This is implemented using '__enter__' and '__exit__' functions,
     #       which are called using the 'with' keyword.
@@ -147,24 +280,24 @@ class Register(list):
 
     def __exit__(self, exc_type, exc_value, traceback):
         # print("\texiting...")
-        # When exiting, write register to file
-        self._write()
+        # When exiting, write changes to file.
+        # Also runs on exceptions (e.g. KeyboardInterrupt, sys.exit) so no progress is lost.
+        # NOTE: Only changes made through Register methods are recorded.
+        self.flush()
 
     # NOTE: '_read', and '_write', implement the loading and saving to file.
     #       These private methods should never be called explicitly from external code.
 
+    @metrics.timed('register.read')
     def _read(self):
         """Loads register from file."""
         # print("\t  read from '" + self.filename + "'")
-        with open(self.filename) as regfile:
-            decoded_json = json.load(regfile, object_hook=decode)
-            if not isinstance(decoded_json, list):
-                return [decoded_json]
-
-            return decoded_json
+        return self.storage.read()
 
+    @metrics.timed('register.write')
     def _write(self):
-        """Writes register to file."""
+        """Writes whole register to file."""
         # print("\t  write to '" + self.filename + "'")
-        with open(self.filename, 'w') as regfile:
-            json.dump(self, regfile, cls=Encoder)
+        self.storage.write(self)
+        self.changes = []
+        self.lastFlush = time.monotonic()
@@ -0,0 +1,192 @@
+"""Schedules downloads: the order lectures are downloaded in, a global bandwidth limit,
+    and a queue which lets an interrupted run carry on where it stopped."""
+
+import os           # Appends to and removes queue file
+import re           # Parses variant targets
+import threading    # Bandwidth is shared by many download threads
+import time         # Refills token bucket
+
+from .data import Course, Lecture
+from .data import fromJSON, toJSON
+from .storage import writeAtomic
+
+# Download order, see order()
+POLICIES = ('register', 'newest', 'smallest', 'chosen')
+
+# Quality downloaded when a lecture has several variants, or a target e.g. '720p', see chooseVariant()
+VARIANT_POLICIES = ('largest', 'smallest')
+VARIANT_TARGET = re.compile(r'^(\d+)(p|k)$')
+
+# Lectures left to download by an interrupted run are kept in '<register>.queue'
+QUEUE_SUFFIX = '.queue'
+
+def order(tasks, policy, sizes=None, chosen=None):
+    """Sorts lectures to download by a policy, ties are kept in register order.
+        tasks: list of (course, lecture)
+        policy: one of POLICIES
+            register: course by course, as listed in the register
+            newest:   most recent lectures first, undated lectures last
+            smallest: smallest files first, using 'sizes', unknown sizes last
+            chosen:   courses in 'chosen' first, in the order they were chosen
+        sizes: file size in bytes, or None if unknown, of each task
+        chosen: list of course keys
+        returns: sorted list of (course, lecture)"""
+    if policy == 'newest':
+        # Dates and times sort as strings e.g. '2017/07/24', '16:12'
+        return sorted(tasks, reverse=True, key=lambda task: (
+            task[1].date is not None, task[1].date or '', task[1].time or ''))
+    elif policy == 'smallest':
+        sized = sorted(zip(tasks, sizes), key=lambda pair: (pair[1] is None, pair[1] or 0))
+        return [task for task, _ in sized]
+    elif policy == 'chosen':
+        rank = {key: indx for indx, key in enumerate(chosen or [])}
+        return sorted(tasks, key=lambda task: rank.get(task[0].key, len(rank)))
+
+    return list(tasks)
+
+def isVariantPolicy(policy):
+    """returns: True if 'policy' is one of VARIANT_POLICIES or a target"""
+    return policy in VARIANT_POLICIES or bool(VARIANT_TARGET.match(policy))
+
+def chooseVariant(variants, policy):
+    """Picks one variant of a lecture by a policy.
+        variants: list of dicts, see Lecture.variants
+        policy: one of VARIANT_POLICIES, or a target
+            largest:  biggest file, the best quality
+            smallest: smallest file
+            <N>p:     height closest to N pixels e.g. '720p'
+            <N>k:     bitrate closest to N kbit/s e.g. '800k'
+            Targets fall back to the largest file if no variant has a height or bitrate,
+            ties go to the larger file
+        returns: variant dict, or None if there are no variants with a link"""
+    variants = [variant for variant in variants or () if variant.get('url')]
+    if not variants:
+        return None
+
+    def size(variant):
+        return variant.get('size') or 0
+
+    if policy == 'smallest':
+        return min(variants, key=size)
+
+    target = VARIANT_TARGET.match(policy or '')
+    if target:
+        field = 'height' if target.group(2) == 'p' else 'bitrate'
+        goal = int(target.group(1)) * (1000 if field == 'bitrate' else 1)
+        known = [variant for variant in variants if variant.get(field)]
+        if known:
+            return min(known, key=lambda variant: (abs(variant[field] - goal), -size(variant)))
+
+    return max(variants, key=size)
+
+class TokenBucket(object):
+    """Limits the combined rate of all downloads to 'rate' bytes per second.
+        Up to 'burst' bytes can be sent at once, by default one second's worth.
+        Safe to share between threads.
+
+        usage:
+            bucket = TokenBucket(2 * 2**20)     # 2 MB/s
+            bucket.consume(len(chunk))          # Blocks until chunk is allowed
+            await asyncio.sleep(bucket.reserve(len(chunk)))     # Same, without blocking"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, nbytes):
+        """Takes 'nbytes' tokens, going into debt if there aren't enough.
+            returns: seconds to wait before sending 'nbytes'"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            self.tokens = self.tokens - nbytes
+            return max(0, -self.tokens / self.rate)
+
+    def consume(self, nbytes):
+        """Waits until 'nbytes' can be sent."""
+        delay = self.reserve(nbytes)
+        if delay:
+            time.sleep(delay)
+
+class DownloadQueue(object):
+    """Ordered list of lectures to download, kept on file until every one has been tried.
+        Each lecture is stored with its course, so the queue can be resumed without
+        reading the register. Completed lectures are marked by appending a line.
+
+        usage:
+            queue = DownloadQueue("register.json.queue")
+            tasks = queue.load() if queue.exists() else queue.create(plannedTasks)
+            for course, lecture in tasks:
+                ...
+                queue.done(course, lecture)
+            queue.remove()      # Once all lectures have been tried"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.positions = {}     # (course key, lecture key): position in queue
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def create(self, tasks):
+        """Saves a new queue of (course, lecture).
+            returns: tasks"""
+        def dump(queuefile):
+            courses = {}
+            for course, lecture in tasks:
+                # Each course is only stored once, lectures refer to it by position
+                if course.key not in courses:
+                    courses[course.key] = len(courses)
+                    header = course.toDict()
+                    header['lectures'] = []
+                    queuefile.write(toJSON({"course": header}) + '\n')
+                queuefile.write(toJSON({"lecture": lecture.toDict(), "of": courses[course.key]}) + '\n')
+
+        writeAtomic(self.filename, dump)
+        self._index(tasks)
+        return tasks
+
+    def load(self):
+        """returns: list of (course, lecture) which haven't been marked as done, in order"""
+        courses = []
+        tasks = []
+        done = set()
+
+        with open(self.filename, encoding='utf-8') as queuefile:
+            for line in queuefile:
+                try:
+                    record = fromJSON(line)
+                except ValueError:
+                    # Torn record from a crash mid-write, skip it
+                    continue
+
+                if "course" in record:
+                    courses.append(Course.fromDict(record["course"]))
+                elif "lecture" in record:
+                    tasks.append((courses[record["of"]], Lecture.fromDict(record["lecture"])))
+                elif "done" in record:
+                    done.add(record["done"])
+
+        self._index(tasks)
+        return [task for indx, task in enumerate(tasks) if indx not in done]
+
+    def _index(self, tasks):
+        self.positions = {
+            (course.key, lecture.key): indx for indx, (course, lecture) in enumerate(tasks)
+        }
+
+    def done(self, course, lecture):
+        """Marks a lecture as downloaded, so it's skipped if the queue is resumed."""
+        with open(self.filename, 'a', encoding='utf-8') as queuefile:
+            queuefile.write(toJSON({"done": self.positions[(course.key, lecture.key)]}) + '\n')
+            queuefile.flush()
+            getattr(os, 'fdatasync', os.fsync)(queuefile.fileno())
+
+    def remove(self):
+        if self.exists():
+            os.remove(self.filename)
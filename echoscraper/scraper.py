@@ -1,120 +1,308 @@
-"""Builds and updates register file by scraping echo360 for lecture recordings."""
+"""Builds and updates register file by scraping echo360 for lecture recordings.
+    Options:
+        -j N: Fetches N course syllabuses in parallel [j]obs, default 4
+        -r: [r]efreshes everything, ignoring pages cached by previous scrapes
+        -l: Forces a fresh [l]ogin instead of resuming the previous session
+        -a: Runs on a single [a]synchronous event loop, with up to N connections from -j"""
 
 import json                     # parses syllabus json data
-from lxml import html           # parses html
+from lxml import etree          # parses html
 import re                       # string parsing
 
-from .echo360login import Echo360login
+import requests.adapters        # Sizes connection pool for parallel syllabus fetches
+import requests.exceptions as rEx
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime   # Parses lesson times
+
+from . import metrics
+from .cache import ResponseCache
+from .echo360login import Echo360login, ECHO360_URL, SESSION_FILE
 from .data import Course, Lecture
-from .register import Register
+from .register import Register, FLUSH_EVERY, FLUSH_INTERVAL
+from .scheduler import chooseVariant
+
+# Number of course syllabuses fetched at once
+JOBS = 4
+
+# Pages from previous scrapes are cached in '<register>.cache'
+CACHE_SUFFIX = '.cache'
 
-def start(arguments, options):
-    # Module takes no options
-    LectureSpider(arguments[0]).run()
+def start(arguments, options, **client):
+    """Begins scraper.
+        client: 'sessionfile', 'credentials', 'streams' and 'interactive' for LectureSpider, see batch
+        returns: True if scrape completed"""
+    jobs = options.get('j', JOBS)
+    if jobs < 1:
+        print("Option '-j' must be a positive number.")
+        return
+
+    if 'a' in options:
+        # Only imported when wanted, as it needs aiohttp
+        import asyncio
+        from . import asyncclient
+        if asyncclient.available():
+            asyncio.run(asyncclient.AsyncLectureSpider(arguments[0], jobs).run('r' in options, 'l' in options))
+        return
+
+    return LectureSpider(arguments[0], jobs, **client).run('r' in options, 'l' in options)
 
 class LectureSpider(Echo360login):
-    def __init__(self, regname):
-        super().__init__()
+    def __init__(self, regname, jobs=JOBS, sessionfile=SESSION_FILE, credentials=None, streams=None,
+                 interactive=True):
+        super().__init__(sessionfile, credentials, interactive)
         self.regname = regname
+        self.jobs = jobs
+        # Semaphore shared with other processes, held while fetching a page
+        self.streams = streams if streams is not None else nullcontext()
+        self.register = None
+        self.cache = ResponseCache(regname + CACHE_SUFFIX)
 
-    def run(self):
-        if not self.login():
-            return
-        
-        self.scrape_courselist()
+    def run(self, refresh=False, fresh=False):
+        """returns: True if scrape completed"""
+        if not self.login(fresh):
+            return False
 
-        for indx, course in enumerate(Register(self.regname)):
-            print("Scraping lectures for '{}'...".format(course.name))
-            self.scrape_course_lectures(indx)
+        # Register is read once and kept for the whole run, changes are flushed in batches
+        self.register = Register(self.regname, FLUSH_EVERY, FLUSH_INTERVAL)
+
+        if refresh or not self.register.exists:
+            # Cached pages are only skipped if they've already been scraped into the register
+            self.cache.clear()
+
+        # Syllabuses are fetched in parallel, sharing the logged in session
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.jobs, pool_maxsize=self.jobs)
+        self.sesh.mount('https://', adapter)
+
+        self.scrape()
+        print("Page cache: {}".format(self.cache.summary()))
 
         print("\nBuilt ", end='')
-        Register(self.regname).docket()
+        self.register.docket()
         print("\nRun 'echoscraper download {}' to begin downloading.".format(self.regname))
+        return True
 
-    def scrape_courselist(self):
-        """Scrapes links to all courses with available lectures."""
+    def scrape(self):
+        """Scrapes the course list and every course's syllabus into the register.
+            returns: list of (course, lecture) added to the register"""
+        added = []
+        with self.register:
+            self.scrape_courselist()
 
-        def scrape_course_data():
-            """Scrapes metadata for echo360 course."""
-            # Get course name, year, and semesters
-            title = row.xpath(".//div[@class='info-main']")[0]
-            
-            coursename = title.xpath("./h2/text()")[0]
-
-            # Teaching period needs to be parsed i.e. "3720 - 2017 Semester 1"
-            teachingperiod = title.xpath("./h3/text()")[0]
-            groups = re.search(r"\d+ - (\d+) Semester (\d)", teachingperiod)
-            courseyear = int(groups.group(1))
-            coursesemester = int(groups.group(2))
-
-            courseSyllabusLink = "https://echo360.org.au" + re.sub('home', 'syllabus', row.xpath("./div/a/@href")[0])
-
-            # Create a Course object and write to file using Register class
-            return Course(
-                coursename,
-                courseSyllabusLink,
-                courseyear,
-                coursesemester
-            )
+            with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                results = list(pool.map(self.scrape_course_lectures, list(self.register)))
 
+            # Merge all lectures into register in one pass
+            for indx, lectures in enumerate(results):
+                for lect in lectures:
+                    if self.register.appendLecture(indx, lect):
+                        added.append((self.register[indx], lect))
+
+        # Only save cache once its pages are safely in the register
+        self.cache.save()
+        return added
+
+    @metrics.timed('scrape.courselist')
+    def scrape_courselist(self):
+        """Scrapes links to all courses with available lectures."""
         print("Scraping course metadata...")
 
         # Request list of courses
-        response = self.sesh.get("https://echo360.org.au/home")
-        tree = html.fromstring(response.text)
+        with self.streams:
+            text, changed = self.cache.get(self.sesh, ECHO360_URL + "/home")
+        if not changed:
+            print("Course list unchanged since last scrape.")
+            return
+
+        for course in parse_courselist(text):
+            self.register.appendIfMissing(course)
 
-        rows = tree.xpath(".//div[@class='home-content-main']/div")
+    @metrics.timed('scrape.syllabus')
+    def scrape_course_lectures(self, course):
+        """Downloads JSON structure containing lecture metadata and download links.
+            Safe to run in parallel, as the register isn't modified.
+            returns: list of Lecture objects in course syllabus"""
+        # Download JSON encoded syllabus for the course
+        try:
+            with self.streams:
+                text, changed = self.cache.get(self.sesh, course.courselink)
+            if not changed:
+                print("Lectures for '{}' unchanged since last scrape.".format(course.name))
+                return []
 
-        for row in rows:
-            # Scrape course information into Course object
-            course = scrape_course_data()
+            print("Scraping lectures for '{}'...".format(course.name))
+            return parse_syllabus(text)
+        except (rEx.RequestException, ValueError) as err:
+            print("Couldn't scrape lectures for '{0}': {1}".format(course.name, err))
+            self.cache.forget(course.courselink)
+            return []
 
-            with Register(self.regname) as reg:
-                reg.appendIfMissing(course)
+# NOTE: Parsing is kept apart from fetching, so it's shared with asyncclient.
 
-    def scrape_course_lectures(self, courseindx):
-        """Downloads JSON structure containing lecture metadata and download links."""
-        # Download JSON encoded syllabus for the course
-        link = Register(self.regname)[courseindx].courselink
-        response = self.sesh.get(link)
-        
-        syllabus_json = json.loads(response.text)
-
-        for lect_syllabus in syllabus_json["data"]:
-            try:
-                start_time = lect_syllabus["lesson"]["lesson"]["timing"]["start"]
-            except KeyError:
-                # Lecture has no start date or time
-                date = None
-                time = None
-            else:
-                # Times looks like this (2017-07-24)T(16:12):00.000
-                times = re.search(r'(\d+-\d{2}-\d{2})T(\d{2}:\d{2}):\d+.\d+', start_time)
-                date = re.sub('-', '/', times.group(1))
-                time = times.group(2)
-
-            # Scrape download link for largest file size video
-            try:
-                links = lect_syllabus["lesson"]["video"]["media"]["media"]["current"]['primaryFiles']
-            except KeyError:
-                # Lecture has no video, skip
-                continue
-
-            size = 0
-            for link in links:
-                if link["size"] > size:
-                    link["size"] = size
-                    dllink = link["s3Url"]
-
-            lect = Lecture(
-                lect_syllabus["lesson"]["lesson"]["displayName"],
-                date,
-                time,
-                dllink
-            )
-
-            with Register(self.regname) as reg:
-                if lect not in reg[courseindx].lectures:
-                    reg[courseindx].lectures.append(lect)
+@metrics.timed('parse.courselist')
+def parse_courselist(text):
+    """Scrapes metadata of all courses listed on the Echo360 home page.
+        The page is streamed through a parser target, which picks out course rows
+        as they're parsed, so no tree is built for the rest of the page.
+        returns: list of Course objects"""
+    parser = etree.HTMLParser(target=CourseListTarget())
+    parser.feed(text)
+    return parser.close()
+
+class CourseListTarget(object):
+    """lxml parser target, collecting a Course for each row of the home page's course list.
+        A row is a 'div' directly inside 'div.home-content-main', which holds
+            - the course link, in the first 'a' inside one of the row's own 'div's
+            - 'div.info-main', holding the course name in 'h2' and teaching period in 'h3'
+        Rows missing any of these aren't courses, and are skipped."""
+
+    def __init__(self):
+        self.depth = 0          # Number of open elements
+        self.main = None        # Depth of 'div.home-content-main'
+        self.row = None         # Depth of current row, and fields found in it
+        self.fields = {}
+        self.rowDiv = None      # Depth of the row's own 'div' being parsed
+        self.info = None        # Depth of row's 'div.info-main'
+        self.capture = None     # Field being read from a heading's text
+        self.courses = []
+
+    def start(self, tag, attrib):
+        self.depth = self.depth + 1
+        # Only a heading's first text counts, which ends at its first child
+        self.capture = None
+
+        if self.row is None:
+            if self.main is None:
+                if tag == 'div' and attrib.get('class') == 'home-content-main':
+                    self.main = self.depth
+            elif tag == 'div' and self.depth == self.main + 1:
+                self.row = self.depth
+                self.fields = {}
+            return
+
+        if tag == 'div':
+            if self.depth == self.row + 1:
+                self.rowDiv = self.depth
+            if self.info is None and 'info' not in self.fields and attrib.get('class') == 'info-main':
+                self.info = self.depth
+                self.fields['info'] = True
+        elif tag == 'a':
+            if self.rowDiv is not None and self.depth == self.rowDiv + 1 and 'href' not in self.fields:
+                href = attrib.get('href')
+                if href is not None:
+                    self.fields['href'] = href
+        elif tag in HEADINGS and self.info is not None and self.depth == self.info + 1:
+            if HEADINGS[tag] not in self.fields:
+                self.capture = HEADINGS[tag]
+                self.fields[self.capture] = ''
+
+    def data(self, text):
+        if self.capture:
+            self.fields[self.capture] = self.fields[self.capture] + text
+
+    def end(self, tag):
+        self.capture = None
+
+        # 'div.info-main' can also be one of the row's own 'div's
+        if self.depth == self.info:
+            self.info = None
+        if self.depth == self.rowDiv:
+            self.rowDiv = None
+
+        if self.depth == self.row:
+            self.finishRow()
+            self.row = None
+        elif self.depth == self.main:
+            self.main = None
+
+        self.depth = self.depth - 1
+
+    def finishRow(self):
+        """Adds a Course for the row which just ended, if it had every field."""
+        fields = self.fields
+        if not (fields.get('href') and fields.get('name') and fields.get('period')):
+            return
+
+        # Teaching period needs to be parsed i.e. "3720 - 2017 Semester 1"
+        groups = TEACHING_PERIOD.search(fields['period'])
+        if not groups:
+            return
+
+        self.courses.append(Course(
+            fields['name'],
+            ECHO360_URL + fields['href'].replace('home', 'syllabus'),
+            int(groups.group(1)),
+            int(groups.group(2))
+        ))
+
+    def close(self):
+        return self.courses
+
+# Headings of 'div.info-main', and the field they hold
+HEADINGS = {'h2': 'name', 'h3': 'period'}
+
+TEACHING_PERIOD = re.compile(r"\d+ - (\d+) Semester (\d)")
+
+def duration(timing):
+    """returns: seconds from a lesson's scheduled start to its end, roughly the length of
+        its recording, or None if either is unknown"""
+    try:
+        start, end = (datetime.strptime(timing[field][:19], '%Y-%m-%dT%H:%M:%S') for field in ('start', 'end'))
+    except (KeyError, TypeError, ValueError):
+        return None
+    seconds = (end - start).total_seconds()
+    return seconds if seconds > 0 else None
+
+@metrics.timed('parse.syllabus')
+def parse_syllabus(text):
+    """Scrapes lecture metadata and download links from a course's JSON syllabus.
+        returns: list of Lecture objects
+        raises: ValueError if syllabus isn't valid JSON"""
+    syllabus_json = json.loads(text)
+
+    lectures = []
+
+    for lect_syllabus in syllabus_json["data"]:
+        timing = lect_syllabus["lesson"]["lesson"].get("timing") or {}
+        try:
+            start_time = timing["start"]
+        except KeyError:
+            # Lecture has no start date or time
+            date = None
+            time = None
+        else:
+            # Times looks like this (2017-07-24)T(16:12):00.000
+            times = re.search(r'(\d+-\d{2}-\d{2})T(\d{2}:\d{2}):\d+.\d+', start_time)
+            date = re.sub('-', '/', times.group(1))
+            time = times.group(2)
+
+        # Every quality the lecture was encoded in
+        try:
+            links = lect_syllabus["lesson"]["video"]["media"]["media"]["current"]['primaryFiles']
+        except KeyError:
+            # Lecture has no video, skip
+            continue
+
+        seconds = duration(timing)
+        variants = [{
+            "url": link["s3Url"],
+            "size": link.get("size"),
+            "width": link.get("width"),
+            "height": link.get("height"),
+            "bitrate": int(link["size"] * 8 / seconds) if link.get("size") and seconds else None,
+        } for link in links if link.get("s3Url")]
+
+        # Download link is the largest file, others can be chosen with 'download -q'
+        best = chooseVariant(variants, 'largest')
+        if best is None:
+            continue
 
+        lectures.append(Lecture(
+            lect_syllabus["lesson"]["lesson"]["displayName"],
+            date,
+            time,
+            best["url"],
+            variants=variants
+        ))
 
+    return lectures
@@ -0,0 +1,530 @@
+"""Storage engines used by the register to r/w courses and lectures.
+
+    Engine is chosen by the register's file extension:
+        .db, .sqlite, .sqlite3: SQLiteStorage, indexed tables of courses and lectures
+        .jsonl:                 JSONLinesStorage, append-only JSON records, one per line
+        anything else:          JSONStorage, a single JSON document"""
+
+import json
+import os
+import tempfile
+
+from .data import Course, Lecture
+from .data import dumps, loads, fromJSON, toJSON, iterloads
+
+SQLITE_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+JSONL_EXTENSIONS = ('.jsonl',)
+
+# Changes to JSON registers are appended to '<register>.journal'...
+JOURNAL_SUFFIX = '.journal'
+JOURNAL_LIMIT = 2**20   # ...which is compacted into the register once it's this many bytes
+
+# JSON Lines registers are compacted once they hold this many times more records than courses
+COMPACT_RATIO = 4
+COMPACT_MIN = 64        # ...and at least this many records
+
+def writeAtomic(filename, dump, mode=None):
+    """Writes to a file by calling 'dump' with a temporary file, which then replaces it.
+        A crash mid-write therefore never leaves a truncated file behind.
+        mode: permissions of written file, by default those of the file being replaced"""
+    path = os.path.abspath(filename)
+    fd, tmpname = tempfile.mkstemp(
+        prefix='.' + os.path.basename(path) + '.',
+        suffix='.tmp',
+        dir=os.path.dirname(path)
+    )
+
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as tmpfile:
+            dump(tmpfile)
+            tmpfile.flush()
+            os.fsync(tmpfile.fileno())
+
+        if mode is None:
+            # Keep permissions of the file being replaced
+            try:
+                mode = os.stat(path).st_mode
+            except FileNotFoundError:
+                mode = 0o644
+        os.chmod(tmpname, mode)
+
+        os.replace(tmpname, path)
+    except BaseException:
+        # Don't leave temporary files lying around
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+        raise
+
+def mergeCourse(course, other, replace=False):
+    """Merges lectures of 'other' into 'course'.
+        replace: if 'other' is newer, its download state replaces that of 'course',
+                 otherwise only recorded filenames are merged"""
+    for lect in other.lectures:
+        indx = course.findLecture(lect.key)
+        if indx == -1:
+            course.addLecture(lect)
+        elif lect.filename or replace:
+            existing = course.lectures[indx]
+            existing.filename = lect.filename
+            existing.size = lect.size
+            existing.etag = lect.etag
+
+def applyChange(course, change):
+    """Applies a change, see Storage.commit(), to a course with the same key."""
+    if change[0] == 'course':
+        mergeCourse(course, change[1])
+    elif change[0] == 'lecture':
+        course.addLecture(change[2])
+    elif change[0] == 'filename':
+        mergeCourse(course, Course(lectures=[change[2]]), replace=True)
+
+def replay(courses, changes):
+    """Streams courses with a list of changes applied.
+        Replaying changes which have already been applied does nothing.
+        returns: iterator of Course objects, courses added by 'changes' last"""
+    # Course key: changes made to course, in order
+    pending = {}
+    for change in changes:
+        pending.setdefault(change[1].key, []).append(change)
+
+    for course in courses:
+        for change in pending.pop(course.key, ()):
+            applyChange(course, change)
+        yield course
+
+    # Remaining courses are new
+    for courseChanges in pending.values():
+        first = courseChanges[0][1]
+        course = Course(first.name, first.courselink, first.year, first.semester)
+        for change in courseChanges:
+            applyChange(course, change)
+        yield course
+
+def openStorage(filename):
+    """Returns storage engine for a given register filename."""
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in SQLITE_EXTENSIONS:
+        return SQLiteStorage(filename)
+    if extension in JSONL_EXTENSIONS:
+        return JSONLinesStorage(filename)
+
+    return JSONStorage(filename)
+
+class Storage(object):
+    """Base storage engine.
+        Engines must implement 'read' and 'write', everything else has a default
+        implementation built on top of them which engines can override with
+        something faster.
+        'write' may be passed any iterable of courses, including one which is
+        lazily reading from this storage."""
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def read(self):
+        """Returns list of all Course objects in storage."""
+        raise NotImplementedError
+
+    def write(self, courses):
+        """Replaces storage contents with a list of Course objects."""
+        raise NotImplementedError
+
+    def commit(self, courses, changes):
+        """Saves a list of changes made to 'courses'.
+            changes: list of tuples, one of
+                ('course', course):            course was added
+                ('lecture', course, lecture):  lecture was added to course
+                ('filename', course, lecture): lecture's filename was set
+            courses: None if the register isn't held in memory, changes are then
+                     applied to storage while streaming through it"""
+        if courses is None:
+            courses = replay(self.courses(), changes)
+        self.write(courses)
+
+    def courses(self, onlyMissing=False):
+        """Iterates over Course objects in storage.
+            onlyMissing: only include lectures which haven't been downloaded"""
+        for course in self.read():
+            yield self.missing(course) if onlyMissing else course
+
+    @staticmethod
+    def missing(course):
+        """Returns copy of course with only the lectures which haven't been downloaded."""
+        return Course(
+            course.name, course.courselink, course.year, course.semester,
+            [lect for lect in course.lectures if not lect.filename]
+        )
+
+    def tally(self):
+        """Tallys number of lectures and how many are left to download.
+            returns: (total, missing)"""
+        missing = 0
+        total = 0
+        for course in self.courses():
+            for lecture in course.lectures:
+                if lecture.dllink:
+                    total = total + 1
+                    if not lecture.filename:
+                        missing = missing + 1
+
+        return (total, missing)
+
+class JSONStorage(Storage):
+    """Stores register as a single JSON document.
+        Queries, and writes of courses which aren't in memory, stream one course at a time.
+        Changes are appended to a journal beside the register, which is replayed when
+        reading, and compacted into the register once it passes JOURNAL_LIMIT."""
+
+    def __init__(self, filename):
+        super().__init__(filename)
+        self.journal = filename + JOURNAL_SUFFIX
+
+    def read(self):
+        # Whole register is wanted, decoding in one go is fastest
+        with open(self.filename, encoding='utf-8') as regfile:
+            courses = loads(regfile.read())
+
+        changes = self.readJournal()
+        if changes:
+            courses = list(replay(courses, changes))
+        return courses
+
+    def commit(self, courses, changes):
+        with open(self.journal, 'ab+') as journal:
+            if journal.seek(0, os.SEEK_END):
+                journal.seek(-1, os.SEEK_END)
+                if journal.read(1) != b'\n':
+                    # Last record was torn by a crash, keep it on a line of its own
+                    journal.write(b'\n')
+
+            journal.write(''.join(self._journalRecord(change) for change in changes).encode())
+            journal.flush()
+            # Only the data needs to be durable, not metadata such as access times
+            getattr(os, 'fdatasync', os.fsync)(journal.fileno())
+
+            size = journal.tell()
+
+        if size >= JOURNAL_LIMIT:
+            self.compact(courses)
+
+    def compact(self, courses=None):
+        """Rewrites register with the journal applied, then deletes the journal.
+            courses: the register if it's held in memory, saves reading it again"""
+        self.write(courses if courses is not None else self.courses())
+
+    @staticmethod
+    def _journalRecord(change):
+        course = change[1]
+        if change[0] == 'course':
+            dct = course.toDict()
+        else:
+            # Course is only needed to identify it, leave out its lectures
+            dct = {
+                "name": course.name,
+                "courselink": course.courselink,
+                "year": course.year,
+                "semester": course.semester,
+                "lectures": [],
+            }
+
+        record = {"change": change[0], "course": dct}
+        if len(change) > 2:
+            record["lecture"] = change[2].toDict()
+        return toJSON(record) + '\n'
+
+    def readJournal(self):
+        """returns: list of changes recorded in journal"""
+        changes = []
+        try:
+            journal = open(self.journal, encoding='utf-8')
+        except FileNotFoundError:
+            return changes
+
+        with journal:
+            for line in journal:
+                try:
+                    record = fromJSON(line)
+                except ValueError:
+                    # Torn record from a crash mid-write, skip it
+                    continue
+
+                change = (record["change"], Course.fromDict(record["course"]))
+                if "lecture" in record:
+                    change = change + (Lecture.fromDict(record["lecture"]),)
+                changes.append(change)
+
+        return changes
+
+    def write(self, courses):
+        def dump(regfile):
+            if isinstance(courses, list):
+                regfile.write(dumps(courses))
+                return
+
+            regfile.write('[')
+            for indx, course in enumerate(courses):
+                if indx:
+                    regfile.write(', ')
+                regfile.write(toJSON(course.toDict()))
+            regfile.write(']')
+
+        writeAtomic(self.filename, dump)
+
+        # Register now holds everything in the journal.
+        # (If interrupted before this, replaying the journal again changes nothing)
+        if os.path.exists(self.journal):
+            os.remove(self.journal)
+
+    def courses(self, onlyMissing=False):
+        changes = self.readJournal()
+        with open(self.filename, encoding='utf-8') as regfile:
+            for course in replay(iterloads(regfile), changes):
+                yield self.missing(course) if onlyMissing else course
+
+class JSONLinesStorage(Storage):
+    """Stores register as JSON Lines, one record per line.
+        Each record holds a course, and some or all of its lectures:
+            {"key": [name, year, semester, courselink], "course": {...}}
+        Changes are saved by appending a record with just the changed lectures,
+        later records of a course are merged into earlier ones.
+        The file is rewritten with one record per course once it has grown too large."""
+
+    def __init__(self, filename):
+        super().__init__(filename)
+        self.records = None     # Number of records in file, None until counted
+        self.live = None        # Number of distinct courses in file
+
+    def scan(self):
+        """Finds the records of each course, without decoding their lectures.
+            returns: dict of course key: list of record offsets, in order of first record"""
+        decoder = json.JSONDecoder()
+        offsets = {}
+        records = 0
+
+        with open(self.filename, 'rb') as regfile:
+            offset = 0
+            for line in regfile:
+                if line.strip():
+                    # Key is written first, so only it needs decoding
+                    text = line.decode()
+                    key, _ = decoder.raw_decode(text, text.index('['))
+                    offsets.setdefault(tuple(key), []).append(offset)
+                    records = records + 1
+                offset = offset + len(line)
+
+        self.records = records
+        self.live = len(offsets)
+        return offsets
+
+    @staticmethod
+    def _record(course, lectures):
+        dct = course.toDict()
+        dct['lectures'] = [lect.toDict() for lect in lectures]
+        return toJSON({"key": list(course.key), "course": dct}) + '\n'
+
+    def read(self):
+        return list(self.courses())
+
+    def write(self, courses):
+        def dump(regfile):
+            live = 0
+            for course in courses:
+                regfile.write(self._record(course, course.lectures))
+                live = live + 1
+            self.records = self.live = live
+
+        writeAtomic(self.filename, dump)
+
+    def commit(self, courses, changes):
+        if self.records is None:
+            self.scan()
+
+        # Course key: (course, changed lectures), in order of first change
+        records = {}
+        for change in changes:
+            course, lectures = records.setdefault(change[1].key, (change[1], {}))
+            if change[0] == 'course':
+                lectures.update(dict.fromkeys(course.lectures))
+            else:
+                lectures[change[2]] = None
+
+        with open(self.filename, 'a', encoding='utf-8') as regfile:
+            for course, lectures in records.values():
+                regfile.write(self._record(course, lectures))
+            regfile.flush()
+            os.fsync(regfile.fileno())
+
+        self.records = self.records + len(records)
+        self.live = self.live + sum(1 for change in changes if change[0] == 'course')
+
+        if self.records > max(COMPACT_MIN, COMPACT_RATIO * self.live):
+            self.compact()
+
+    def compact(self):
+        """Rewrites file with a single record for each course."""
+        self.write(self.courses())
+
+    def courses(self, onlyMissing=False):
+        offsets = self.scan()
+        with open(self.filename, 'rb') as regfile:
+            for recordOffsets in offsets.values():
+                course = None
+                for offset in recordOffsets:
+                    regfile.seek(offset)
+                    record = Course.fromDict(fromJSON(regfile.readline())['course'])
+                    if course is None:
+                        course = record
+                    else:
+                        mergeCourse(course, record, replace=True)
+
+                yield self.missing(course) if onlyMissing else course
+
+class SQLiteStorage(Storage):
+    """Stores register in indexed SQLite tables.
+        Changes are saved by updating single rows instead of rewriting the register."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS courses (
+            id          INTEGER PRIMARY KEY,
+            name        TEXT NOT NULL,
+            courselink  TEXT NOT NULL,
+            year        INTEGER NOT NULL,
+            semester    INTEGER NOT NULL,
+            UNIQUE (name, year, semester, courselink)
+        );
+        CREATE TABLE IF NOT EXISTS lectures (
+            id          INTEGER PRIMARY KEY,
+            course      INTEGER NOT NULL REFERENCES courses (id),
+            name        TEXT NOT NULL,
+            date        TEXT NOT NULL,
+            time        TEXT NOT NULL,
+            dllink      TEXT NOT NULL,
+            filename    TEXT NOT NULL DEFAULT '',
+            size        INTEGER,
+            etag        TEXT,
+            variants    TEXT,
+            UNIQUE (course, name, date, time)
+        );
+        CREATE INDEX IF NOT EXISTS lectures_missing
+            ON lectures (course) WHERE filename = '';
+        CREATE INDEX IF NOT EXISTS lectures_state
+            ON lectures (dllink, filename);
+    """
+
+    def __init__(self, filename):
+        super().__init__(filename)
+        self._db = None
+        self._courseids = {}
+
+    @property
+    def db(self):
+        """Connection to database, created on first use."""
+        if self._db is None:
+            import sqlite3  # Only imported when wanted, most registers aren't SQLite
+            self._db = sqlite3.connect(self.filename)
+            self._db.executescript(self.SCHEMA)
+
+            # Registers created before lectures recorded their size, ETag and variants
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(lectures)")]
+            with self._db:
+                for column, kind in (('size', 'INTEGER'), ('etag', 'TEXT'), ('variants', 'TEXT')):
+                    if column not in columns:
+                        self._db.execute("ALTER TABLE lectures ADD COLUMN {0} {1}".format(column, kind))
+        return self._db
+
+    # NOTE: SQL has no equality for NULL, so missing dates and times are stored as ''.
+    #       Variants are only read along with their lecture, so they're kept as JSON.
+
+    @staticmethod
+    def _lectureRow(lect):
+        return (lect.name, lect.date or '', lect.time or '', lect.dllink or '', lect.filename or '',
+                lect.size, lect.etag, toJSON(lect.variants) if lect.variants else None)
+
+    @staticmethod
+    def _lecture(row):
+        name, date, time, dllink, filename, size, etag, variants = row
+        return Lecture(name, date or None, time or None, dllink, filename, size, etag,
+                       fromJSON(variants) if variants else None)
+
+    def _courseid(self, course):
+        """Returns row id of a course, inserting it if it doesn't exist."""
+        key = (course.name, course.year, course.semester, course.courselink)
+        if key not in self._courseids:
+            self.db.execute(
+                "INSERT OR IGNORE INTO courses (name, year, semester, courselink) VALUES (?, ?, ?, ?)",
+                key
+            )
+            self._courseids[key] = self.db.execute(
+                "SELECT id FROM courses WHERE name = ? AND year = ? AND semester = ? AND courselink = ?",
+                key
+            ).fetchone()[0]
+
+        return self._courseids[key]
+
+    def _addLecture(self, courseid, lect):
+        self.db.execute(
+            "INSERT OR IGNORE INTO lectures (course, name, date, time, dllink, filename, size, etag, variants) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (courseid, *self._lectureRow(lect))
+        )
+
+    def _setFilename(self, courseid, lect):
+        self.db.execute(
+            "UPDATE lectures SET filename = ?, size = ?, etag = ? "
+            "WHERE course = ? AND name = ? AND date = ? AND time = ?",
+            (lect.filename or '', lect.size, lect.etag, courseid, lect.name, lect.date or '', lect.time or '')
+        )
+
+    def read(self):
+        return list(self.courses())
+
+    def write(self, courses):
+        with self.db:
+            for course in courses:
+                courseid = self._courseid(course)
+                for lect in course.lectures:
+                    self._addLecture(courseid, lect)
+                    self._setFilename(courseid, lect)
+
+    def commit(self, courses, changes):
+        with self.db:
+            for change in changes:
+                courseid = self._courseid(change[1])
+                if change[0] == 'course':
+                    # Course may have been added with its lectures
+                    for lect in change[1].lectures:
+                        self._addLecture(courseid, lect)
+                        self._setFilename(courseid, lect)
+                elif change[0] == 'lecture':
+                    self._addLecture(courseid, change[2])
+                elif change[0] == 'filename':
+                    self._setFilename(courseid, change[2])
+
+    def courses(self, onlyMissing=False):
+        if not self.exists():
+            raise FileNotFoundError(self.filename)
+
+        query = "SELECT name, date, time, dllink, filename, size, etag, variants FROM lectures WHERE course = ?"
+        if onlyMissing:
+            query = query + " AND filename = ''"
+        query = query + " ORDER BY id"
+
+        rows = self.db.execute(
+            "SELECT id, name, courselink, year, semester FROM courses ORDER BY id"
+        ).fetchall()
+        for courseid, name, courselink, year, semester in rows:
+            self._courseids[(name, year, semester, courselink)] = courseid
+            lectures = [self._lecture(row) for row in self.db.execute(query, (courseid,))]
+            yield Course(name, courselink, year, semester, lectures)
+
+    def tally(self):
+        if not self.exists():
+            raise FileNotFoundError(self.filename)
+
+        total, missing = self.db.execute(
+            "SELECT COUNT(*), TOTAL(filename = '') FROM lectures WHERE dllink != ''"
+        ).fetchone()
+        return (total, int(missing))
@@ -0,0 +1,283 @@
+"""Stores each lecture video once, however many cross-listed courses it appears in.
+    Downloads are indexed by the video behind their download link, so a lecture which is
+    already on disk is linked into another course's folder instead of being downloaded again."""
+
+import json         # Index file format
+import os           # Links files
+import threading    # Index is shared by parallel downloads
+from urllib.parse import urlsplit
+
+from .storage import writeAtomic
+
+# Downloads are stored under this folder, and indexed in a hidden file inside it
+LECTURES_DIR = 'lectures'
+STORE_FILE = os.path.join(LECTURES_DIR, '.store')
+
+LINK_SUFFIX = '.link'   # Appended to a link while it's made, so it replaces a file atomically
+
+# Linux ioctl which clones a whole file, sharing its blocks until either copy is changed
+FICLONE = 0x40049409
+
+def mediaKey(dllink):
+    """returns: identity of the video behind a download link, or None if there's no link.
+        This is its host and path, i.e. an S3 bucket and object key, without the query
+        string, as pre-signed links to the same object differ only in their signature."""
+    if not dllink:
+        return None
+    parts = urlsplit(dllink)
+    return parts.netloc + parts.path
+
+def downloadedKey(lecture):
+    """returns: 'mediaKey' of the video in a downloaded lecture's file, or None if it can't be told.
+        The register keeps the largest variant's link even when '-q' chose another, so a lecture
+        with several variants is matched to the variant with the size of its file."""
+    variants = lecture.variants or ()
+    if len(variants) < 2:
+        return mediaKey(lecture.dllink)
+
+    if lecture.size is not None:
+        for variant in variants:
+            if variant.get('size') == lecture.size:
+                return mediaKey(variant.get('url'))
+    return None
+
+def linkFile(source, target):
+    """Makes 'target' share the data of 'source', replacing 'target' if it exists.
+        A hardlink is tried first, then a reflink on filesystems which can't hardlink.
+        returns: 'hardlink' or 'reflink', or None if neither is possible, e.g. across devices"""
+    temp = target + LINK_SUFFIX
+    try:
+        os.remove(temp)
+    except FileNotFoundError:
+        pass
+
+    try:
+        os.link(source, temp)
+        method = 'hardlink'
+    except OSError:
+        if not reflink(source, temp):
+            return None
+        method = 'reflink'
+
+    os.replace(temp, target)
+    return method
+
+def reflink(source, target):
+    """Clones 'source' into new file 'target', e.g. on Btrfs or XFS.
+        returns: True if clone was made"""
+    try:
+        import fcntl    # Not available on Windows
+    except ImportError:
+        return False
+
+    try:
+        with open(source, 'rb') as src, open(target, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except OSError:
+        try:
+            os.remove(target)
+        except FileNotFoundError:
+            pass
+        return False
+    return True
+
+class ContentStore(object):
+    """Index of downloaded videos, by 'mediaKey' of their download link.
+        Entries hold the file's path, size and the server's ETag, and are only trusted
+        while the file is still on disk with the same size.
+
+        usage:
+            store = ContentStore()
+            stored = store.claim(lecture)   # Waits while another thread downloads the same video
+            try:
+                if not (stored and linkFile(stored['path'], filepath)):
+                    ...download to filepath...
+                    store.add(lecture, filepath, size, etag)
+            finally:
+                store.release(lecture)
+            store.save()"""
+
+    def __init__(self, filename=STORE_FILE):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.changed = False
+        self.pending = {}   # Key: Event set once the thread downloading that video is done
+
+        try:
+            with open(filename, encoding='utf-8') as storefile:
+                self.entries = json.load(storefile)
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+
+    def find(self, lecture):
+        """returns: entry of the stored video behind 'lecture', or None if it isn't stored"""
+        key = mediaKey(lecture.dllink)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        try:
+            size = os.path.getsize(entry['path'])
+        except OSError:
+            size = None
+
+        if size is None or (entry['size'] is not None and size != entry['size']):
+            # File has been moved, deleted or truncated since
+            with self.lock:
+                if self.entries.pop(key, None) is not None:
+                    self.changed = True
+            return None
+        return entry
+
+    def claim(self, lecture):
+        """Claims the video behind 'lecture' for this thread, until 'release' is called.
+            Waits while another thread holds it, so the same video isn't downloaded twice at once.
+            returns: entry of the stored video, or None if it should be downloaded"""
+        key = mediaKey(lecture.dllink)
+        if key is None:
+            return None
+
+        while True:
+            with self.lock:
+                downloading = self.pending.get(key)
+                if downloading is None:
+                    self.pending[key] = threading.Event()
+                    break
+            downloading.wait()
+
+        return self.find(lecture)
+
+    def release(self, lecture):
+        """Releases the video behind 'lecture', claimed by 'claim'."""
+        with self.lock:
+            downloading = self.pending.pop(mediaKey(lecture.dllink), None)
+        if downloading is not None:
+            downloading.set()
+
+    def add(self, lecture, filepath, size=None, etag=None, key=None):
+        """Records 'filepath' as holding the video behind 'lecture'.
+            key: 'mediaKey' of the video, by default that of the lecture's download link"""
+        key = key or mediaKey(lecture.dllink)
+        if key is None:
+            return
+        with self.lock:
+            self.entries[key] = {'path': filepath, 'size': size, 'etag': etag}
+            self.changed = True
+
+    def addDownloaded(self, register):
+        """Records every downloaded lecture in 'register' which isn't already stored,
+            e.g. those downloaded before the store existed. Lectures whose variant can't be
+            told, see downloadedKey, are left out rather than risk linking the wrong quality."""
+        for course in register.iterCourses():
+            for lecture in course.lectures:
+                if not lecture.filename:
+                    continue
+                key = downloadedKey(lecture)
+                if key is not None and key not in self.entries:
+                    self.add(lecture, lecture.filename, lecture.size, lecture.etag, key)
+
+    def forget(self, lecture):
+        """Removes every video stored in a downloaded lecture's file, e.g. once it's found to be bad."""
+        with self.lock:
+            keys = [key for key, entry in self.entries.items() if entry['path'] == lecture.filename]
+            for key in keys:
+                del self.entries[key]
+            self.changed = self.changed or bool(keys)
+
+    def save(self):
+        """Writes index to file, if it has changed."""
+        with self.lock:
+            if not self.changed:
+                return
+            os.makedirs(os.path.dirname(self.filename) or '.', exist_ok=True)
+            writeAtomic(self.filename, lambda storefile: json.dump(self.entries, storefile))
+            self.changed = False
+
+def dedupe(arguments, options):
+    """Links duplicate lecture videos under 'lectures/' together, so each is stored once.
+    Usage:
+        echoscraper dedupe [options] <filename>
+    Options:
+        -j N: Checksums N files in parallel [j]obs, default 4
+        -n: Only reports duplicates, [n]o files are changed"""
+    # Only needed here, download imports this module
+    from concurrent.futures import ThreadPoolExecutor
+    from .download import PART_SUFFIX, SEGMENTS_SUFFIX
+    from .progress import humanize
+    from .verify import Verifier, JOBS
+
+    jobs = options.get('j', JOBS)
+    if jobs < 1:
+        print("Option '-j' must be a positive number.")
+        return
+
+    # Checksums are cached alongside verify's, in '<register>.verify'
+    verifier = Verifier(arguments[0], jobs)
+    if not verifier.register.exists:
+        return
+
+    store = ContentStore()
+    store.addDownloaded(verifier.register)
+
+    # Only files of the same size can be duplicates, and hardlinks of a file are already one copy
+    bySize = {}     # Size: {(device, inode): [(path, stat), ...]}
+    for dirpath, _, filenames in os.walk(LECTURES_DIR):
+        for name in filenames:
+            if name.startswith('.') or name.endswith((PART_SUFFIX, SEGMENTS_SUFFIX, LINK_SUFFIX)):
+                # Index, temporary and partly downloaded files
+                continue
+            path = os.path.join(dirpath, name)
+            stat = os.stat(path)
+            if stat.st_size:
+                bySize.setdefault(stat.st_size, {}).setdefault((stat.st_dev, stat.st_ino), []).append((path, stat))
+
+    copies = [(size, paths) for size, inodes in bySize.items() if len(inodes) > 1 for paths in inodes.values()]
+    if copies:
+        print("Checksumming {} files...".format(len(copies)))
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        digests = list(pool.map(lambda copy: verifier.fingerprint(*copy[1][0]), copies))
+
+    duplicates = {}     # (size, MD5): list of copies, each a list of (path, stat) sharing an inode
+    for (size, paths), digest in zip(copies, digests):
+        duplicates.setdefault((size, digest), []).append(paths)
+
+    change = 'n' not in options
+    found = linked = failed = saved = 0
+    for (size, digest), group in sorted(duplicates.items(), key=lambda item: item[1][0][0][0]):
+        if len(group) < 2:
+            continue
+
+        # Copies are linked to the one with the most paths already, so fewest files change
+        group.sort(key=lambda paths: (-len(paths), paths[0][0]))
+        keep = group[0][0][0]
+        for paths in group[1:]:
+            done = True
+            for path, _ in paths:
+                found = found + 1
+                print("  Duplicate: '{0}' of '{1}'".format(path, keep))
+                if not change:
+                    continue
+
+                if linkFile(keep, path) is None:
+                    print("    Couldn't link, e.g. it's on another device.")
+                    failed = failed + 1
+                    done = False
+                    continue
+                linked = linked + 1
+
+                # Link has a new inode or mtime, which would make its checksum look stale
+                stat = os.stat(path)
+                verifier.fingerprints[path] = [stat.st_size, stat.st_mtime_ns, stat.st_ino, digest]
+
+            if done:
+                saved = saved + size
+
+    store.save()
+    verifier.save()
+
+    if change:
+        print("Linked {0} of {1} duplicate files, saving {2}{3}.".format(
+            linked, found, humanize(saved), ", {} couldn't be linked".format(failed) if failed else ''))
+    else:
+        print("Found {0} duplicate files, linking them would save {1}.".format(found, humanize(saved)))
@@ -0,0 +1,205 @@
+"""Scrapes and downloads in one pass, starting each course's downloads as soon as its syllabus is scraped.
+    Options:
+        -j N: Runs N downloads in parallel [j]obs, default 1
+        -f N: [f]etches N course syllabuses in parallel, default 4
+        -q QUALITY: Chooses the [q]uality of lectures encoded in several, see download
+        -r MB: Limits combined download [r]ate to MB per second
+        -l: Forces a fresh [l]ogin instead of resuming the previous session
+    Downloads begin without asking, ^C stops once downloads in progress finish."""
+
+import queue        # Hands lectures from scraping to download workers
+import signal       # Captures SIGINT
+import threading    # Runs download workers
+
+import requests.adapters    # Sizes connection pool for syllabuses and downloads
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from . import scraper
+from .download import LectureDownloader, chooseVariants
+from .progress import Progress
+from .register import Register, FLUSH_EVERY, FLUSH_INTERVAL
+from .scheduler import TokenBucket, isVariantPolicy
+
+# Lectures scraped but not yet downloaded, per download worker. Once this many are waiting,
+# no more syllabuses are fetched until a worker takes one.
+BACKLOG = 2
+
+# Seconds between recording finished downloads while waiting on scraping or a full queue
+WAIT = 0.2
+
+def start(arguments, options):
+    """Begins syncing.
+        returns: True if every lecture found was tried"""
+    jobs = options.get('j', 1)
+    fetches = options.get('f', scraper.JOBS)
+    rate = options.get('r', 0) * 2**20
+
+    if jobs < 1 or fetches < 1 or rate < 0:
+        print("Options '-j', '-f' and '-r' must be positive numbers.")
+        return
+
+    if not isVariantPolicy(options.get('q', 'largest')):
+        print("Option '-q' must be 'largest', 'smallest', a height e.g. '720p' or a bitrate e.g. '800k'.")
+        return
+
+    bucket = TokenBucket(rate) if rate else None
+    return Syncer(arguments[0], jobs, fetches, options.get('q'), bucket).run('l' in options)
+
+class Syncer(object):
+    """Pipes lectures from a LectureSpider straight to a LectureDownloader's workers.
+        Syllabuses are fetched by one pool of threads, and downloads run in another, through a
+        bounded queue. Both share one session, and the register is only ever modified from the
+        main thread, which merges scraped lectures and records finished downloads.
+
+        main:      fetch syllabus -> merge into register -> tasks (bounded) -> record download
+        workers:                                            tasks -> download -> finished"""
+
+    def __init__(self, regname, jobs=1, fetches=scraper.JOBS, policy=None, bucket=None):
+        self.regname = regname
+        self.jobs = jobs            # Parallel downloads
+        self.policy = policy        # Variant chosen by '-q'
+        self.bucket = bucket        # TokenBucket limiting combined rate of all downloads
+        self.spider = scraper.LectureSpider(regname, fetches)
+        self.downloader = None      # Made once the register exists, see run
+        self.register = None
+        self.bar = None
+
+        self.tasks = queue.Queue(maxsize=jobs * BACKLOG)   # (course, lecture) to download
+        self.finished = queue.Queue()   # ((course, lecture), (filepath, etag)) to record
+        self.scraped = False    # Every syllabus has been merged, workers stop once tasks run out
+        self.stopping = False   # Stop scraping, and starting downloads
+        self.error = None       # First exception raised by a download worker
+        self.found = 0
+
+    def run(self, fresh=False):
+        """returns: True if every lecture found was tried"""
+        if not self.spider.login(fresh):
+            return False
+
+        # Register is read once and kept for the whole run, changes are flushed in batches
+        self.register = Register(self.regname, FLUSH_EVERY, FLUSH_INTERVAL)
+        self.spider.register = self.register
+        if not self.register.exists:
+            self.spider.cache.clear()
+
+        # One connection pool for syllabuses and downloads
+        connections = self.spider.jobs + self.jobs
+        adapter = requests.adapters.HTTPAdapter(pool_connections=connections, pool_maxsize=connections)
+        self.spider.sesh.mount('https://', adapter)
+        self.spider.sesh.mount('http://', adapter)
+
+        with self.register:
+            self.spider.scrape_courselist()
+
+            self.downloader = LectureDownloader(self.regname, bucket=self.bucket)
+            self.downloader.sesh = self.spider.sesh
+            self.downloader.register = self.register
+            self.downloader.store.addDownloaded(self.register)
+            # Downloader catches ^C itself, but scraping needs to stop too
+            signal.signal(signal.SIGINT, self.stop)
+
+            self.bar = Progress(0)
+            workers = [threading.Thread(target=self.worker) for _ in range(self.jobs)]
+            for thread in workers:
+                thread.start()
+
+            try:
+                self.scrape()
+            finally:
+                # Workers stop once tasks run out, their downloads are recorded as they finish
+                self.scraped = True
+                for thread in workers:
+                    while thread.is_alive():
+                        thread.join(WAIT)
+                        self.drain()
+                self.drain()
+                self.bar.close()
+                self.downloader.store.save()
+
+            if self.error is not None:
+                raise self.error
+
+        # Only save cache once its pages are safely in the register
+        self.spider.cache.save()
+        print("Page cache: {}".format(self.spider.cache.summary()))
+        print("{0} new lecture{1} found, {2} downloaded.".format(
+            self.found, 's' if self.found != 1 else '', self.downloader.numDownloaded))
+        return not self.stopping
+
+    def scrape(self):
+        """Fetches syllabuses, queueing each course's missing lectures once it's merged.
+            Only as many syllabuses are fetched at once as there are fetch threads, and none
+            while the queue is full, so scraping never runs far ahead of downloading."""
+        courses = iter(enumerate(list(self.register)))
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.spider.jobs) as pool:
+            while True:
+                while not self.stopping and len(running) < self.spider.jobs:
+                    course = next(courses, None)
+                    if course is None:
+                        break
+                    running[pool.submit(self.spider.scrape_course_lectures, course[1])] = course[0]
+
+                if not running:
+                    break
+
+                done, _ = wait(running, timeout=WAIT, return_when=FIRST_COMPLETED)
+                self.drain()
+                for future in done:
+                    self.merge(running.pop(future), future.result())
+
+    def merge(self, indx, lectures):
+        """Adds scraped lectures to a course in the register, then queues its missing lectures."""
+        for lect in lectures:
+            if self.register.appendLecture(indx, lect):
+                self.found = self.found + 1
+
+        course = self.register[indx]
+        tasks = [(course, lecture) for lecture in course.lectures if lecture.dllink and not lecture.filename]
+        for task in chooseVariants(tasks, self.policy):
+            self.enqueue(task)
+
+    def enqueue(self, task):
+        """Queues a lecture for the download workers, recording finished downloads while the queue is full."""
+        while not self.stopping:
+            try:
+                self.tasks.put(task, timeout=WAIT)
+            except queue.Full:
+                self.drain()
+                continue
+            self.bar.queued()
+            return
+
+    def worker(self):
+        """Downloads queued lectures until every syllabus is scraped and the queue is empty, or until stopped."""
+        while not self.stopping:
+            try:
+                task = self.tasks.get(timeout=WAIT)
+            except queue.Empty:
+                if self.scraped:
+                    return
+                continue
+            try:
+                result = self.downloader.downloadLecture(*task, self.bar)
+            except Exception as err:
+                # e.g. disk full, which would fail every download after it too.
+                # Everything stops, and the error is raised again in the main thread.
+                self.error = self.error or err
+                self.stopping = True
+                result = (None, None)
+            self.finished.put((task, result))
+
+    def drain(self):
+        """Records downloads which have finished, in the main thread."""
+        while True:
+            try:
+                (course, lecture), result = self.finished.get_nowait()
+            except queue.Empty:
+                return
+            self.downloader.record(None, course, lecture, *result)
+
+    def stop(self, *args):
+        """Captures SIGINT, stopping once downloads in progress finish, or quitting if pressed twice."""
+        self.stopping = True
+        self.downloader.interrupt_handler()
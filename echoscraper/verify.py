@@ -0,0 +1,145 @@
+"""Checks downloaded lectures are still on disk and complete, so bad ones are downloaded again.
+    Options:
+          : default checks each file exists and has the size recorded when it was downloaded
+        -c: Also [c]hecksums files, comparing them to the server's ETag where it's an MD5
+        -j N: Checksums N files in parallel [j]obs, default 4
+        -n: Only reports bad files, [n]o changes are made to the register"""
+
+import hashlib      # Checksums files
+import json         # Fingerprint cache format
+import mmap         # Reads files without copying them into Python
+import os           # Stats files
+import re           # Recognises MD5 ETags
+from concurrent.futures import ThreadPoolExecutor
+
+from .register import Register
+from .store import ContentStore
+from .storage import writeAtomic
+
+# Number of files checksummed at once
+JOBS = 4
+
+# Checksums are cached in '<register>.verify', and reused while a file's stat is unchanged
+FINGERPRINT_SUFFIX = '.verify'
+
+BLOCK_SIZE = 2**22  # Bytes hashed at a time
+
+# ETags of files uploaded to S3 in one go are the MD5 of their contents
+MD5_ETAG = re.compile(r'^"?([0-9a-f]{32})"?$')
+
+def start(arguments, options):
+    """Verifies downloaded lectures."""
+    jobs = options.get('j', JOBS)
+    if jobs < 1:
+        print("Option '-j' must be a positive number.")
+        return
+
+    Verifier(arguments[0], jobs).run('c' in options, 'n' not in options)
+
+def checksum(filepath):
+    """returns: MD5 hex digest of a file's contents"""
+    digest = hashlib.md5()
+    with open(filepath, 'rb') as fd:
+        if os.fstat(fd.fileno()).st_size:
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    # hashlib releases the GIL on large blocks, so threads hash in parallel
+                    for offset in range(0, len(view), BLOCK_SIZE):
+                        digest.update(view[offset:offset + BLOCK_SIZE])
+                finally:
+                    view.release()
+    return digest.hexdigest()
+
+class Verifier(object):
+    def __init__(self, regname, jobs=JOBS):
+        self.regname = regname
+        self.jobs = jobs
+        self.register = Register(regname, flushEvery=1, load=False)
+        self.cachename = regname + FINGERPRINT_SUFFIX
+
+        # Filepath: [size, mtime, inode, MD5] of file when it was last checksummed
+        try:
+            with open(self.cachename, encoding='utf-8') as cachefile:
+                self.fingerprints = json.load(cachefile)
+        except (FileNotFoundError, ValueError):
+            self.fingerprints = {}
+
+    def run(self, hashing=False, reset=True):
+        if not self.register.exists:
+            return
+
+        bad = []        # (course, lecture, reason)
+        checked = 0
+        unknown = 0     # Files which can't be checked against a size or checksum
+        toHash = []     # (course, lecture, stat)
+
+        # Fast pass, only stats files
+        for course in self.register.iterCourses():
+            for lecture in course.lectures:
+                if not lecture.filename:
+                    continue
+                checked = checked + 1
+
+                try:
+                    stat = os.stat(lecture.filename)
+                except FileNotFoundError:
+                    bad.append((course, lecture, "missing"))
+                    continue
+
+                if lecture.size is not None and stat.st_size != lecture.size:
+                    bad.append((course, lecture, "{0} of {1} bytes".format(stat.st_size, lecture.size)))
+                    continue
+
+                if hashing and lecture.etag and MD5_ETAG.match(lecture.etag):
+                    toHash.append((course, lecture, stat))
+                elif lecture.size is None:
+                    unknown = unknown + 1
+
+        # Slow pass, checksums files which have changed since they were last checksummed
+        if toHash:
+            print("Checksumming {} files...".format(len(toHash)))
+            with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                digests = pool.map(lambda task: self.fingerprint(task[1].filename, task[2]), toHash)
+                for (course, lecture, _), digest in zip(toHash, digests):
+                    if digest != MD5_ETAG.match(lecture.etag).group(1):
+                        bad.append((course, lecture, "checksum doesn't match"))
+
+            # Forget files which are no longer in the register
+            hashed = {lecture.filename for _, lecture, _ in toHash}
+            self.fingerprints = {path: fp for path, fp in self.fingerprints.items() if path in hashed}
+            self.save()
+
+        for course, lecture, reason in bad:
+            print("  Bad: '{0}' ({1})".format(lecture.filename, reason))
+
+        if bad and reset:
+            store = ContentStore()
+            with self.register:
+                for course, lecture, _ in bad:
+                    # Lecture is downloaded again by the next 'download', rather than linked
+                    store.forget(lecture)
+                    self.register.setFilename(course, lecture, '')
+            store.save()
+
+        print("Checked {0} files: {1} bad{2}{3}.".format(
+            checked,
+            len(bad),
+            ", {} without a recorded size".format(unknown) if unknown else '',
+            ", reset to be downloaded again" if bad and reset else ''
+        ))
+
+    def fingerprint(self, filepath, stat):
+        """returns: MD5 of a file, from cache if the file hasn't changed since it was cached"""
+        key = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+        cached = self.fingerprints.get(filepath)
+        if cached and cached[:3] == key:
+            return cached[3]
+
+        digest = checksum(filepath)
+        self.fingerprints[filepath] = key + [digest]
+        return digest
+
+    def save(self):
+        """Writes fingerprint cache to file."""
+        writeAtomic(self.cachename, lambda cachefile: json.dump(self.fingerprints, cachefile))
@@ -0,0 +1,214 @@
+"""Keeps watching for new lecture recordings, downloading each as soon as it's found.
+    One session and register are kept for the whole run, instead of logging in and
+    reading the register again for every scrape and download. Checks are made more often
+    in the hours after lectures are timetabled, when their recordings are published.
+    Options:
+        -i MINUTES: Checks for new lectures every MINUTES [i]nterval, default 60
+        -j N: Runs N downloads in parallel [j]obs, default 1
+        -q QUALITY: Chooses the [q]uality of lectures encoded in several, see download
+        -r MB: Limits combined download [r]ate to MB per second
+        -l: Forces a fresh [l]ogin instead of resuming the previous session
+    Stops once downloads in progress finish, on ^C or SIGTERM."""
+
+import random       # Jitters intervals between checks
+import signal       # Stops gracefully on SIGINT and SIGTERM
+import sys          # Checks if login can prompt
+import threading    # Sleeps until the next check, or until stopped
+
+import requests.adapters            # Sizes connection pool for parallel downloads
+import requests.exceptions as rEx   # A failed check is retried at the next one
+from datetime import datetime, timedelta
+
+from . import metrics
+from .download import LectureDownloader, lecturesToDownload, chooseVariants
+from .register import Register, FLUSH_EVERY, FLUSH_INTERVAL
+from .scheduler import DownloadQueue, TokenBucket, QUEUE_SUFFIX, order, isVariantPolicy
+from .scraper import LectureSpider
+
+# Minutes between checks, by default
+INTERVAL = 60
+
+# Recordings of a lecture are expected between these many seconds after it starts,
+# during which checks are made every BUSY_INTERVAL seconds
+PUBLISH_WINDOW = (45 * 60, 4 * 60 * 60)
+BUSY_INTERVAL = 5 * 60
+
+# Lectures from this many weeks before now make up the timetable, see timetable
+TIMETABLE_WEEKS = 3
+
+# Intervals vary by up to this fraction either way, so checks don't fall on the same minute
+JITTER = 0.2
+
+DAY = 24 * 60 * 60
+WEEK = 7 * DAY
+
+def start(arguments, options):
+    """Begins watching.
+        returns: True once stopped"""
+    interval = options.get('i', INTERVAL)
+    jobs = options.get('j', 1)
+    rate = options.get('r', 0) * 2**20
+
+    if interval <= 0 or jobs < 1 or rate < 0:
+        print("Options '-i', '-j' and '-r' must be positive numbers.")
+        return
+
+    if not isVariantPolicy(options.get('q', 'largest')):
+        print("Option '-q' must be 'largest', 'smallest', a height e.g. '720p' or a bitrate e.g. '800k'.")
+        return
+
+    bucket = TokenBucket(rate) if rate else None
+    return Watcher(arguments[0], interval * 60, jobs, options.get('q'), bucket).run('l' in options)
+
+def timetable(register, now, weeks=TIMETABLE_WEEKS):
+    """returns: set of (weekday, seconds after midnight) at which lectures in the register
+        started, over the 'weeks' weeks before 'now'. Lectures repeat weekly during
+        a semester, and older ones are left out, so the timetable is empty between semesters."""
+    since = now - timedelta(weeks=weeks)
+    slots = set()
+    for course in register.iterCourses():
+        for lecture in course.lectures:
+            if not (lecture.date and lecture.time):
+                continue
+            try:
+                started = datetime.strptime(lecture.date + ' ' + lecture.time, '%Y/%m/%d %H:%M')
+            except ValueError:
+                continue
+            if since <= started <= now:
+                slots.add((started.weekday(), started.hour * 3600 + started.minute * 60))
+    return slots
+
+def nextCheck(now, slots, interval):
+    """returns: seconds to wait before the next check, which is BUSY_INTERVAL while a recording
+        is expected from one of the timetable's 'slots', otherwise 'interval', or until a
+        recording is next expected if that's sooner. Either way it's jittered by JITTER."""
+    # Seconds since the start of the week
+    week = now.weekday() * DAY + now.hour * 3600 + now.minute * 60 + now.second
+
+    wait = interval
+    for weekday, seconds in slots:
+        elapsed = (week - weekday * DAY - seconds) % WEEK
+        if PUBLISH_WINDOW[0] <= elapsed < PUBLISH_WINDOW[1]:
+            wait = min(wait, BUSY_INTERVAL)
+        else:
+            wait = min(wait, (PUBLISH_WINDOW[0] - elapsed) % WEEK)
+
+    return wait * random.uniform(1 - JITTER, 1 + JITTER)
+
+class Watcher(object):
+    """Scrapes then downloads new lectures over and over, sharing a session between them.
+        The scraper and downloader both work on the one register, which is loaded once,
+        and only modified from the main thread."""
+
+    def __init__(self, regname, interval=INTERVAL * 60, jobs=1, policy=None, bucket=None):
+        self.regname = regname
+        self.interval = interval    # Seconds between checks, outside of publishing windows
+        self.jobs = jobs            # Parallel downloads
+        self.policy = policy        # Variant chosen by '-q'
+        self.bucket = bucket        # TokenBucket limiting combined rate of all downloads
+        self.spider = LectureSpider(regname)
+        self.downloader = None      # Made once the register exists, see poll
+        self.register = None
+
+        self.stopping = False
+        self.downloading = False
+        self.wake = threading.Event()   # Set to cut a wait short when stopping
+
+    def run(self, fresh=False):
+        """returns: True once stopped"""
+        if not self.spider.login(fresh):
+            return False
+
+        # Register is read once and kept for the whole run, changes are flushed in batches
+        self.register = Register(self.regname, FLUSH_EVERY, FLUSH_INTERVAL)
+        self.spider.register = self.register
+        if not self.register.exists:
+            self.spider.cache.clear()
+
+        # One connection pool for syllabuses and downloads
+        connections = max(self.spider.jobs, self.jobs)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=connections, pool_maxsize=connections)
+        self.spider.sesh.mount('https://', adapter)
+        self.spider.sesh.mount('http://', adapter)
+
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
+        print("Watching '{}' for new lectures, ^C to stop.".format(self.regname))
+        while not self.stopping:
+            self.poll()
+            if self.stopping:
+                break
+
+            now = datetime.now()
+            wait = nextCheck(now, timetable(self.register, now), self.interval)
+            print("Next check at {:%H:%M}.".format(now + timedelta(seconds=wait)))
+            self.wake.wait(wait)
+
+        print("Stopped watching.")
+        return True
+
+    @metrics.timed('watch.poll')
+    def poll(self):
+        """Scrapes for new lectures, then downloads every lecture which is still missing."""
+        try:
+            if not self.relogin():
+                return
+
+            added = self.spider.scrape()
+            # Cookies refreshed since logging in are kept for other commands
+            self.spider.saveSession()
+        except rEx.RequestException as err:
+            print("Couldn't check for new lectures: {}".format(err))
+            return
+
+        if added:
+            print("Found {0} new lecture{1}.".format(len(added), 's' if len(added) != 1 else ''))
+
+        tasks = list(lecturesToDownload(self.register, None))
+        if not tasks or self.stopping:
+            return
+        tasks = chooseVariants(tasks, self.policy)
+
+        if self.downloader is None:
+            self.downloader = LectureDownloader(self.regname, bucket=self.bucket)
+            self.downloader.sesh = self.spider.sesh
+            self.downloader.register = self.register
+            self.downloader.store.addDownloaded(self.register)
+            # Downloader catches ^C itself, but stopping is handled here
+            signal.signal(signal.SIGINT, self.stop)
+
+        # Newest lectures first, as they're the ones just published
+        queue = DownloadQueue(self.regname + QUEUE_SUFFIX)
+        tasks = queue.create(order(tasks, 'newest'))
+        self.downloading = True
+        try:
+            self.downloader.downloadQueued(queue, tasks, self.jobs)
+        finally:
+            self.downloading = False
+
+    def relogin(self):
+        """Logs in again if the session has expired, prompting only if there's a terminal.
+            returns: True if logged in"""
+        # Another command may have logged in and saved a newer session meanwhile
+        if self.spider.loggedIn() or self.spider.resumeSession():
+            return True
+
+        if not sys.stdin.isatty():
+            print("Session has expired, waiting for a login e.g. 'echoscraper scrape -l {}'.".format(self.regname))
+            return False
+        return self.spider.login(fresh=True)
+
+    def stop(self, *args):
+        """Captures SIGINT and SIGTERM, stopping once downloads in progress finish."""
+        if self.downloading:
+            # Downloader halts, or quits if stopped twice
+            self.stopping = True
+            self.downloader.interrupt_handler()
+        elif not self.stopping:
+            self.stopping = True
+            print("\nStopping...")
+            self.wake.set()
+        else:
+            print("\nQuitting...")
+            sys.exit(1)
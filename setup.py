@@ -28,7 +28,7 @@ with open("README.rst", "rb") as f:
 # urllib3==1.22
 # wrapt==1.10.11
 
-requirements = ["clint==0.5.1", "lxml==4.1.1", "requests==2.18.4"]
+requirements = ["lxml==4.1.1", "requests==2.18.4"]
 
 setup(
     name = "echoscraper",
@@ -42,5 +42,11 @@ setup(
     author = "ChickaChickaChicka",
     author_email = "gatecrasher53@gmail.com",
     # url = "http://gehrcke.de/2014/02/distributing-a-python-command-line-application",
-    install_requires = requirements
+    install_requires = requirements,
+    extras_require = {
+        # Faster loading and saving of large JSON registers
+        "fast": ["orjson"],
+        # Asynchronous client, see 'scrape -a' and 'download -a'
+        "async": ["aiohttp"]
+    }
 )
\ No newline at end of file